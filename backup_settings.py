@@ -15,46 +15,105 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-from datetime import datetime
-from typing import Final
+import argparse
+import json
+import sys
+import time
 
-from controller.dispatcher import Dispatcher
+from controller.dispatcher import IMPORT_STATUS_TOPIC, IMPORT_TOPIC, Dispatcher, Route
 from controller.mqtt import Mqtt
 
+# Our own session, poupool would be disconnected if we used its client id. The spool of poupool
+# is not used either.
+CLIENT_ID = "poupool-backup"
 
-class BackupDispatcher(Dispatcher):
-    ignore: Final = ["/status/filtration/duration"]
 
-    def __init__(self, fd):
-        self.__fd = fd
-
-    def dispatch(self, topic, payload):
-        if topic in self.ignore:
-            return
-        data = payload.decode("utf-8")
-        self.__fd.write(f'mosquitto_pub -t {topic} -m "{data}" -r\n')
-
-
-def main():
-    print("Starting backup...")
-    with open("backup.txt", "w") as fd:
-        dispatcher = BackupDispatcher(fd)
-        dispatcher.register(None, None, None, None, None, None, None, None)
-
-        fd.write(f"# Backup from {datetime.now()}\n")
+def export(path, timeout):
+    # Without actors, the dispatcher only collects the retained settings. It is done as soon as all
+    # the topics are received or the broker has sent all its retained messages.
+    dispatcher = Dispatcher()
+    dispatcher.register()
+    mqtt = Mqtt.start(dispatcher, client_id=CLIENT_ID, spool=False, requests=False).proxy()
+    mqtt.do_start().get()
+    try:
+        restored = dispatcher.wait_restored(timeout) and dispatcher.restore_complete
+        document = dispatcher.export()
+    finally:
+        mqtt.do_stop()
+        mqtt.stop()
+    missing = dispatcher.missing()
+    if not restored:
+        # Do not replace a good backup with a partial one
+        print(f"Timeout while waiting for the retained settings, missing: {', '.join(missing)}")
+        return 1
+    with open(path, "w") as fd:
+        json.dump(document, fd, indent=2, sort_keys=True)
+    print(f"Exported {len(document['settings'])} settings to {path}")
+    if missing:
+        print(f"Not set on the broker: {', '.join(missing)}")
+    return 0
 
-        mqtt = Mqtt.start(dispatcher).proxy()
-        mqtt.do_start()
 
-        # Don't stop the client too quickly or not all messages will be published.
-        import time
+def wait_result(dispatcher, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = dispatcher.value(IMPORT_STATUS_TOPIC)
+        if result is not None:
+            return json.loads(result)
+        time.sleep(0.1)
+    return None
 
-        time.sleep(1)
 
+def restore(path, timeout):
+    with open(path) as fd:
+        document = json.load(fd)
+    # Checked here first, poupool then applies all of them at once and publishes them
+    validator = Dispatcher()
+    validator.register()
+    try:
+        settings = validator.import_settings(document)
+    except ValueError as e:
+        print(f"Invalid settings file: {e}")
+        return 1
+    # Only collect the answer of poupool
+    dispatcher = Dispatcher(routes=(Route(IMPORT_STATUS_TOPIC, None, None, "string", export=False),))
+    dispatcher.register()
+    mqtt = Mqtt.start(dispatcher, client_id=CLIENT_ID, spool=False, requests=False).proxy()
+    mqtt.do_start().get()
+    try:
+        # Connected once the retained messages are received
+        if not dispatcher.wait_restored(timeout):
+            print("Timeout while connecting to the broker")
+            return 1
+        if not mqtt.publish(IMPORT_TOPIC, json.dumps(document), qos=1).get():
+            print("Unable to send the settings to poupool")
+            return 1
+        result = wait_result(dispatcher, timeout)
+        if result is None:
+            # Poupool is not running, e.g. when rebuilding the broker. It restores the retained
+            # settings on its next start.
+            for topic, data in settings:
+                mqtt.publish(topic, data, qos=1, retain=True).get()
+            print(f"No answer from poupool, published {len(settings)} retained settings for its next start")
+            return 0
+    finally:
         mqtt.do_stop()
         mqtt.stop()
-    print("Done")
+    if "error" in result:
+        print(f"Import rejected by poupool: {result['error']}")
+        return 1
+    print(f"Imported {result['imported']} settings")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or restore the poupool settings as a JSON document")
+    parser.add_argument("--restore", action="store_true", help="send the settings of the file to poupool")
+    parser.add_argument("--timeout", type=float, default=10, help="maximum duration in seconds to wait for the broker")
+    parser.add_argument("path", nargs="?", default="backup.json", help="settings file")
+    args = parser.parse_args()
+    return restore(args.path, args.timeout) if args.restore else export(args.path, args.timeout)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,84 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Cost of Dispatcher.dispatch() per message, the actors only count the calls. The debounce merges
+# most of them since the messages are all sent at once.
+#
+#   python -m benchmark.dispatch
+
+import logging
+import random
+import time
+
+from controller.dispatcher import WINDOWS, Dispatcher
+
+PAYLOADS = {
+    "/settings/mode": [b"eco", b"standby", b"halt"],
+    "/settings/filtration/duration": [b"36000", b"3600.0"],
+    "/settings/filtration/tank_percentage": [b"0.1"],
+    "/settings/heating/enable": [b"1", b"off"],
+    "/settings/disinfection/ph/setpoint": [b"7.2"],
+    "/settings/swim/mode": [b"timed", b"continuous"],
+    # Out of range, invalid and unknown
+    "/settings/filtration/period": [b"42", b"abc"],
+    "/settings/unknown": [b"1"],
+}
+
+
+calls = 0
+
+
+class Method:
+    __slots__ = ()
+
+    def defer(self, *args):
+        global calls
+        calls += 1
+
+
+class Actor:
+    def __getattr__(self, name):
+        return Method()
+
+
+def messages(count):
+    rng = random.Random(0)
+    topics = sorted(PAYLOADS)
+    return [(topic, rng.choice(PAYLOADS[topic])) for topic in (rng.choice(topics) for _ in range(count))]
+
+
+def main():
+    # The invalid values are logged
+    logging.disable(logging.CRITICAL)
+    dispatcher = Dispatcher()
+    start = time.perf_counter()
+    dispatcher.register(*[Actor() for _ in range(8)])
+    register = time.perf_counter() - start
+    sequence = messages(200000)
+    dispatch = dispatcher.dispatch
+    start = time.perf_counter()
+    for topic, payload in sequence:
+        dispatch(topic, payload)
+    elapsed = time.perf_counter() - start
+    time.sleep(max(WINDOWS.values()) + 0.5)
+    print(f"register: {register * 1e3:.3f}ms")
+    print(f"dispatch: {elapsed / len(sequence) * 1e9:.0f}ns/message, {len(sequence) / elapsed:.0f} messages/s")
+    print(f"calls: {calls} for {len(sequence)} messages")
+
+
+if __name__ == "__main__":
+    main()
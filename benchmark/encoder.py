@@ -0,0 +1,101 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Cost of a status update through the Encoder compared with resolving the topic on every call like
+# we used to. The actors drop the messages and every value is accepted so that only the encoder is
+# measured.
+#
+#   python -m benchmark.encoder
+
+import time
+import tracemalloc
+
+from controller.actor import defer_coalesced
+from controller.encoder import STATUS_TOPICS, Encoder
+
+
+class Actor:
+    def __init__(self):
+        self.actor_ref = self
+
+    def tell(self, message):
+        pass
+
+
+class Policy:
+    def accept(self, name, value):
+        return True
+
+
+class LegacyEncoder:
+    def __init__(self, mqtt, lcd, policy, snapshot):
+        self.__mqtt = mqtt
+        self.__lcd = lcd
+        self.__policy = policy
+        self.__snapshot = snapshot
+
+    def __getattr__(self, value):
+        topic = "/status/" + "/".join(value.split("_"))
+        topic = topic.replace("//", "_")
+
+        def wrapper(x, **kwargs):
+            if not self.__policy.accept(value, x):
+                return
+            defer_coalesced(self.__mqtt, ("publish", topic), "publish", topic, x, **kwargs)
+            defer_coalesced(self.__lcd, ("update", value), "update", value, x)
+            if self.__snapshot is not None:
+                defer_coalesced(self.__snapshot, ("update", topic), "update", topic, x)
+
+        return wrapper
+
+
+def updates(encoder, names, count):
+    # Like the actors, the method is looked up on every update
+    for i in range(count):
+        getattr(encoder, names[i % len(names)])(i)
+
+
+def bench(encoder, names, count):
+    start = time.perf_counter()
+    updates(encoder, names, count)
+    return (time.perf_counter() - start) / count
+
+
+def lookup_memory(encoder, names, count):
+    # Memory allocated by the lookups, kept alive to be counted
+    tracemalloc.start()
+    publishers = [getattr(encoder, names[i % len(names)]) for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del publishers
+    return size / count
+
+
+def main():
+    names = list(STATUS_TOPICS)
+    count = 200000
+    print(f"{len(names)} status topics, {count} updates")
+    print(f"{'encoder':<10}{'ns/update':>12}{'bytes/lookup':>14}")
+    for label, encoder_class in (("legacy", LegacyEncoder), ("cached", Encoder)):
+        encoder = encoder_class(Actor(), Actor(), Policy(), Actor())
+        per_update = bench(encoder, names, count)
+        memory = lookup_memory(encoder, names, count // 10)
+        print(f"{label:<10}{per_update * 1e9:>12.0f}{memory:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
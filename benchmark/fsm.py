@@ -0,0 +1,144 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Compare the table driven state machine with transitions on the Filtration state machine.
+#
+#   python -m benchmark.fsm
+
+import logging
+import random
+import time
+from unittest import mock
+
+import pykka
+from transitions.extensions import HierarchicalMachine
+
+from controller.fsm import Machine
+
+
+class Recorder:
+    def __init__(self, model, states, initial, before_state_change=None):
+        self.states = states
+        self.initial = initial
+        self.before_state_change = [*(before_state_change or []), "do_cancel"]
+        self.transitions = []
+
+    def add_transition(self, trigger, source, dest, **kwargs):
+        self.transitions.append((trigger, source, dest, kwargs))
+
+
+def capture_filtration():
+    from controller import filtration
+
+    recorders = []
+
+    def recorder(**kwargs):
+        recorders.append(Recorder(**kwargs))
+        return recorders[-1]
+
+    with mock.patch.object(filtration, "PoupoolModel", recorder):
+        filtration.Filtration(mock.Mock(), mock.Mock(), mock.MagicMock())
+    pykka.ActorRegistry.stop_all()
+    return recorders[0]
+
+
+def name(callback):
+    return callback if isinstance(callback, str) else callback.__name__
+
+
+def listify(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def make_model_class(recorder):
+    # Model with no-op callbacks so that we only measure the state machine
+    attributes = {}
+
+    def noop(self):
+        pass
+
+    def guard(self):
+        return self.rng.random() < 0.5
+
+    for _, _, _, kwargs in recorder.transitions:
+        for callback in listify(kwargs.get("conditions")) + listify(kwargs.get("unless")):
+            attributes[name(callback)] = guard
+        for callback in listify(kwargs.get("before")) + listify(kwargs.get("after")):
+            attributes[name(callback)] = noop
+    for callback in recorder.before_state_change:
+        attributes[name(callback)] = noop
+    return type("Filtration", (), attributes)
+
+
+def build(engine, recorder, model_class):
+    model = model_class()
+    model.rng = random.Random(0)
+    extra = {"auto_transitions": False, "ignore_invalid_triggers": True} if engine is HierarchicalMachine else {}
+    before = [name(c) for c in recorder.before_state_change]
+    machine = engine(model=model, states=recorder.states, initial=recorder.initial, before_state_change=before, **extra)
+    for trigger, source, dest, kwargs in recorder.transitions:
+        kwargs = {key: [name(c) for c in listify(value)] for key, value in kwargs.items()}
+        machine.add_transition(trigger, source, dest, **kwargs)
+    return model
+
+
+def bench_startup(engine, recorder, model_class, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        build(engine, recorder, model_class)
+    return (time.perf_counter() - start) / count
+
+
+def bench_triggers(engine, recorder, model_class, count):
+    model = build(engine, recorder, model_class)
+    rng = random.Random(1)
+    triggers = sorted({t[0] for t in recorder.transitions})
+    sequence = [getattr(model, rng.choice(triggers)) for _ in range(count)]
+    start = time.perf_counter()
+    executed = sum(1 for trigger in sequence if trigger())
+    elapsed = time.perf_counter() - start
+    return count / elapsed, executed
+
+
+def bench_is_state(engine, recorder, model_class, count):
+    model = build(engine, recorder, model_class)
+    model.eco()
+    is_eco = model.is_eco
+    start = time.perf_counter()
+    for _ in range(count):
+        is_eco(allow_substates=True)
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    # Both engines log the invalid triggers as warnings
+    logging.disable(logging.WARNING)
+    recorder = capture_filtration()
+    model_class = make_model_class(recorder)
+    print(f"Filtration: {len(recorder.transitions)} transitions")
+    print(f"{'engine':<14}{'startup':>14}{'triggers/s':>14}{'executed':>10}{'is_*/s':>14}")
+    for label, engine in (("transitions", HierarchicalMachine), ("fsm", Machine)):
+        startup = bench_startup(engine, recorder, model_class, 100)
+        rate, executed = bench_triggers(engine, recorder, model_class, 20000)
+        is_rate = bench_is_state(engine, recorder, model_class, 100000)
+        print(f"{label:<14}{startup * 1e3:>12.3f}ms{rate:>14.0f}{executed:>10}{is_rate:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
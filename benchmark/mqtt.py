@@ -0,0 +1,111 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# End to end measurements of poupool with the fake devices and the embedded broker: time from the
+# start to the retained mode being applied, latency from a setting published on the broker to the
+# resulting status, and rate of the status publications.
+#
+#   python -m benchmark.mqtt [count]
+
+import queue
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+import paho.mqtt.client as paho
+
+from controller.broker import Broker
+from controller.dispatcher import LEADING, WINDOWS
+
+# Retained settings restored at start up
+SETTINGS = {
+    "/settings/filtration/speed/eco": "2",
+    "/settings/filtration/duration": "36000",
+    "/settings/filtration/period": "3",
+    "/settings/mode": "eco",
+}
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    broker = Broker().start()
+    retained = paho.Client(paho.CallbackAPIVersion.VERSION2)
+    retained.connect(broker.host, broker.port)
+    retained.loop_start()
+    for topic, value in SETTINGS.items():
+        retained.publish(topic, value, retain=True).wait_for_publish(2)
+    retained.loop_stop()
+    retained.disconnect()
+    spawned = time.monotonic()
+    command = [sys.executable, "poupool.py", "--fake-devices", "--log-config", "none", "--no-disinfection"]
+    command += ["--mqtt-host", broker.host, "--mqtt-port", str(broker.port)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    states = queue.Queue()
+    received = []
+    client = paho.Client(paho.CallbackAPIVersion.VERSION2)
+
+    def on_message(client, userdata, message):
+        received.append(time.monotonic())
+        if message.topic == "/status/filtration/state":
+            states.put((time.monotonic(), message.payload.decode()))
+
+    client.on_message = on_message
+    client.connect(broker.host, broker.port)
+    client.subscribe("/status/#")
+    client.loop_start()
+
+    # Wait for the start up to settle
+    time.sleep(5)
+    startup = []
+    while not states.empty():
+        startup.append(states.get())
+    operational = next(when for when, state in startup if state.startswith("eco")) - spawned
+    start, published = time.monotonic(), broker.received
+
+    latencies = []
+    for i in range(count):
+        mode = "eco" if i % 2 == 0 else "halt"
+        while not states.empty():
+            states.get()
+        sent = time.monotonic()
+        client.publish("/settings/mode", mode)
+        # The first state published after the setting
+        when, _ = states.get(timeout=10)
+        latencies.append(when - sent)
+        # Let the transitions triggered by the mode settle, past the debounce of the modes
+        time.sleep(WINDOWS[LEADING] + 0.5)
+
+    elapsed = time.monotonic() - start
+    rate = (broker.received - published) / elapsed
+    client.loop_stop()
+    client.disconnect()
+    process.send_signal(signal.SIGINT)
+    process.wait(30)
+    broker.stop()
+
+    print(f"operational after {operational:.2f}s, start up states: {[state for _, state in startup]}")
+    median = statistics.median(latencies) * 1e3
+    print(
+        f"settings to status latency over {count} mode changes: median {median:.1f}ms max {max(latencies) * 1e3:.1f}ms"
+    )
+    print(f"status publications: {rate:.1f}/s over {elapsed:.0f}s, {len(received)} messages received")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# Idle CPU usage of poupool with the fake devices and the embedded broker.
+#
+#   python -m benchmark.mqtt_idle [seconds]
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from controller.broker import Broker
+
+
+def process_times(pid):
+    # User and system time of a running process from /proc, in seconds
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 30
+    broker = Broker().start()
+    command = [sys.executable, "poupool.py", "--fake-devices", "--log-config", "none"]
+    command += ["--mqtt-host", broker.host, "--mqtt-port", str(broker.port)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Leave time for the start up and only measure the idle part
+    time.sleep(5)
+    before = process_times(process.pid)
+    time.sleep(duration)
+    after = process_times(process.pid)
+    process.send_signal(signal.SIGINT)
+    process.wait(30)
+    broker.stop()
+    cpu = after - before
+    print(f"idle cpu: {cpu:.2f}s over {duration:.0f}s ({cpu / duration * 100:.1f}%), broker packets: {broker.received}")
+
+
+if __name__ == "__main__":
+    main()
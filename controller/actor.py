@@ -17,13 +17,17 @@
 
 import functools
 import logging
-from datetime import datetime
-from threading import Timer
+import math
+import threading
 
 import pykka
+from pykka.messages import ProxyCall
 
-# from transitions.extensions import HierarchicalGraphMachine as Machine
-from transitions.extensions import HierarchicalMachine as Machine
+from .backend import Coalesced, get_backend
+from .clock import get_clock
+from .fsm import Machine
+from .metrics import message_name
+from .scheduler import scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -42,32 +46,166 @@ def do_repeat():
                 pass
             else:
                 method = func.__name__.replace("on_enter_", "do_repeat_")
-                function = getattr(self._proxy, method)
-                function.defer()
+                # Dropped if the state is left before it runs, e.g. by an urgent halt
+                self.do_later(method)
 
         return wrapped_func
 
     return wrap
 
 
+def defer_coalesced(proxy, key, method, *args, **kwargs):
+    # Same as proxy.method.defer(*args, **kwargs) but the call replaces any call with the same key
+    # still waiting in the inbox of the actor. Only for idempotent calls where the newest wins.
+    message = ProxyCall(attr_path=(method,), args=args, kwargs=kwargs)
+    proxy.actor_ref.tell(Coalesced(key, message))
+
+
+# Current state of each state machine keyed by the class name of its model. It is updated on every
+# transition so that other actors can check a state without a round trip through the mailbox. Only
+# the owner writes its entry and readers do not need a lock.
+_states = {}
+
+
+def publish_state(name, state):
+    _states[name] = state
+
+
+def get_state(name):
+    return _states.get(name)
+
+
+def is_state(name, state, allow_substates=False):
+    current = _states.get(name)
+    if current is None:
+        return False
+    return current == state or (allow_substates and current.startswith(state + "_"))
+
+
 class PoupoolModel(Machine):
-    def __init__(self, **kwargs):
+    def __init__(self, clock=None, **kwargs):
+        self.__clock = clock or get_clock()
         kwargs.setdefault("before_state_change", []).extend(["do_cancel", self.__update_state_time])
-        super().__init__(auto_transitions=False, ignore_invalid_triggers=True, **kwargs)
+        super().__init__(**kwargs)
         self.__state_time = None
 
+    def set_state(self, state, model=None):
+        super().set_state(state, model)
+        for mod in self.models:
+            publish_state(type(mod).__name__, getattr(mod, self.model_attribute))
+
+    def add_transition(self, trigger, *args, **kwargs):
+        super().add_transition(trigger, *args, **kwargs)
+        # Dropped from the inbox of the actor when queued before an urgent message
+        inbox = getattr(self.model, "actor_inbox", None)
+        if inbox is not None:
+            inbox.triggers.add(trigger)
+
     def __update_state_time(self):
-        self.__state_time = datetime.now()
+        self.__state_time = self.__clock.now()
 
     def get_time_in_state(self):
-        return datetime.now() - self.__state_time
+        return self.__clock.now() - self.__state_time
+
+
+class ActorIndex:
+    # Name to proxy index of the running actors. This avoids a locked scan of the pykka registry
+    # on each lookup. Readers do not take the lock, a dict lookup is atomic.
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__proxies = {}
+
+    def add(self, ref):
+        proxy = ref.proxy()
+        with self.__lock:
+            self.__proxies[ref.actor_class.__name__] = proxy
+        # The actor might have been stopped before being added
+        if not ref.is_alive():
+            self.remove(ref)
+
+    def remove(self, ref):
+        name = ref.actor_class.__name__
+        with self.__lock:
+            proxy = self.__proxies.get(name)
+            if proxy is not None and proxy.actor_ref.actor_urn == ref.actor_urn:
+                del self.__proxies[name]
+
+    def get(self, name):
+        return self.__proxies.get(name)
+
+
+actor_index = ActorIndex()
+
+
+def is_quiescent():
+    # True if none of the running actors has a message waiting or being processed. This is what the
+    # virtual clock waits for before jumping to the next deadline.
+    for ref in pykka.ActorRegistry.get_all():
+        if issubclass(ref.actor_class, PoupoolActor) and ref.actor_inbox.unfinished_tasks:
+            return False
+    return True
 
 
 class PoupoolActor(pykka.ThreadingActor):
+    # Missed tick policies of do_periodic()
+    SKIP = "skip"
+    CATCH_UP = "catch_up"
+    # Messages handled ahead of the others in the inbox. A safety stop must not wait behind the
+    # routine polling and settings.
+    URGENT = frozenset({"halt"})
+
+    # Set on the actors doing blocking device I/O. The event loop backend runs them in a thread pool.
+    BLOCKING_IO = False
+
     def __init__(self):
         super().__init__()
         self._proxy = self.actor_ref.proxy()
+        self._clock = get_clock()
         self.__timer = None
+        self.__generation = 0
+        self.__tick = None
+        self.__actors = {}
+
+    @classmethod
+    def start(cls, *args, **kwargs):
+        ref = super().start(*args, **kwargs)
+        actor_index.add(ref)
+        return ref
+
+    def __forget(self):
+        # Neither the index nor the state mirror must answer for a dead actor
+        actor_index.remove(self.actor_ref)
+        _states.pop(type(self).__name__, None)
+
+    def _stop(self):
+        self.__forget()
+        super()._stop()
+
+    def _handle_failure(self, exception_type, exception_value, traceback):
+        # Called instead of _stop() when a handler raises
+        self.__forget()
+        super()._handle_failure(exception_type, exception_value, traceback)
+
+    def _create_actor_inbox(self):
+        return get_backend().create_inbox(self)
+
+    @staticmethod
+    def _create_future():
+        return get_backend().create_future()
+
+    def _start_actor_loop(self):
+        get_backend().start(self)
+
+    def _handle_receive(self, message):
+        metrics = self.actor_inbox.metrics
+        handler = metrics.started(message_name(message))
+        try:
+            return super()._handle_receive(message)
+        finally:
+            metrics.finished(handler)
+            self.actor_inbox.task_done()
+            self._clock.notify_idle()
 
     def on_failure(self, exception_type, exception_value, traceback):
         # The actor is going to die
@@ -77,15 +215,21 @@ class PoupoolActor(pykka.ThreadingActor):
         self.do_cancel()
 
     def get_actor(self, name):
-        fsm = pykka.ActorRegistry.get_by_class_name(name)
-        if fsm:
-            return fsm[0].proxy()
-        logger.critical(f"Actor {name} not found!!!")
-        return None
+        proxy = self.__actors.get(name)
+        if proxy is None or not proxy.actor_ref.is_alive():
+            proxy = actor_index.get(name)
+            if proxy is None:
+                logger.critical(f"Actor {name} not found!!!")
+                return None
+            self.__actors[name] = proxy
+        return proxy
 
     def __do_cancel(self):
+        # A timer which already fired might still have its message waiting in the inbox. Bumping
+        # the generation makes do_timer() drop it.
+        self.__generation += 1
         if self.__timer:
-            self.__timer.cancel()
+            scheduler.cancel(self.__timer)
             self.__timer = None
 
     def do_cancel(self):
@@ -96,9 +240,50 @@ class PoupoolActor(pykka.ThreadingActor):
         assert delay >= 0
         # Stop an already running timer
         self.__do_cancel()
-        func = getattr(self._proxy, method)
         if delay > 0:
-            self.__timer = Timer(delay, func.defer, *args, **kwargs)
-            self.__timer.start()
+            # All the actors share a single timer thread instead of spawning one per delay
+            timer = self._proxy.do_timer.defer
+            self.__timer = scheduler.schedule(delay, timer, self.__generation, method, args, kwargs)
         else:
-            func.defer(*args, **kwargs)
+            getattr(self._proxy, method).defer(*args, **kwargs)
+
+    def do_later(self, method, *args, **kwargs):
+        # Like do_delay(0, ...) but without stopping the running timer. The call is dropped by a
+        # cancel before it runs.
+        assert isinstance(method, str)
+        self._proxy.do_timer.defer(self.__generation, method, args, kwargs)
+
+    def do_timer(self, generation, method, args, kwargs):
+        if generation == self.__generation:
+            self.__timer = None
+            getattr(self, method)(*args, **kwargs)
+
+    def do_periodic(self, period, method, policy=SKIP):
+        # Fixed rate timer. Called from a tick of the same method, the next deadline follows the
+        # previous one so that the time spent in the handler does not add to the period. Not calling
+        # it from the handler stops the loop and do_cancel() stops it too like do_delay().
+        assert isinstance(method, str)
+        assert period > 0
+        now = self._clock.monotonic()
+        tick = self.__tick
+        if tick is not None and tick[0] == method:
+            deadline = tick[1] + period
+            if deadline < now and policy == self.SKIP:
+                missed = math.ceil((now - deadline) / period)
+                self.actor_inbox.metrics.skipped(method, missed)
+                deadline += missed * period
+        else:
+            deadline = now + period
+        self.__do_cancel()
+        timer = self._proxy.do_tick.defer
+        self.__timer = scheduler.schedule(max(0, deadline - now), timer, self.__generation, method, deadline)
+
+    def do_tick(self, generation, method, deadline):
+        if generation == self.__generation:
+            self.__timer = None
+            self.actor_inbox.metrics.ticked(method, self._clock.monotonic() - deadline)
+            self.__tick = (method, deadline)
+            try:
+                getattr(self, method)()
+            finally:
+                self.__tick = None
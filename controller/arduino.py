@@ -18,13 +18,13 @@
 import logging
 from typing import Final
 
-# from transitions.extensions import GraphMachine as Machine
 from .actor import PoupoolActor, PoupoolModel, do_repeat
 
 logger = logging.getLogger(__name__)
 
 
 class Arduino(PoupoolActor):
+    BLOCKING_IO = True
     STATE_REFRESH_DELAY = 60
 
     states: Final = ["halt", "run"]
@@ -78,4 +78,4 @@ class Arduino(PoupoolActor):
             self.__water_counter_last = value
         else:
             logger.error("Unable to read water counter. Not updating the value")
-        self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_run.__name__)
+        self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_run.__name__)
@@ -0,0 +1,334 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import itertools
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pykka
+from pykka._threading import ThreadingFuture
+
+from .metrics import ActorMetrics, message_name
+from .watchdog import watchdog
+
+logger = logging.getLogger(__name__)
+
+
+class Coalesced:
+    # Message replacing the pending message with the same key, see Inbox
+    __slots__ = ("key", "message")
+
+    def __init__(self, key, message):
+        self.key = key
+        self.message = message
+
+
+class Inbox(queue.Queue):
+    # Messages listed in urgent, like halt, are dequeued ahead of the routine work. Taking one drops
+    # the triggers of the state machine queued before it, an eco sent before a halt must not undo
+    # it. A Coalesced message replaces the pending one with the same key, the newest goes to the
+    # tail. Keep track of when and what was queued to know how long messages wait in the inbox. The
+    # queue methods are called with the queue mutex held.
+
+    def __init__(self, urgent=frozenset()):
+        self.__names = urgent
+        # Filled by PoupoolModel
+        self.triggers = set()
+        self.metrics = ActorMetrics()
+        super().__init__()
+
+    def _init(self, maxsize):
+        self.queue = deque()
+        self.__urgent = deque()
+        self.__keys = {}
+        self.__size = 0
+        self.__sequence = itertools.count()
+
+    def _qsize(self):
+        return self.__size
+
+    def _put(self, envelope):
+        message = envelope.message
+        key = None
+        if isinstance(message, Coalesced):
+            key = message.key
+            envelope.message = message = message.message
+        name = message_name(message)
+        item = [envelope, time.monotonic(), name, key, next(self.__sequence)]
+        if key is not None:
+            previous = self.__keys.get(key)
+            if previous is not None:
+                # Dropped when reaching the head. put() counts it as a new task, undo that.
+                previous[0] = None
+                self.__size -= 1
+                self.unfinished_tasks -= 1
+                self.metrics.coalesced(previous[2])
+            self.__keys[key] = item
+        if name in self.__names:
+            self.__urgent.append(item)
+        else:
+            self.queue.append(item)
+        self.__size += 1
+        self.metrics.enqueued(name, self.__size)
+
+    def _get(self):
+        while True:
+            urgent = bool(self.__urgent)
+            envelope, enqueued, name, key, sequence = self.__urgent.popleft() if urgent else self.queue.popleft()
+            if envelope is not None:
+                break
+        if key is not None:
+            del self.__keys[key]
+        self.__size -= 1
+        wait = time.monotonic() - enqueued
+        if urgent:
+            self.metrics.preempted(wait, len(self.queue))
+            if self.triggers:
+                self.__cancel(sequence)
+        self.metrics.dequeued(name, wait)
+        return envelope
+
+    def __cancel(self, sequence):
+        # Drop the triggers queued before the urgent message, like the coalesced messages. A caller
+        # waiting on one gets False as for a trigger which could not run.
+        for item in self.queue:
+            envelope, _, name, key, queued = item
+            if queued > sequence:
+                break
+            if envelope is None or name not in self.triggers:
+                continue
+            item[0] = None
+            self.__size -= 1
+            self.unfinished_tasks -= 1
+            if key is not None:
+                del self.__keys[key]
+            self.metrics.cancelled(name)
+            if envelope.reply_to is not None:
+                envelope.reply_to.set(False)
+
+
+class WatchedFuture(ThreadingFuture):
+    def get(self, *, timeout=None):
+        if self._result is not None:
+            return super().get(timeout=timeout)
+        # Let the watchdog know we are blocked waiting on another actor
+        token = watchdog.wait_started()
+        try:
+            return super().get(timeout=timeout)
+        finally:
+            watchdog.wait_finished(token)
+
+
+class ThreadingBackend:
+    name = "threading"
+
+    def create_inbox(self, actor):
+        return Inbox(actor.URGENT)
+
+    def create_future(self):
+        return WatchedFuture()
+
+    def start(self, actor):
+        pykka.ThreadingActor._start_actor_loop(actor)  # noqa: SLF001
+
+    def handoff(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class Loop:
+    """Single thread running the submitted callbacks one after the other, like an event loop.
+
+    A callback about to block, e.g. an actor waiting on a future, hands the loop over to a new
+    thread first, see handoff(). The blocked thread ends once its callback returns.
+    """
+
+    def __init__(self):
+        self.__callbacks = queue.SimpleQueue()
+        self.__owner = None
+        self.__running = True
+        self.__start()
+
+    def __start(self):
+        self.__owner = threading.Thread(target=self.__run, name="EventLoop", daemon=True)
+        self.__owner.start()
+
+    def __run(self):
+        thread = threading.current_thread()
+        while self.__owner is thread:
+            callback = self.__callbacks.get()
+            if not self.__running:
+                break
+            callback()
+        # Wake up the thread which took over, it might be waiting for a callback too
+        if not self.__running:
+            self.__callbacks.put(None)
+
+    def in_loop(self):
+        return threading.current_thread() is self.__owner
+
+    def call_soon(self, callback):
+        self.__callbacks.put(callback)
+
+    def handoff(self):
+        if self.in_loop():
+            self.__start()
+
+    def stop(self):
+        self.__running = False
+        self.__callbacks.put(None)
+
+
+class LoopFuture(WatchedFuture):
+    def get(self, *, timeout=None):
+        # Never block the loop, the other actors keep running on a new loop thread while we wait
+        if self._result is None:
+            get_backend().handoff()
+        return super().get(timeout=timeout)
+
+
+class SerialInbox(Inbox):
+    # Maximum number of messages processed before giving the hand to another actor
+    BATCH = 10
+
+    def __init__(self, actor, submit):
+        super().__init__(actor.URGENT)
+        self.__actor = actor
+        self.__submit = submit
+        self.__state = threading.Lock()
+        # Set while a drain is submitted or running, an actor never runs two handlers at once
+        self.__scheduled = False
+        self.__started = False
+
+    def put(self, envelope, block=True, timeout=None):
+        super().put(envelope, block, timeout)
+        self.schedule()
+
+    def schedule(self):
+        with self.__state:
+            if self.__scheduled:
+                return
+            self.__scheduled = True
+        self.__submit(self.drain)
+
+    def drain(self):
+        if not self.__started:
+            self.__started = True
+            self.__actor._actor_loop_setup()  # noqa: SLF001
+        for _ in range(self.BATCH):
+            if not self.__process_one():
+                break
+        with self.__state:
+            self.__scheduled = False
+        if not self.empty():
+            self.schedule()
+
+    def __process_one(self):
+        actor = self.__actor
+        if actor.actor_stopped.is_set():
+            actor._actor_loop_teardown()  # noqa: SLF001
+            return False
+        try:
+            envelope = self.get_nowait()
+        except queue.Empty:
+            return False
+        # Same handling as pykka.Actor._actor_loop_running() but for a single envelope
+        try:
+            response = actor._handle_receive(envelope.message)  # noqa: SLF001
+            if envelope.reply_to is not None:
+                envelope.reply_to.set(response)
+        except Exception:
+            if envelope.reply_to is not None:
+                logger.info(f"Exception returned from {actor} to caller:", exc_info=sys.exc_info())
+                envelope.reply_to.set_exception()
+            else:
+                actor._handle_failure(*sys.exc_info())  # noqa: SLF001
+                try:
+                    actor.on_failure(*sys.exc_info())
+                except Exception:
+                    actor._handle_failure(*sys.exc_info())  # noqa: SLF001
+        except BaseException:
+            logger.debug(f"{sys.exc_info()[1]!r} in {actor}. Stopping all actors.")
+            actor._stop()  # noqa: SLF001
+            pykka.ActorRegistry.stop_all(block=False)
+        if actor.actor_stopped.is_set():
+            actor._actor_loop_teardown()  # noqa: SLF001
+            return False
+        return True
+
+
+class EventLoopBackend:
+    """Run all the actors on a shared event loop thread, without asyncio.
+
+    Actors flagged with BLOCKING_IO do their device I/O synchronously. Their messages are processed
+    by a small thread pool instead so that they do not stall the loop. An actor waiting on another
+    one hands the loop over to a new thread, see Loop.
+    """
+
+    name = "event_loop"
+
+    def __init__(self, workers=4):
+        self.__loop = Loop()
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="BlockingActor")
+
+    def in_loop(self):
+        return self.__loop.in_loop()
+
+    def handoff(self):
+        self.__loop.handoff()
+
+    def __submit_executor(self, func):
+        self.__executor.submit(func)
+
+    def create_inbox(self, actor):
+        if getattr(actor, "BLOCKING_IO", False):
+            return SerialInbox(actor, self.__submit_executor)
+        return SerialInbox(actor, self.__loop.call_soon)
+
+    def create_future(self):
+        return LoopFuture()
+
+    def start(self, actor):
+        # The first run calls on_start() before processing the messages
+        actor.actor_inbox.schedule()
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False)
+        self.__loop.stop()
+
+
+_backend = ThreadingBackend()
+
+
+def get_backend():
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+def create_backend(name):
+    return EventLoopBackend() if name == EventLoopBackend.name else ThreadingBackend()
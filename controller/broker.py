@@ -0,0 +1,290 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import contextlib
+import logging
+import socket
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def matches(topic_filter, topic):
+    # MQTT 3.1.1 topic filter with the + and # wildcards
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def packet(kind, flags, body):
+    return bytes((kind << 4 | flags,)) + encode_length(len(body)) + body
+
+
+def encode_string(value):
+    return struct.pack("!H", len(value)) + value
+
+
+def decode_string(data, position):
+    (length,) = struct.unpack_from("!H", data, position)
+    position += 2
+    return data[position : position + length], position + length
+
+
+class Session:
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.subscriptions = {}
+        self.connection = None
+
+
+class Connection:
+    def __init__(self, broker, sock):
+        self.__broker = broker
+        self.__sock = sock
+        self.__lock = threading.Lock()
+        self.session = None
+
+    def send(self, data):
+        # A dead connection is cleaned up by its reading thread
+        with self.__lock, contextlib.suppress(OSError):
+            self.__sock.sendall(data)
+
+    def close(self):
+        with contextlib.suppress(OSError):
+            self.__sock.shutdown(socket.SHUT_RDWR)
+        self.__sock.close()
+
+    def __recv(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.__sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Connection closed")
+            data += chunk
+        return data
+
+    def read(self):
+        header = self.__recv(1)[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = self.__recv(1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0F, self.__recv(length) if length else b""
+
+    def run(self):
+        try:
+            while True:
+                kind, flags, body = self.read()
+                if not self.__broker.handle(self, kind, flags, body):
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.__broker.disconnected(self)
+            self.close()
+
+
+class Broker:
+    """Minimal MQTT 3.1.1 broker running in the process, for the tests and the benchmarks.
+
+    Messages are delivered with QoS 0, QoS 1 and 2 publications are acknowledged. Retained messages
+    and persistent sessions are kept in memory. There is no authentication.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.__server = socket.create_server((host, port))
+        self.host, self.port = self.__server.getsockname()[:2]
+        self.__lock = threading.Lock()
+        self.__sessions = {}
+        self.__connections = set()
+        self.__retained = {}
+        self.__thread = None
+        # Counters
+        self.received = 0
+        self.delivered = 0
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__accept, name="Broker", daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        # Closing alone does not wake up accept()
+        with contextlib.suppress(OSError):
+            self.__server.shutdown(socket.SHUT_RDWR)
+        self.__server.close()
+        with self.__lock:
+            connections = list(self.__connections)
+        for connection in connections:
+            connection.close()
+        if self.__thread:
+            self.__thread.join()
+
+    def __accept(self):
+        while True:
+            try:
+                sock, _ = self.__server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = Connection(self, sock)
+            with self.__lock:
+                self.__connections.add(connection)
+            threading.Thread(target=connection.run, name="BrokerConnection", daemon=True).start()
+
+    def disconnected(self, connection):
+        with self.__lock:
+            self.__connections.discard(connection)
+            session = connection.session
+            if session is not None and session.connection is connection:
+                session.connection = None
+
+    def handle(self, connection, kind, flags, body):
+        if kind == CONNECT:
+            self.__connect(connection, body)
+        elif connection.session is None:
+            # The first packet must be CONNECT
+            return False
+        elif kind == PUBLISH:
+            self.__publish(connection, flags, body)
+        elif kind == PUBREL:
+            connection.send(packet(PUBCOMP, 0, body[:2]))
+        elif kind == SUBSCRIBE:
+            self.__subscribe(connection, body)
+        elif kind == UNSUBSCRIBE:
+            self.__unsubscribe(connection, body)
+        elif kind == PINGREQ:
+            connection.send(packet(PINGRESP, 0, b""))
+        elif kind == DISCONNECT:
+            return False
+        return True
+
+    def __connect(self, connection, body):
+        _, position = decode_string(body, 0)
+        connect_flags = body[position + 1]
+        client_id, _ = decode_string(body, position + 4)
+        clean = bool(connect_flags & 0x02)
+        with self.__lock:
+            session = self.__sessions.get(client_id)
+            present = session is not None and not clean
+            if not present:
+                session = Session(client_id)
+                if clean:
+                    self.__sessions.pop(client_id, None)
+                else:
+                    self.__sessions[client_id] = session
+            previous = session.connection
+            session.connection = connection
+            connection.session = session
+        if previous is not None:
+            # Same client id connecting again, the old connection is closed
+            previous.close()
+        connection.send(packet(CONNACK, 0, bytes((int(present), 0))))
+
+    def __publish(self, connection, flags, body):
+        qos = (flags >> 1) & 0x03
+        topic, position = decode_string(body, 0)
+        if qos:
+            packet_id = body[position : position + 2]
+            position += 2
+        payload = body[position:]
+        if qos == 1:
+            connection.send(packet(PUBACK, 0, packet_id))
+        elif qos == 2:
+            connection.send(packet(PUBREC, 0, packet_id))
+        topic = topic.decode()
+        if flags & 0x01:
+            with self.__lock:
+                if payload:
+                    self.__retained[topic] = payload
+                else:
+                    self.__retained.pop(topic, None)
+        self.__deliver(topic, payload)
+
+    def __deliver(self, topic, payload):
+        data = packet(PUBLISH, 0, encode_string(topic.encode()) + payload)
+        with self.__lock:
+            connections = [
+                c for c in self.__connections if c.session and any(matches(f, topic) for f in c.session.subscriptions)
+            ]
+            self.received += 1
+            self.delivered += len(connections)
+        for connection in connections:
+            connection.send(data)
+
+    def __subscribe(self, connection, body):
+        packet_id = body[:2]
+        position = 2
+        topic_filters = []
+        while position < len(body):
+            topic_filter, position = decode_string(body, position)
+            position += 1
+            topic_filters.append(topic_filter.decode())
+        with self.__lock:
+            for topic_filter in topic_filters:
+                connection.session.subscriptions[topic_filter] = 0
+            retained = [
+                (topic, payload)
+                for topic, payload in self.__retained.items()
+                if any(matches(f, topic) for f in topic_filters)
+            ]
+            self.delivered += len(retained)
+        # Everything is delivered with QoS 0
+        connection.send(packet(SUBACK, 0, packet_id + bytes(len(topic_filters))))
+        for topic, payload in retained:
+            connection.send(packet(PUBLISH, 0x01, encode_string(topic.encode()) + payload))
+
+    def __unsubscribe(self, connection, body):
+        packet_id = body[:2]
+        position = 2
+        with self.__lock:
+            while position < len(body):
+                topic_filter, position = decode_string(body, position)
+                connection.session.subscriptions.pop(topic_filter.decode(), None)
+        connection.send(packet(UNSUBACK, 0, packet_id))
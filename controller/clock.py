@@ -0,0 +1,103 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+class RealClock:
+    def now(self):
+        return datetime.now()
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, condition, timeout):
+        condition.wait(timeout)
+
+    def notify_idle(self):
+        pass
+
+
+class VirtualClock:
+    """Clock jumping straight to the next deadline once the actors are idle.
+
+    The idle callable tells whether all the pending work has been processed. Without it, the clock
+    jumps as soon as the scheduler is waiting.
+    """
+
+    def __init__(self, start=None, idle=None):
+        self.__lock = threading.Lock()
+        self.__start = start or datetime.now()
+        self.__elapsed = 0.0
+        self.__idle = idle or (lambda: True)
+        self.__condition = None
+
+    def now(self):
+        return self.__start + timedelta(seconds=self.__elapsed)
+
+    def time(self):
+        return self.__start.timestamp() + self.__elapsed
+
+    def monotonic(self):
+        return self.__elapsed
+
+    def advance(self, seconds):
+        assert seconds >= 0
+        with self.__lock:
+            self.__elapsed += seconds
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, condition, timeout):
+        if timeout is None:
+            condition.wait()
+            return
+        # Register first so that an actor going idle in the meantime wakes us up
+        self.__condition = condition
+        if self.__idle():
+            self.advance(timeout)
+        else:
+            # Wait until an actor reports being idle before jumping in time
+            condition.wait(0.1)
+        self.__condition = None
+
+    def notify_idle(self):
+        condition = self.__condition
+        if condition is not None:
+            with condition:
+                condition.notify()
+
+
+_clock = RealClock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+    global _clock
+    _clock = clock
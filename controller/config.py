@@ -27,6 +27,11 @@ class Config:
         section, key = pair
         return self.__config.get(section, key)
 
+    def items(self, section):
+        if not self.__config.has_section(section):
+            return {}
+        return dict(self.__config.items(section))
+
 
 def as_list(value, type_cast=int):
     return [type_cast(m) for m in value.split(",")]
@@ -16,8 +16,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import logging
-import time
-from datetime import datetime, timedelta
+from datetime import timedelta
 from typing import Final
 
 from .actor import PoupoolActor, PoupoolModel
@@ -40,7 +39,7 @@ class PWM(PoupoolActor):
         self.__state = False
         self.__security_duration = Timer(f"PWM for {name}")
         self.__security_duration.delay = timedelta(hours=PWM.SECURITY_DURATION)
-        self.__security_reset = datetime.now() + timedelta(days=1)
+        self.__security_reset = self._clock.now() + timedelta(days=1)
         self.__min_runtime = min_runtime
         self.value = 0.0
 
@@ -52,7 +51,7 @@ class PWM(PoupoolActor):
         self.__pump.off()
 
     def do_run(self):
-        now = time.time()
+        now = self._clock.time()
         if self.__last is not None:
             diff = now - self.__last
             self.__duration += diff
@@ -71,23 +70,23 @@ class PWM(PoupoolActor):
                     "state: {self.__state} duration: {self.__duration:.1f}"
                 )
             if self.__state:
-                self.__security_duration.update(datetime.now())
+                self.__security_duration.update(self._clock.now())
                 if self.__duration >= duty_on and duty_on != self.period:
                     self.__duration = 0
                     self.__state = False
                     self.__pump.off()
             else:
-                self.__security_duration.update(datetime.now(), 0)
+                self.__security_duration.update(self._clock.now(), 0)
                 security_ok = not self.__security_duration.elapsed()
                 if self.__duration >= duty_off and duty_off != self.period and security_ok:
                     self.__duration = 0
                     self.__state = True
                     self.__pump.on()
-        if datetime.now() > self.__security_reset:
+        if self._clock.now() > self.__security_reset:
             self.__security_duration.reset()
             self.__security_reset += timedelta(days=1)
         self.__last = now
-        self.do_delay(1, self.do_run.__name__)
+        self.do_periodic(1, self.do_run.__name__)
 
 
 class PController:
@@ -15,315 +15,504 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import itertools
 import logging
+import math
+import threading
+import time
 
-logger = logging.getLogger(__name__)
+from .clock import get_clock
+from .config import config
+from .ingress import Ingress
+from .metrics import DispatchMetrics
+from .scheduler import scheduler
 
+logger = logging.getLogger(__name__)
 
-def between(minimum, maximum):
-    return lambda x: minimum <= float(x) <= maximum
+MODES = ("halt", "eco", "standby", "overflow", "comfort", "sweep", "wash", "wintering")
+SWITCH = {"0": False, "off": False, "1": True, "on": True}
 
+# The first change of a mode or a switch is applied right away and the last of the changes received
+# during the window at its end. A number is applied once it did not change for the window.
+LEADING = "leading"
+TRAILING = "trailing"
+EDGES = {"enum": LEADING, "bool": LEADING, "int": TRAILING, "float": TRAILING}
+WINDOWS = {LEADING: float(config["debounce", "leading"]), TRAILING: float(config["debounce", "trailing"])}
+# Modes applied right away whatever the window, a pending change is dropped. Like the urgent
+# messages of the actors, a halt must not wait.
+URGENT = frozenset({"halt"})
 
-def greater_equal(value):
-    return lambda x: float(x) >= value
+# Bulk settings, see Dispatcher.export() and import_settings()
+VERSION = 1
+EXPORT_TOPIC = "/settings/export"
+IMPORT_TOPIC = "/settings/import"
+IMPORT_STATUS_TOPIC = "/status/settings/import"
 
 
 def to_bool(x):
     return x.lower() in ("true", "1", "y", "yes", "on")
 
 
-def to_int(x):
-    return int(float(x))
+class Route:
+    """Declaration of a topic we act upon.
+
+    The value of an "enum" route is the method to call, without argument. Otherwise the value is
+    converted to kind ("int", "float", "bool" or "string"), checked against limits (minimum,
+    maximum), None for no bound, and passed to the method. A {name} in the topic is expanded for
+    every value listed in params and substituted in the method too. A route processed only once is
+    removed afterwards e.g. for the configuration restore at startup. The exported routes are part
+    of the bulk settings.
+
+    The changes are debounced, see EDGES and WINDOWS for the defaults. A window of 0 disables it.
+    """
+
+    __slots__ = ("actor", "edge", "export", "kind", "limits", "method", "once", "params", "topic", "window")
+
+    def __init__(
+        self, topic, actor, method, kind, limits=None, once=False, params=None, edge=None, window=None, export=True
+    ):
+        self.topic = topic
+        self.actor = actor
+        self.method = method
+        self.kind = kind
+        self.limits = limits
+        self.once = once
+        self.params = params or {}
+        self.export = export
+        self.edge = edge or EDGES.get(kind)
+        if once or self.edge is None:
+            window = 0
+        self.window = WINDOWS[self.edge] if window is None else window
+
+    def expand(self):
+        names = list(self.params)
+        for values in itertools.product(*self.params.values()):
+            fields = dict(zip(names, values, strict=True))
+            yield self.topic.format(**fields), self.method and self.method.format(**fields)
+
+
+ROUTES = (
+    Route("/settings/mode", "filtration", None, "enum", MODES),
+    Route("/settings/filtration/duration", "filtration", "duration", "int", (1, 172800)),
+    Route("/settings/filtration/period", "filtration", "period", "int", (1, 10)),
+    Route("/settings/filtration/reset_hour", "filtration", "reset_hour", "int", (0, 23)),
+    Route("/settings/filtration/tank_percentage", "filtration", "tank_percentage", "float", (0, 0.5)),
+    Route("/settings/filtration/stir_duration", "filtration", "stir_duration", "int", (0, 10 * 60)),
+    Route("/settings/filtration/stir_period", "filtration", "stir_period", "int", (0, 7200)),
+    Route("/settings/filtration/boost_duration", "filtration", "boost_duration", "int", (0, 10 * 60)),
+    Route("/settings/filtration/backwash/period", "filtration", "backwash_period", "int", (0, 90)),
+    Route(
+        "/settings/filtration/backwash/{step}_duration",
+        "filtration",
+        "backwash_{step}_duration",
+        "int",
+        (0, 300),
+        params={"step": ("backwash", "rinse")},
+    ),
+    Route("/status/filtration/backwash/last", "filtration", "backwash_last", "string"),
+    Route("/status/filtration/duration", "filtration", "restore_duration", "int", (0, 86400), once=True, export=False),
+    Route("/settings/filtration/speed/eco", "filtration", "speed_eco", "int", (1, 3)),
+    Route("/settings/filtration/speed/standby", "filtration", "speed_standby", "int", (0, 2)),
+    Route("/settings/filtration/speed/overflow", "filtration", "speed_overflow", "int", (1, 4)),
+    Route("/settings/filtration/overflow_in_comfort", "filtration", "overflow_in_comfort", "bool"),
+    Route("/settings/cover/position/eco", "filtration", "cover_position_eco", "int", (0, 100)),
+    Route("/settings/tank/force_empty", "tank", "force_empty", "bool"),
+    Route("/settings/swim/mode", "swim", None, "enum", ("halt", "timed", "continuous")),
+    Route("/settings/swim/timer", "swim", "timer", "int", (1, 60)),
+    Route("/settings/swim/speed", "swim", "speed", "int", (1, 100)),
+    Route("/settings/light/mode", "light", None, "enum", ("halt", "on")),
+    Route("/settings/heater/setpoint", "heater", "setpoint", "float", (0, 30)),
+    Route("/settings/heating/enable", "heating", "enable", "bool"),
+    Route("/settings/heating/setpoint", "heating", "setpoint", "float", (10, 32)),
+    Route("/settings/heating/start_hour", "heating", "start_hour", "int", (0, 23)),
+    Route("/settings/heating/min_temp", "heating", "min_temp", "int", (5, 25)),
+    Route("/status/heating/total_seconds", "heating", "total_seconds", "int", once=True),
+    Route(
+        "/settings/disinfection/{probe}/enable",
+        "disinfection",
+        "{probe}_enable",
+        "bool",
+        params={"probe": ("ph", "orp")},
+    ),
+    Route("/settings/disinfection/ph/setpoint", "disinfection", "ph_setpoint", "float", (6, 8)),
+    Route("/settings/disinfection/orp/setpoint", "disinfection", "orp_setpoint", "int", (500, 800)),
+    Route(
+        "/settings/disinfection/{probe}/pterm",
+        "disinfection",
+        "{probe}_pterm",
+        "float",
+        (0, 10),
+        params={"probe": ("ph", "orp")},
+    ),
+    Route("/status/water/counter", "arduino", "restore_water_counter", "int", (0, None), once=True),
+)
+
+
+class OutOfRange(ValueError):
+    pass
+
+
+def _check(value, limits):
+    # Written so that NaN is out of any range, infinity is rejected too
+    minimum, maximum = limits
+    if (
+        not math.isfinite(value)
+        or (minimum is not None and not minimum <= value)
+        or (maximum is not None and not value <= maximum)
+    ):
+        raise OutOfRange(f"{value} not in [{minimum}, {maximum}]")
+    return value
+
+
+def _converter(kind, limits):
+    # Parse and validate the payload in one go, raise ValueError or KeyError if invalid
+    if kind == "enum":
+        choices = frozenset(limits)
+
+        def choice(x):
+            if x not in choices:
+                raise KeyError(x)
+            return x
+
+        return choice
+    if kind == "bool":
+        return lambda x: SWITCH[x.lower()]
+    if kind == "string":
+        return str
+    limits = limits or (None, None)
+    if kind == "int":
+        # Some clients send the integers as floats
+        return lambda x: int(_check(float(x), limits))
+    return lambda x: _check(float(x), limits)
+
+
+class Target:
+    # Compiled route of a topic. An enum route calls the method named by the value, found in
+    # methods. The remaining attributes hold the debounce state.
+    __slots__ = (
+        "actor",
+        "convert",
+        "deadline",
+        "defer",
+        "edge",
+        "export",
+        "last",
+        "methods",
+        "once",
+        "pending",
+        "timer",
+        "window",
+    )
+
+    def __init__(self, actor, convert, defer, methods, route):
+        self.actor = actor
+        self.convert = convert
+        self.defer = defer
+        self.methods = methods
+        self.once = route.once
+        self.export = route.export
+        self.edge = route.edge
+        self.window = route.window
+        self.timer = None
+        self.deadline = 0
+        self.pending = _NOTHING
+        self.last = _NOTHING
+
+    def apply(self, value):
+        self.last = value
+        if self.methods is not None:
+            self.methods[value]()
+        elif self.defer is not None:
+            self.defer(value)
 
 
-def to_float(x):
-    return float(x)
+_NOTHING = object()
 
 
-def to_string(x):
-    return str(x)
+def compile_routes(routes, actors):
+    # Map each topic to its Target, the methods are looked up only once. Without actor, the values
+    # are only validated.
+    table = {}
+    for route in routes:
+        actor = actors.get(route.actor)
+        convert = _converter(route.kind, route.limits)
+        for topic, method in route.expand():
+            if route.kind == "enum":
+                methods = {value: getattr(actor, value).defer for value in route.limits} if actor else None
+                table[topic] = Target(route.actor, convert, None, methods, route)
+            else:
+                defer = getattr(actor, method).defer if actor else None
+                table[topic] = Target(route.actor, convert, defer, None, route)
+    return table
+
+
+def _payload(value):
+    # Values of a settings document, JSON numbers and booleans are accepted too
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return str(value)
 
 
 class Dispatcher:
-    def __init__(self):
+    def __init__(self, routes=ROUTES):
+        self.__routes = routes
+        self.__targets = {}
+        # The targets still active, the once ones are removed after use
         self.__mapping = {}
+        # Last payload of each topic and the imported values we will receive back from the broker
+        self.__values = {}
+        self.__echoes = {}
+        # The messages are dispatched by the ingress worker and the debounce timers fire on the
+        # scheduler thread
+        self.__lock = threading.Lock()
+        # Latest value of each topic received during the restore phase
+        self.__restoring = None
+        self.__restore_start = None
+        # Topics without any value yet, the restore ends as soon as all of them are received
+        self.__expected = set()
+        self.__restored = threading.Event()
+        self.restore_duration = None
+        # False when the restore ended on a timeout, some retained settings may be missing
+        self.restore_complete = False
+        self.metrics = DispatchMetrics()
+        self.ingress = Ingress(int(config["ingress", "size"]), config["ingress", "policy"])
 
-    def register(self, filtration, tank, swim, light, heater, heating, disinfection, arduino):
-        self.__mapping = {
-            "/settings/mode": (
-                filtration,
-                lambda x: x in ("halt", "eco", "standby", "overflow", "comfort", "sweep", "wash", "wintering"),
-                lambda x: x,
-                None,
-                False,
-            ),
-            "/settings/filtration/duration": (
-                filtration,
-                between(1, 172800),
-                lambda _: "duration",
-                to_int,
-                False,
-            ),
-            "/settings/filtration/period": (
-                filtration,
-                between(1, 10),
-                lambda _: "period",
-                to_int,
-                False,
-            ),
-            "/settings/filtration/reset_hour": (
-                filtration,
-                between(0, 23),
-                lambda _: "reset_hour",
-                to_int,
-                False,
-            ),
-            "/settings/filtration/tank_percentage": (
-                filtration,
-                between(0, 0.5),
-                lambda _: "tank_percentage",
-                to_float,
-                False,
-            ),
-            "/settings/filtration/stir_duration": (
-                filtration,
-                between(0, 10 * 60),
-                lambda _: "stir_duration",
-                to_int,
-                False,
-            ),
-            "/settings/filtration/stir_period": (
-                filtration,
-                between(0, 7200),
-                lambda _: "stir_period",
-                to_int,
-                False,
-            ),
-            "/settings/filtration/boost_duration": (
-                filtration,
-                between(0, 10 * 60),
-                lambda _: "boost_duration",
-                to_int,
-                False,
-            ),
-            "/settings/filtration/backwash/period": (
-                filtration,
-                between(0, 90),
-                lambda _: "backwash_period",
-                to_int,
-                False,
-            ),
-            "/settings/filtration/backwash/backwash_duration": (
-                filtration,
-                between(0, 300),
-                lambda _: "backwash_backwash_duration",
-                to_int,
-                False,
-            ),
-            "/settings/filtration/backwash/rinse_duration": (
-                filtration,
-                between(0, 300),
-                lambda _: "backwash_rinse_duration",
-                to_int,
-                False,
-            ),
-            "/status/filtration/backwash/last": (
-                filtration,
-                lambda _: True,
-                lambda _: "backwash_last",
-                to_string,
-                False,
-            ),
-            "/status/filtration/duration": (
-                filtration,
-                between(0, 86400),
-                lambda _: "restore_duration",
-                to_int,
-                True,
-            ),
-            "/settings/filtration/speed/eco": (
-                filtration,
-                between(1, 3),
-                lambda _: "speed_eco",
-                to_int,
-                False,
-            ),
-            "/settings/filtration/speed/standby": (
-                filtration,
-                between(0, 2),
-                lambda _: "speed_standby",
-                to_int,
-                False,
-            ),
-            "/settings/filtration/speed/overflow": (
-                filtration,
-                between(1, 4),
-                lambda _: "speed_overflow",
-                to_int,
-                False,
-            ),
-            "/settings/filtration/overflow_in_comfort": (
-                filtration,
-                lambda x: x.lower() in ("0", "1", "off", "on"),
-                lambda _: "overflow_in_comfort",
-                to_bool,
-                False,
-            ),
-            "/settings/cover/position/eco": (
-                filtration,
-                between(0, 100),
-                lambda _: "cover_position_eco",
-                to_int,
-                False,
-            ),
-            "/settings/tank/force_empty": (
-                tank,
-                lambda x: x.lower() in ("0", "1", "off", "on"),
-                lambda _: "force_empty",
-                to_bool,
-                False,
-            ),
-            "/settings/swim/mode": (
-                swim,
-                lambda x: x in ("halt", "timed", "continuous"),
-                lambda x: x,
-                None,
-                False,
-            ),
-            "/settings/swim/timer": (
-                swim,
-                between(1, 60),
-                lambda _: "timer",
-                to_int,
-                False,
-            ),
-            "/settings/swim/speed": (
-                swim,
-                between(1, 100),
-                lambda _: "speed",
-                to_int,
-                False,
-            ),
-            "/settings/light/mode": (
-                light,
-                lambda x: x in ("halt", "on"),
-                lambda x: x,
-                None,
-                False,
-            ),
-            "/settings/heater/setpoint": (
-                heater,
-                between(0, 30),
-                lambda _: "setpoint",
-                to_float,
-                False,
-            ),
-            "/settings/heating/enable": (
-                heating,
-                lambda x: x.lower() in ("0", "1", "off", "on"),
-                lambda _: "enable",
-                to_bool,
-                False,
-            ),
-            "/settings/heating/setpoint": (
-                heating,
-                between(10, 32),
-                lambda _: "setpoint",
-                to_float,
-                False,
-            ),
-            "/settings/heating/start_hour": (
-                heating,
-                between(0, 23),
-                lambda _: "start_hour",
-                to_int,
-                False,
-            ),
-            "/settings/heating/min_temp": (
-                heating,
-                between(5, 25),
-                lambda _: "min_temp",
-                to_int,
-                False,
-            ),
-            "/status/heating/total_seconds": (
-                heating,
-                lambda _: True,
-                lambda _: "total_seconds",
-                to_int,
-                True,
-            ),
-            "/settings/disinfection/ph/enable": (
-                disinfection,
-                lambda x: x.lower() in ("0", "1", "off", "on"),
-                lambda _: "ph_enable",
-                to_bool,
-                False,
-            ),
-            "/settings/disinfection/ph/setpoint": (
-                disinfection,
-                between(6, 8),
-                lambda _: "ph_setpoint",
-                to_float,
-                False,
-            ),
-            "/settings/disinfection/ph/pterm": (
-                disinfection,
-                between(0, 10),
-                lambda _: "ph_pterm",
-                to_float,
-                False,
-            ),
-            "/settings/disinfection/orp/enable": (
-                disinfection,
-                lambda x: x.lower() in ("0", "1", "off", "on"),
-                lambda _: "orp_enable",
-                to_bool,
-                False,
-            ),
-            "/settings/disinfection/orp/setpoint": (
-                disinfection,
-                between(500, 800),
-                lambda _: "orp_setpoint",
-                to_int,
-                False,
-            ),
-            "/settings/disinfection/orp/pterm": (
-                disinfection,
-                between(0, 10),
-                lambda _: "orp_pterm",
-                to_float,
-                False,
-            ),
-            "/status/water/counter": (
-                arduino,
-                greater_equal(0),
-                lambda _: "restore_water_counter",
-                to_int,
-                True,
-            ),
+    def register(
+        self,
+        filtration=None,
+        tank=None,
+        swim=None,
+        light=None,
+        heater=None,
+        heating=None,
+        disinfection=None,
+        arduino=None,
+    ):
+        actors = {
+            "filtration": filtration,
+            "tank": tank,
+            "swim": swim,
+            "light": light,
+            "heater": heater,
+            "heating": heating,
+            "disinfection": disinfection,
+            "arduino": arduino,
         }
+        self.__targets = compile_routes(self.__routes, actors)
+        self.__mapping = dict(self.__targets)
 
     def topics(self):
         return self.__mapping.keys()
 
+    def start(self):
+        self.ingress.start()
+
+    def stop(self):
+        self.ingress.stop()
+
+    def submit(self, topic, payload):
+        # Called from the MQTT network thread, which must not wait for us
+        self.ingress.put(topic, self.dispatch, topic, payload)
+
+    def submit_call(self, func, *args):
+        # Run after the messages already submitted, never dropped
+        self.ingress.put_control(func, *args)
+
+    def subscriptions(self):
+        # A single wildcard for the settings, the messages are filtered in dispatch(). The status
+        # topics are subscribed one by one since we publish a lot more of them than we restore.
+        topics = {"/settings/#"}
+        topics.update(topic for topic in self.__mapping if not topic.startswith("/settings/"))
+        return sorted(topics)
+
     def dispatch(self, topic, payload):
-        entry = self.__mapping.get(topic)
-        if entry:
-            fsm, predicate, method, value, once = entry
+        start = time.perf_counter()
+        target = self.__mapping.get(topic)
+        outcome = DispatchMetrics.ACCEPTED
+        coalesced = False
+        if target is None:
+            topic = None
+        else:
             try:
                 data = payload.decode("utf-8")
-                if predicate(data):
-                    func = getattr(fsm, method(data))
-                    param = value(data) if value else None
-                    if param is not None:
-                        func.defer(param)
-                    else:
-                        func.defer()
-                    # Remove the entry if it should be processed only once e.g. for
-                    # configuration restore at startup.
-                    if once:
-                        logger.debug(f"Removing {topic}, only processed once")
-                        del self.__mapping[topic]
-            except Exception:
-                logger.exception(f"Unable to process data for {topic}: {payload!s}")
+                value = target.convert(data)
+            except (KeyError, OutOfRange):
+                logger.warning(f"Invalid value for {topic}: {payload!s}")
+                outcome = DispatchMetrics.REJECTED
+            except ValueError:
+                logger.warning(f"Unable to convert value for {topic}: {payload!s}")
+                outcome = DispatchMetrics.ERRORS
+            else:
+                coalesced = self.__route(topic, target, value, data)
+        self.metrics.dispatched(topic, outcome, start, time.perf_counter(), coalesced)
+
+    def __route(self, topic, target, value, data):
+        # Return whether the value replaced one not applied yet
+        with self.__lock:
+            self.__values[topic] = data
+            if self.__echoes.pop(topic, _NOTHING) == value:
+                # Our own import published back by the broker, already applied
+                return False
+            if self.__restoring is not None:
+                coalesced = topic in self.__restoring
+                self.__restoring[topic] = (target, value)
+                expected = self.__expected
+                if topic in expected:
+                    expected.discard(topic)
+                    if not expected:
+                        self.__end_restore(True)
+                return coalesced
+            if target.methods is not None and value in URGENT:
+                coalesced = target.pending is not _NOTHING
+                target.pending = _NOTHING
+                self.__apply(topic, target, value)
+                if target.window and target.timer is None:
+                    target.timer = scheduler.schedule(target.window, self.__settle, topic, target)
+                return coalesced
+            if target.window == 0 or (target.edge == LEADING and target.timer is None):
+                self.__apply(topic, target, value)
+                if target.window:
+                    target.timer = scheduler.schedule(target.window, self.__settle, topic, target)
+                return False
+            coalesced = target.pending is not _NOTHING
+            target.pending = value
+            if target.edge == TRAILING:
+                # Push the deadline back instead of re-arming the timer on every message
+                target.deadline = get_clock().monotonic() + target.window
+                if target.timer is None:
+                    target.timer = scheduler.schedule(target.window, self.__settle, topic, target)
+            return coalesced
+
+    def begin_restore(self):
+        # Hold the messages back until end_restore(), the retained settings are then applied at once
+        with self.__lock:
+            self.__restoring = {}
+            self.__restore_start = get_clock().monotonic()
+            self.__expected = self.__mapping.keys() - self.__values.keys()
+            self.restore_complete = False
+            self.__restored.clear()
+
+    def end_restore(self, complete=True):
+        # Complete once the broker has sent all its retained messages, see Mqtt
+        with self.__lock:
+            return self.__end_restore(complete)
+
+    def __end_restore(self, complete):
+        batch, self.__restoring = self.__restoring, None
+        if batch is None:
+            return False
+        self.__apply_batch(batch)
+        self.restore_duration = get_clock().monotonic() - self.__restore_start
+        self.restore_complete = complete
+        if complete:
+            logger.info(f"Restored {len(batch)} settings in {self.restore_duration:.3f}s")
+        else:
+            logger.warning(f"Restored {len(batch)} settings, timeout after {self.restore_duration:.3f}s")
+        self.__restored.set()
+        return True
+
+    def wait_restored(self, timeout=None):
+        return self.__restored.wait(timeout)
+
+    def missing(self):
+        # Exported settings never received
+        with self.__lock:
+            return sorted(
+                topic for topic, target in self.__targets.items() if target.export and topic not in self.__values
+            )
+
+    def __apply_batch(self, batch):
+        # Group by actor with the modes last so that an actor only does a single transition once
+        # all its settings are known. No debounce, all the values are final.
+        actors = {}
+        for topic, (target, value) in batch.items():
+            actors.setdefault(target.actor, []).append((target.methods is not None, topic, target, value))
+        for entries in actors.values():
+            for _, topic, target, value in sorted(entries, key=lambda entry: entry[0]):
+                self.__apply(topic, target, value)
+
+    def value(self, topic):
+        # Last payload received on the topic
+        with self.__lock:
+            return self.__values.get(topic)
+
+    def export(self):
+        # Versioned document with the last value of all the exported settings
+        with self.__lock:
+            settings = {
+                topic: self.__values[topic]
+                for topic, target in self.__targets.items()
+                if target.export and topic in self.__values
+            }
+        return {"version": VERSION, "settings": settings}
+
+    def import_settings(self, document):
+        """Apply a document from export() as a whole, like the restore at startup.
+
+        Nothing is applied if a setting is unknown or invalid, ValueError tells which ones. The once
+        settings already restored and the unchanged ones are only recorded. Return the imported
+        topics and payloads.
+        """
+        if not isinstance(document, dict) or document.get("version") != VERSION:
+            raise ValueError(f"Unsupported settings document, version {VERSION} expected")
+        settings = document.get("settings")
+        if not isinstance(settings, dict):
+            raise ValueError("No settings in the document")
+        batch = {}
+        errors = []
+        for topic, data in settings.items():
+            target = self.__targets.get(topic)
+            if target is None or not target.export:
+                errors.append(f"{topic} unknown")
+                continue
+            data = _payload(data)
+            try:
+                batch[topic] = (target, target.convert(data), data)
+            except (KeyError, ValueError):
+                errors.append(f"{topic} invalid: {data}")
+        if errors:
+            raise ValueError(", ".join(errors))
+        with self.__lock:
+            apply = {}
+            for topic, (target, value, data) in batch.items():
+                self.__values[topic] = data
+                self.__echoes[topic] = value
+                # The imported value wins over the one waiting for the debounce
+                target.pending = _NOTHING
+                # An unchanged setting could still cause a reload of the actor
+                if topic in self.__mapping and value != target.last:
+                    apply[topic] = (target, value)
+            if self.__restoring is not None:
+                self.__restoring.update(apply)
+            else:
+                self.__apply_batch(apply)
+        logger.info(f"Imported {len(batch)} settings, {len(apply)} changed")
+        return [(topic, data) for topic, (_, _, data) in batch.items()]
+
+    def __settle(self, topic, target):
+        with self.__lock:
+            target.timer = None
+            if target.edge == TRAILING:
+                remaining = target.deadline - get_clock().monotonic()
+                if remaining > 0:
+                    target.timer = scheduler.schedule(remaining, self.__settle, topic, target)
+                    return
+            value, target.pending = target.pending, _NOTHING
+            if value is _NOTHING or (target.edge == LEADING and value == target.last):
+                return
+            self.__apply(topic, target, value)
+            if target.edge == LEADING:
+                # Keep a stream of changes rate limited
+                target.timer = scheduler.schedule(target.window, self.__settle, topic, target)
+
+    def __apply(self, topic, target, value):
+        try:
+            target.apply(value)
+            # Remove the entry if it should be processed only once e.g. for
+            # configuration restore at startup.
+            if target.once:
+                logger.debug(f"Removing {topic}, only processed once")
+                del self.__mapping[topic]
+                self.metrics.consumed(topic)
+        except Exception:
+            logger.exception(f"Unable to process data for {topic}: {value!s}")
@@ -15,18 +15,133 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import threading
+
+from .actor import defer_coalesced
+from .clock import get_clock
+from .config import config
+
+
+class PublishPolicy:
+    """Drop the status values which did not change since the last publication.
+
+    A numeric value with a deadband is only published again once it moved by at least the
+    deadband. Any value is published again after max_age seconds.
+    """
+
+    def __init__(self, max_age, deadbands):
+        self.__max_age = max_age
+        self.__deadbands = deadbands
+        self.__lock = threading.Lock()
+        self.__last = {}
+        self.published = 0
+        self.suppressed = 0
+
+    def accept(self, name, value):
+        now = get_clock().monotonic()
+        with self.__lock:
+            last = self.__last.get(name)
+            if last is None or now - last[1] >= self.__max_age or self.__changed(name, last[0], value):
+                self.__last[name] = (value, now)
+                self.published += 1
+                return True
+            self.suppressed += 1
+            return False
+
+    def __changed(self, name, last, value):
+        deadband = self.__deadbands.get(name)
+        if deadband is not None:
+            try:
+                # Tolerate the rounding error, 24.5 - 24.4 is slightly below 0.1
+                return abs(float(value) - float(last)) >= deadband - 1e-9
+            except (TypeError, ValueError):
+                pass
+        return value != last
+
+
+def default_policy():
+    deadbands = {name: float(value) for name, value in config.items("deadband").items()}
+    return PublishPolicy(float(config["publish", "max_age"]), deadbands)
+
+
+def status_topic(name):
+    # The underscores separate the levels of the topic, a double underscore is kept as an underscore
+    return "/status/" + "/".join(name.split("_")).replace("//", "_")
+
+
+# Status values published by the actors through the encoder, the name of the method and its topic.
+# The retained ones are restored at startup, see dispatcher.ROUTES. The monitor, the snapshots, the
+# watchdog and the settings import/export publish on /status/metrics, /status/snapshot,
+# /status/watchdog and /status/settings directly.
+STATUS_TOPICS = {
+    name: status_topic(name)
+    for name in (
+        "disinfection_state",
+        # Output of the regulation in percent
+        "disinfection_cl_feedback",
+        "disinfection_ph_feedback",
+        "disinfection_orp_value",
+        "disinfection_ph_value",
+        "filtration_state",
+        # Next filtration event and remaining duration of the current one
+        "filtration_next",
+        "filtration_remaining",
+        # Retained
+        "filtration_duration",
+        "filtration_backwash_last",
+        "heating_state",
+        # Retained
+        "heating_total__seconds",
+        "light_state",
+        "swim_state",
+        "tank_state",
+        "tank_height",
+        "temperature_pool",
+        "temperature_air",
+        "temperature_local",
+        "temperature_ncc",
+        # Degrees per hour
+        "temperature_pool__slope",
+        # Retained
+        "water_counter",
+    )
+}
+
 
 class Encoder:
-    def __init__(self, mqtt, lcd):
+    def __init__(self, mqtt, lcd, policy=None, snapshot=None):
         self.__mqtt = mqtt
         self.__lcd = lcd
+        self.__policy = policy or default_policy()
+        self.__snapshot = snapshot
+        for name, topic in STATUS_TOPICS.items():
+            setattr(self, name, self.__publisher(name, topic))
+
+    def __getattr__(self, name):
+        # Only called for a name missing from STATUS_TOPICS, resolved once as well
+        if name.startswith("__"):
+            raise AttributeError(name)
+        publisher = self.__publisher(name, status_topic(name))
+        setattr(self, name, publisher)
+        return publisher
 
-    def __getattr__(self, value):
-        topic = "/status/" + "/".join(value.split("_"))
-        topic = topic.replace("//", "_")
+    def __publisher(self, name, topic):
+        # The keys of the coalesced messages are built once too
+        accept = self.__policy.accept
+        mqtt = self.__mqtt
+        lcd = self.__lcd
+        snapshot = self.__snapshot
+        mqtt_key = ("publish", topic)
+        lcd_key = ("update", name)
+        snapshot_key = ("update", topic)
 
-        def wrapper(x, **kwargs):
-            self.__mqtt.publish.defer(topic, x, **kwargs)
-            self.__lcd.update.defer(value, x)
+        def publish(x, **kwargs):
+            if not accept(name, x):
+                return
+            # Only the latest value of a topic is worth sending
+            defer_coalesced(mqtt, mqtt_key, "publish", topic, x, **kwargs)
+            defer_coalesced(lcd, lcd_key, "update", name, x)
+            if snapshot is not None:
+                defer_coalesced(snapshot, snapshot_key, "update", topic, x)
 
-        return wrapper
+        return publish
@@ -16,14 +16,13 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import logging
-import time
 from datetime import datetime, timedelta
 from typing import Final
 
-import pykka
 from astral import geocoder, sun
 
-from .actor import PoupoolActor, PoupoolModel, do_repeat
+from .actor import PoupoolActor, PoupoolModel, defer_coalesced, do_repeat, is_state
+from .clock import get_clock
 from .config import config
 from .util import Timer, round_timedelta
 
@@ -31,8 +30,9 @@ logger = logging.getLogger(__name__)
 
 
 class EcoMode:
-    def __init__(self, encoder):
+    def __init__(self, encoder, clock=None):
         self.__encoder = encoder
+        self.__clock = clock or get_clock()
         self.filtration = Timer("filtration")
         self.current = Timer("current")
         self.reset_hour = 0
@@ -43,7 +43,7 @@ class EcoMode:
         self.off_duration = timedelta()
         self.on_duration = timedelta()
         self.tank_duration = timedelta()
-        self.__duration_last_save = datetime.now()
+        self.__duration_last_save = self.__clock.now()
 
     @property
     def reset_hour(self):
@@ -51,7 +51,7 @@ class EcoMode:
 
     @reset_hour.setter
     def reset_hour(self, hour):
-        tm = datetime.now()
+        tm = self.__clock.now()
         self.__next_reset = tm.replace(hour=hour, minute=0, second=0, microsecond=0)
         if self.__next_reset < tm:
             self.__next_reset += timedelta(days=1)
@@ -87,7 +87,7 @@ class EcoMode:
         remaining_duration = max(timedelta(), self.filtration.delay - self.filtration.duration)
         assert self.period_duration > timedelta()
         remaining_periods = max(1, int(remaining_duration / self.period_duration))
-        remaining_time = max(timedelta(), self.reset_hour - datetime.now())
+        remaining_time = max(timedelta(), self.reset_hour - self.__clock.now())
         logger.info(f"Remaining duration: {remaining_duration} periods: {remaining_periods} time: {remaining_time}")
         self.on_duration = min(remaining_time, remaining_duration / remaining_periods)
         if self.on_duration < timedelta(hours=1):
@@ -182,7 +182,7 @@ class StirMode:
         # No need to stir at night, this mode is meant to lower the solar cover
         # temperature.
         if self.__period > timedelta() and self.__current.elapsed():
-            elevation = sun.elevation(self.__city)
+            elevation = sun.elevation(self.__city, now.astimezone())
             if self.__stir_state:
                 self.__pause(None)
             elif elevation >= StirMode.SOLAR_ELEVATION and self.__duration > timedelta():
@@ -223,7 +223,7 @@ class Filtration(PoupoolActor):
         self.__encoder = encoder
         self.__devices = devices
         # Parameters
-        self.__eco_mode = EcoMode(encoder)
+        self.__eco_mode = EcoMode(encoder, self._clock)
         self.__stir_mode = StirMode(devices)
         self.__boost_duration = timedelta(minutes=5)
         self.__cover_position_eco = 0
@@ -231,8 +231,8 @@ class Filtration(PoupoolActor):
         self.__speed_standby = 1
         self.__speed_overflow = 4
         self.__overflow_in_comfort = False
-        self.__backwash_backwash_duration = 120
-        self.__backwash_rinse_duration = 60
+        self.__backwash_backwash_duration = timedelta(seconds=120)
+        self.__backwash_rinse_duration = timedelta(seconds=60)
         self.__backwash_period = 30
         self.__backwash_last = datetime.fromtimestamp(0)
         # Initialize the state machine
@@ -301,18 +301,12 @@ class Filtration(PoupoolActor):
         # since there is actually no state change). So we jump to the reload state and back to
         # workaround this.
         self.__machine.add_transition("reload", ["eco", "standby", "overflow"], "reload")
-        # Export the FSM
-        from transitions.extensions import HierarchicalGraphMachine
-
-        if isinstance(self.__machine, HierarchicalGraphMachine):
-            args = "-Grankdir=LR -Goverlap=false -Gsplines=true -Gratio=1 -Gsep=.3"
-            self.__machine.get_graph().draw("filtration.svg", prog="dot", args=args)
 
     def __reload_eco(self):
         if self.is_eco(allow_substates=True):
             # Jump to the reload state so that we can jump back into the same state
-            self._proxy.reload.defer()
-            self._proxy.eco.defer()
+            defer_coalesced(self._proxy, "reload", "reload")
+            defer_coalesced(self._proxy, "eco", "eco")
 
     def duration(self, value):
         current_duration = self.__eco_mode.filtration.duration
@@ -360,31 +354,31 @@ class Filtration(PoupoolActor):
         logger.info(f"Speed for eco mode set to: {self.__speed_eco}")
         if self.is_eco_normal():
             # Jump to the reload state so that we can jump back into standby mode
-            self._proxy.reload.defer()
-            self._proxy.eco.defer()
+            defer_coalesced(self._proxy, "reload", "reload")
+            defer_coalesced(self._proxy, "eco", "eco")
 
     def speed_standby(self, value):
         self.__speed_standby = value
         logger.info(f"Speed for standby mode set to: {self.__speed_standby}")
         if self.is_standby_normal():
             # Jump to the reload state so that we can jump back into standby mode
-            self._proxy.reload.defer()
-            self._proxy.standby.defer()
+            defer_coalesced(self._proxy, "reload", "reload")
+            defer_coalesced(self._proxy, "standby", "standby")
 
     def speed_overflow(self, value):
         self.__speed_overflow = value
         logger.info(f"Speed for overflow mode set to: {self.__speed_overflow}")
         if self.is_overflow_normal():
             # Jump to the reload state so that we can jump back into overflow mode
-            self._proxy.reload.defer()
-            self._proxy.overflow.defer()
+            defer_coalesced(self._proxy, "reload", "reload")
+            defer_coalesced(self._proxy, "overflow", "overflow")
 
     def overflow_in_comfort(self, value):
         self.__overflow_in_comfort = value
         logger.info("Overflow in comfort mode is %sable" % ("en" if value else "dis"))
         if self.is_comfort():
             # Reload settings
-            self._proxy.reload.defer()
+            defer_coalesced(self._proxy, "reload", "reload")
 
     def backwash_backwash_duration(self, value):
         self.__backwash_backwash_duration = timedelta(seconds=value)
@@ -406,32 +400,28 @@ class Filtration(PoupoolActor):
         logger.info(f"Backwash last set to: {self.__backwash_last}")
 
     def tank_start(self):
-        tank = self.get_actor("Tank")
-        if tank.is_halt().get():
-            tank.fill.defer()
+        if is_state("Tank", "halt"):
+            self.get_actor("Tank").fill.defer()
 
     def heating_start(self):
-        heating = self.get_actor("Heating")
-        if heating.is_halt().get():
-            heating.wait.defer()
+        if is_state("Heating", "halt"):
+            self.get_actor("Heating").wait.defer()
 
     def arduino_start(self):
-        arduino = self.get_actor("Arduino")
-        if arduino.is_halt().get():
-            arduino.run.defer()
+        if is_state("Arduino", "halt"):
+            self.get_actor("Arduino").run.defer()
 
     def tank_is_low(self):
-        tank = self.get_actor("Tank")
-        return tank.is_halt().get() or tank.is_low().get() or tank.is_fill().get()
+        return is_state("Tank", "halt") or is_state("Tank", "low") or is_state("Tank", "fill")
 
     def tank_is_high(self):
-        return self.get_actor("Tank").is_high().get()
+        return is_state("Tank", "high")
 
     def pump_stopped_in_standby(self):
         return self.__speed_standby == 0
 
     def __start_backwash(self):
-        diff = datetime.now() - self.__backwash_last
+        diff = self._clock.now() - self.__backwash_last
         if diff >= timedelta(self.__backwash_period):
             if self.tank_is_high():
                 logger.info("Time for a backwash and tank is high")
@@ -446,19 +436,15 @@ class Filtration(PoupoolActor):
         self.__actor_run("Disinfection")
 
     def __actor_run(self, name):
+        # Asked in order with the messages already sent, the state mirror does not know about them.
+        # Run is only sent from halt, from waiting it would skip the start delay.
         actor = self.get_actor(name)
         if actor.is_halt().get():
             actor.run.defer()
 
     def __actor_halt(self, name):
-        actor = self.get_actor(name)
-        try:
-            # We have seen situation where this creates a deadlock. We add a timeout so that we
-            # eventually return from the get() and force the halt transition.
-            if not actor.is_halt().get(timeout=1):
-                actor.halt.defer()
-        except pykka.Timeout:
-            actor.halt.defer()
+        # Ignored if already halted. A pending run is dropped by the urgent halt.
+        self.get_actor(name).halt.defer()
 
     def on_enter_halt(self):
         logger.info("Entering halt state")
@@ -504,7 +490,7 @@ class Filtration(PoupoolActor):
             else:
                 self._proxy.closed.defer()
         else:
-            self.do_delay(5, self.do_repeat_closing.__name__)
+            self.do_periodic(5, self.do_repeat_closing.__name__)
 
     def on_exit_closing(self):
         logger.info("Exiting closing state")
@@ -534,7 +520,7 @@ class Filtration(PoupoolActor):
             # We wait a bit more before exiting the state.
             self.do_delay(2, "opened")
         else:
-            self.do_delay(5, self.do_repeat_opening.__name__)
+            self.do_periodic(5, self.do_repeat_opening.__name__)
 
     def on_exit_opening(self):
         logger.info("Exiting opening state")
@@ -554,7 +540,7 @@ class Filtration(PoupoolActor):
     def on_enter_eco_compute(self):
         logger.info("Entering eco compute")
         self.__encoder.filtration_state("eco_compute")
-        self.__eco_mode.update(datetime.now(), 0)
+        self.__eco_mode.update(self._clock.now(), 0)
         self.__eco_mode.compute()
         if self.__eco_mode.off_duration.total_seconds() > 0:
             self.do_delay(5, "eco_waiting")
@@ -572,7 +558,7 @@ class Filtration(PoupoolActor):
         self.__devices.get_pump("variable").speed(self.__speed_eco)
 
     def do_repeat_eco_normal(self):
-        now = datetime.now()
+        now = self._clock.now()
         if self.__start_backwash():
             self._proxy.wash.defer()
         elif self.__eco_mode.update(now):
@@ -584,7 +570,7 @@ class Filtration(PoupoolActor):
                 self._proxy.eco_tank.defer()
         else:
             self.__stir_mode.update(now)
-            self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_eco_normal.__name__)
+            self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_eco_normal.__name__)
 
     @do_repeat()
     def on_enter_eco_tank(self):
@@ -592,19 +578,19 @@ class Filtration(PoupoolActor):
         self.__encoder.filtration_state("eco_tank")
         self.__eco_mode.set_current(self.__eco_mode.tank_duration)
         self.__actor_halt("Disinfection")
-        self.__stir_mode.clear(datetime.now())
+        self.__stir_mode.clear(self._clock.now())
         self.__devices.get_valve("tank").on()
         # We force the speed to 1 in tank mode because otherwise the tank will be emptied
         # too quickly and the pool will overflow.
         self.__devices.get_pump("variable").speed(1)
 
     def do_repeat_eco_tank(self):
-        if self.__eco_mode.update(datetime.now()):
+        if self.__eco_mode.update(self._clock.now()):
             self.__reload_eco()
         elif self.__eco_mode.elapsed_on():
             self._proxy.eco_waiting.defer()
         else:
-            self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_eco_tank.__name__)
+            self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_eco_tank.__name__)
 
     def on_exit_eco_tank(self):
         self.__devices.get_valve("tank").off()
@@ -618,16 +604,15 @@ class Filtration(PoupoolActor):
         self.__devices.get_pump("variable").speed(2)
 
     def do_repeat_heating_running(self):
-        now = datetime.now()
+        now = self._clock.now()
         self.__eco_mode.update(now)
         self.__stir_mode.update(now)
-        self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_heating_running.__name__)
+        self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_heating_running.__name__)
 
     def on_exit_heating_running(self):
-        actor = self.get_actor("Heating")
-        if actor.is_heating().get():
-            actor.wait.defer()
-        self.__stir_mode.clear(datetime.now())
+        if is_state("Heating", "heating"):
+            self.get_actor("Heating").wait.defer()
+        self.__stir_mode.clear(self._clock.now())
 
     def on_enter_heating_delay(self):
         logger.info("Entering heating_delay state")
@@ -653,7 +638,7 @@ class Filtration(PoupoolActor):
         self.__devices.get_pump("variable").off()
 
     def do_repeat_eco_waiting(self):
-        now = datetime.now()
+        now = self._clock.now()
         if self.__start_backwash():
             self._proxy.wash.defer()
         elif self.__eco_mode.update(now, 0):
@@ -663,7 +648,7 @@ class Filtration(PoupoolActor):
         else:
             # Update the stir mode at the end so we do not switch the boost pumps for nothing.
             self.__stir_mode.update(now)
-            self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_eco_waiting.__name__)
+            self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_eco_waiting.__name__)
 
     def on_enter_standby(self):
         logger.info("Entering standby state")
@@ -694,8 +679,8 @@ class Filtration(PoupoolActor):
 
     def do_repeat_standby_normal(self):
         factor = 1 if self.__speed_standby > 0 else 0
-        self.__eco_mode.update(datetime.now(), factor)
-        self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_standby_normal.__name__)
+        self.__eco_mode.update(self._clock.now(), factor)
+        self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_standby_normal.__name__)
 
     def on_enter_sweep(self):
         logger.info("Entering sweep state")
@@ -727,11 +712,10 @@ class Filtration(PoupoolActor):
             valve.off()
 
     def do_repeat_comfort(self):
-        self.__eco_mode.update(datetime.now(), 0.5)
-        actor = self.get_actor("Heating")
-        if not actor.is_forcing().get() and not actor.is_recovering().get():
-            actor.force.defer()
-        self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_comfort.__name__)
+        self.__eco_mode.update(self._clock.now(), 0.5)
+        if not is_state("Heating", "forcing") and not is_state("Heating", "recovering"):
+            self.get_actor("Heating").force.defer()
+        self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_comfort.__name__)
 
     def on_exit_comfort(self):
         logger.info("Exiting comfort state")
@@ -772,22 +756,22 @@ class Filtration(PoupoolActor):
         self.__actor_halt("Swim")
 
     def do_repeat_overflow_normal(self):
-        self.__eco_mode.update(datetime.now(), 1 if self.__speed_overflow > 2 else 0.5)
-        self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_overflow_normal.__name__)
+        self.__eco_mode.update(self._clock.now(), 1 if self.__speed_overflow > 2 else 0.5)
+        self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_overflow_normal.__name__)
 
     def on_enter_wash(self):
         logger.info("Entering wash state")
         self.__actor_halt("Disinfection")
-        self.__stir_mode.clear(datetime.now())
+        self.__stir_mode.clear(self._clock.now())
 
     def on_enter_wash_backwash(self):
         logger.info("Entering backwash state")
         self.__encoder.filtration_state("backwash")
         self.__devices.get_valve("tank").on()
         self.__devices.get_pump("variable").speed(3)
-        time.sleep(2)
+        self._clock.sleep(2)
         self.__devices.get_valve("backwash").on()
-        time.sleep(2)
+        self._clock.sleep(2)
         self.__devices.get_valve("drain").on()
         self.do_delay(self.__backwash_backwash_duration.total_seconds(), "rinse")
 
@@ -800,7 +784,7 @@ class Filtration(PoupoolActor):
     def on_exit_wash_rinse(self):
         logger.info("Exiting rinse state")
         self.__devices.get_pump("variable").speed(1)
-        self.__backwash_last = datetime.now()
+        self.__backwash_last = self._clock.now()
         self.__encoder.filtration_backwash_last(self.__backwash_last.strftime("%c"), retain=True)
 
     def on_enter_wintering(self):
@@ -823,7 +807,7 @@ class Filtration(PoupoolActor):
             if temperature is None or temperature <= Filtration.WINTERING_ONLY_BELOW:
                 self._proxy.wintering_stir.defer()
                 return
-        self.do_delay(2 * 60, self.do_repeat_wintering_waiting.__name__)
+        self.do_periodic(2 * 60, self.do_repeat_wintering_waiting.__name__)
 
     def on_enter_wintering_stir(self):
         logger.info("Entering wintering stir state")
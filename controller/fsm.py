@@ -0,0 +1,277 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import functools
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = "_"
+
+# Kinds of callbacks. A string is looked up on the model at call time, a method of the model is
+# stored unbound so that the tables can be shared by all the instances of a class.
+_ATTRIBUTE = 0
+_METHOD = 1
+_CALLABLE = 2
+
+
+def _callback(func, model):
+    if isinstance(func, str):
+        return (_ATTRIBUTE, func)
+    if getattr(func, "__self__", None) is model:
+        return (_METHOD, func.__func__)
+    return (_CALLABLE, func)
+
+
+def _callbacks(funcs, model):
+    if funcs is None:
+        return ()
+    if isinstance(funcs, str) or callable(funcs):
+        funcs = [funcs]
+    return tuple(_callback(func, model) for func in funcs)
+
+
+def _call(callback, model, args, kwargs):
+    kind, func = callback
+    if kind == _ATTRIBUTE:
+        func = getattr(model, func)
+        # Same as transitions, a property can be used as a condition
+        return func(*args, **kwargs) if callable(func) else func
+    if kind == _METHOD:
+        return func(model, *args, **kwargs)
+    return func(*args, **kwargs)
+
+
+def _freeze(states, prefix=""):
+    # Hashable representation of the states: (name, initial, children) tuples
+    frozen = []
+    for state in states:
+        if isinstance(state, str):
+            frozen.append((prefix + state, None, ()))
+        else:
+            name = prefix + state["name"]
+            children = _freeze(state.get("children", []), name + SEPARATOR)
+            initial = state.get("initial")
+            frozen.append((name, name + SEPARATOR + initial if initial else None, children))
+    return tuple(frozen)
+
+
+class Transition:
+    __slots__ = ("after", "before", "conditions", "dest", "unless")
+
+    def __init__(self, dest, conditions, unless, before, after):
+        self.dest = dest
+        self.conditions = conditions
+        self.unless = unless
+        self.before = before
+        self.after = after
+
+
+class Table:
+    """Compiled states and transitions of a state machine, shared by all the models of a class."""
+
+    def __init__(self, model_class, frozen_states, specs):
+        self.parents = {}
+        self.initials = {}
+        self.on_enter = {}
+        self.on_exit = {}
+        self.__add_states(model_class, frozen_states, None)
+        self.transitions = {}
+        for trigger, sources, dest, conditions, unless, before, after in specs:
+            transition = Transition(dest, conditions, unless, before, after)
+            for source in sources:
+                self.transitions.setdefault((source, trigger), []).append(transition)
+        self.__paths = {}
+
+    def __add_states(self, model_class, frozen_states, parent):
+        for name, initial, children in frozen_states:
+            self.parents[name] = parent
+            self.initials[name] = initial
+            # The callbacks are found by name on the model like transitions does
+            for kind, callbacks in (("on_enter", self.on_enter), ("on_exit", self.on_exit)):
+                method = f"{kind}_{name}"
+                if callable(getattr(model_class, method, None)):
+                    callbacks[name] = (_ATTRIBUTE, method)
+            self.__add_states(model_class, children, name)
+
+    def lineage(self, state):
+        # The state and all its parents, the top most parent first
+        lineage = []
+        while state is not None:
+            lineage.append(state)
+            state = self.parents[state]
+        lineage.reverse()
+        return lineage
+
+    def path(self, source, dest):
+        # States to exit, new state and states to enter when going from source to dest. It is
+        # computed once for each pair.
+        key = (source, dest)
+        path = self.__paths.get(key)
+        if path is None:
+            current = self.lineage(source)
+            target = self.lineage(dest)
+            common = 0
+            while common < min(len(current), len(target)) and current[common] == target[common]:
+                common += 1
+            # Transition to the state itself or to one of its parents, the state is exited too
+            if common == len(target):
+                common -= 1
+            exits = current[common:][::-1]
+            enters = target[common:]
+            while self.initials[enters[-1]]:
+                enters.append(self.initials[enters[-1]])
+            path = self.__paths[key] = (
+                tuple(self.on_exit.get(state) for state in exits),
+                enters[-1],
+                tuple(self.on_enter.get(state) for state in enters),
+            )
+        return path
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+class Machine:
+    """Hierarchical state machine compatible with how we used transitions' HierarchicalMachine.
+
+    Triggers and is_<state>() are added to the model. Events bubble up from the current state to
+    its parents, invalid triggers are ignored and there is no automatic to_<state>() transition.
+    The tables are compiled on the first trigger and shared by all the models of the same class
+    with the same states and transitions.
+    """
+
+    model_attribute = "state"
+
+    def __init__(self, model=None, states=None, initial=None, before_state_change=None, after_state_change=None):
+        self.model = self if model is None else model
+        self.__frozen_states = _freeze(states or [])
+        self.__states = set()
+        self.__collect(self.__frozen_states)
+        self.__specs = []
+        self.__triggers = set()
+        self.__table = None
+        self.__before_state_change = _callbacks(before_state_change, self.model)
+        self.__after_state_change = _callbacks(after_state_change, self.model)
+        for state in self.__states:
+            self.__assign(f"is_{state}", functools.partial(self.is_state, state))
+        if initial is not None:
+            self.set_state(initial)
+
+    def __collect(self, frozen_states):
+        for name, _, children in frozen_states:
+            self.__states.add(name)
+            self.__collect(children)
+
+    def __assign(self, name, func):
+        # Like transitions, never override something already defined on the model
+        if hasattr(self.model, name):
+            logger.debug(f"Model already contains an attribute '{name}'. Skip binding.")
+        else:
+            setattr(self.model, name, func)
+
+    @property
+    def models(self):
+        return [self.model]
+
+    def set_state(self, state, model=None):
+        if state not in self.__states:
+            raise ValueError(f"State '{state}' is not a registered state")
+        setattr(self.model, self.model_attribute, state)
+
+    def is_state(self, state, allow_substates=False):
+        current = getattr(self.model, self.model_attribute)
+        return current == state or (allow_substates and current.startswith(state + SEPARATOR))
+
+    def add_transition(self, trigger, source, dest, conditions=None, unless=None, before=None, after=None):
+        sources = sorted(self.__states) if source == "*" else [source] if isinstance(source, str) else list(source)
+        for state in [*sources, dest]:
+            if state is not None and state not in self.__states:
+                raise ValueError(f"State '{state}' is not a registered state")
+        model = self.model
+        spec = (
+            trigger,
+            tuple(sources),
+            dest,
+            _callbacks(conditions, model),
+            _callbacks(unless, model),
+            _callbacks(before, model),
+            _callbacks(after, model),
+        )
+        self.__specs.append(spec)
+        self.__table = None
+        if trigger not in self.__triggers:
+            self.__triggers.add(trigger)
+            self.__assign(trigger, functools.partial(self.trigger, trigger))
+
+    @property
+    def table(self):
+        return self.__table or self.__compile()
+
+    def __compile(self):
+        key = (type(self.model), self.__frozen_states, tuple(self.__specs))
+        table = _tables.get(key)
+        if table is None:
+            with _tables_lock:
+                table = _tables.get(key)
+                if table is None:
+                    table = _tables[key] = Table(type(self.model), self.__frozen_states, self.__specs)
+        self.__table = table
+        return table
+
+    def trigger(self, trigger, *args, **kwargs):
+        table = self.__table or self.__compile()
+        model = self.model
+        transitions = table.transitions
+        found = False
+        # Try the current state first and then its parents
+        source = getattr(model, self.model_attribute)
+        while source is not None:
+            for transition in transitions.get((source, trigger), ()):
+                found = True
+                if self.__execute(table, transition, source, args, kwargs):
+                    return True
+            source = table.parents[source]
+        if not found:
+            logger.warning(f"Can't trigger event '{trigger}' from state {getattr(model, self.model_attribute)}!")
+        return False
+
+    def __execute(self, table, transition, source, args, kwargs):
+        model = self.model
+        for condition in transition.conditions:
+            if not _call(condition, model, args, kwargs):
+                return False
+        for condition in transition.unless:
+            if _call(condition, model, args, kwargs):
+                return False
+        for callback in self.__before_state_change + transition.before:
+            _call(callback, model, args, kwargs)
+        if transition.dest is not None:
+            # Exit from the current state, not the source of the transition which can be a parent
+            exits, state, enters = table.path(getattr(model, self.model_attribute), transition.dest)
+            for callback in exits:
+                if callback:
+                    _call(callback, model, args, kwargs)
+            self.set_state(state)
+            for callback in enters:
+                if callback:
+                    _call(callback, model, args, kwargs)
+        for callback in transition.after + self.__after_state_change:
+            _call(callback, model, args, kwargs)
+        return True
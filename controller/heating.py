@@ -16,10 +16,10 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import logging
-from datetime import datetime, timedelta
+from datetime import timedelta
 from typing import Final
 
-from .actor import PoupoolActor, PoupoolModel, do_repeat
+from .actor import PoupoolActor, PoupoolModel, do_repeat, is_state
 from .config import config
 from .util import Duration
 
@@ -68,7 +68,7 @@ class Heater(PoupoolActor):
         if temp is None or temp < self.__setpoint - Heater.HYSTERESIS_DOWN:
             self._proxy.heat.defer()
         else:
-            self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
+            self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
 
     @do_repeat()
     def on_enter_heating(self):
@@ -83,7 +83,7 @@ class Heater(PoupoolActor):
         if temp is not None and temp > self.__setpoint + Heater.HYSTERESIS_UP:
             self._proxy.wait.defer()
         else:
-            self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_heating.__name__)
+            self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_heating.__name__)
 
 
 class Heating(PoupoolActor):
@@ -107,10 +107,10 @@ class Heating(PoupoolActor):
         self.__enable = True
         self.__temperature = temperature
         self.__encoder = encoder
-        self.__total_duration = Duration("heating")
+        self.__total_duration = Duration("heating", self._clock)
         self.__total_duration.set_callback(Heating.DurationEncoderCallback(encoder))
         self.__devices = devices
-        self.__next_start = datetime.now()
+        self.__next_start = self._clock.now()
         self.__next_start_hour = 0
         self.__setpoint = 26.0
         self.__min_temp = 15
@@ -128,7 +128,7 @@ class Heating(PoupoolActor):
         return self.__temperature.get_temperature(key).get()
 
     def __set_next_start(self):
-        tm = datetime.now()
+        tm = self._clock.now()
         self.__next_start = tm.replace(hour=self.__next_start_hour, minute=0, second=0, microsecond=0)
         self.__next_start += timedelta(days=1)
 
@@ -145,14 +145,14 @@ class Heating(PoupoolActor):
         self.__setpoint = value
         logger.info(f"Setpoint set to {self.__setpoint:.1f}")
         # Hack. Restart the heating if the setpoint is changed
-        if self.__next_start > datetime.now():
+        if self.__next_start > self._clock.now():
             self.__next_start -= timedelta(days=1)
 
     def start_hour(self, value):
         logger.info(f"Hour for heating start set to: {value}")
         self.__next_start_hour = value
         self.__set_next_start()
-        if self.__next_start < datetime.now():
+        if self.__next_start < self._clock.now():
             self.__next_start -= timedelta(days=1)
         logger.info(f"Next heating scheduled for {self.__next_start}")
 
@@ -161,12 +161,10 @@ class Heating(PoupoolActor):
         logger.info(f"Minimum temperature for heating set to {self.__min_temp}")
 
     def filtration_ready_for_heating(self):
-        actor = self.get_actor("Filtration")
-        return actor.is_eco_waiting().get() or actor.is_eco_normal().get()
+        return is_state("Filtration", "eco_waiting") or is_state("Filtration", "eco_normal")
 
     def filtration_allow_heating(self):
-        actor = self.get_actor("Filtration")
-        return actor.is_heating_running().get()
+        return is_state("Filtration", "heating_running")
 
     def on_enter_halt(self):
         logger.info("Entering halt state")
@@ -181,11 +179,11 @@ class Heating(PoupoolActor):
 
     def do_repeat_waiting(self):
         if not self.__enable:
-            self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
+            self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
             return
         # First, we check if the daily run is due
-        if datetime.now() < self.__next_start:
-            self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
+        if self._clock.now() < self.__next_start:
+            self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
             return
         # After the time constrain is fulfilled, we check if the temperature is low enough to
         # require heating. If not, then we say it's all good for today and schedule another heating
@@ -195,17 +193,17 @@ class Heating(PoupoolActor):
             # No need to heat today. Schedule for next day
             self.__set_next_start()
             logger.info(f"No heating needed today. Scheduled for {self.__next_start}")
-            self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
+            self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
             return
         # We ensure the outside temperature is high enough to get a good efficiency from the
         # heat pump
         temp = self.__read_temperature("temperature_air")
         if temp is not None and temp < self.__min_temp:
-            self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
+            self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
             return
         # Finally we check that filtration is ready to be switched to heating
         if not self.filtration_ready_for_heating():
-            self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
+            self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
             return
         # All pre-conditions ok, we can start heating now
         self.get_actor("Filtration").heat().get()
@@ -214,7 +212,7 @@ class Heating(PoupoolActor):
         if self.filtration_allow_heating():
             self._proxy.heat.defer()
         else:
-            self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
+            self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_waiting.__name__)
 
     @do_repeat()
     def on_enter_heating(self):
@@ -238,7 +236,7 @@ class Heating(PoupoolActor):
         if temperature is not None and temperature < self.__min_temp - Heating.HYSTERESIS_MIN_TEMP:
             self._proxy.wait.defer()
             return
-        self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_heating.__name__)
+        self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_heating.__name__)
 
     def on_exit_heating(self):
         logger.info("Exiting heating state")
@@ -0,0 +1,157 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import logging
+import threading
+import time
+from collections import deque
+
+from .metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class Ingress:
+    """Bounded queue of calls run in order by a worker thread.
+
+    It takes the received messages off the MQTT network thread. When the queue is full, the
+    DROP_OLDEST policy drops the oldest pending call with the same key, or the incoming one if there
+    is none. The BLOCK policy waits until there is room. The control calls are never dropped nor
+    blocked.
+    """
+
+    DROP_OLDEST = "drop_oldest"
+    BLOCK = "block"
+
+    def __init__(self, maxsize, policy=DROP_OLDEST):
+        assert policy in (self.DROP_OLDEST, self.BLOCK)
+        self.__maxsize = maxsize
+        self.__policy = policy
+        self.__condition = threading.Condition()
+        # Items are [func, args, enqueued, key], func is None once dropped
+        self.__queue = deque()
+        self.__keys = {}
+        self.__size = 0
+        self.__thread = None
+        self.__running = False
+        # Metrics
+        self.__depth = Histogram(bounds=(0, 1, 2, 5, 10, 20, 50, 100))
+        self.__wait = Histogram()
+        self.__max_depth = 0
+        self.__dropped = 0
+        self.__blocked = 0
+
+    def start(self):
+        with self.__condition:
+            if self.__running:
+                return
+            self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name="Ingress", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        if self.__thread and self.__thread is not threading.current_thread():
+            self.__thread.join()
+        self.__thread = None
+
+    def put(self, key, func, *args):
+        with self.__condition:
+            if self.__size >= self.__maxsize:
+                if self.__policy == self.BLOCK:
+                    self.__blocked += 1
+                    while self.__running and self.__size >= self.__maxsize:
+                        self.__condition.wait()
+                elif not self.__drop(key):
+                    self.__dropped += 1
+                    return
+            item = [func, args, time.monotonic(), key]
+            self.__keys.setdefault(key, deque()).append(item)
+            self.__append(item)
+
+    def put_control(self, func, *args):
+        # Run in order with the messages whatever the size of the queue
+        with self.__condition:
+            self.__append([func, args, time.monotonic(), None])
+
+    def __append(self, item):
+        self.__queue.append(item)
+        self.__size += 1
+        self.__depth.add(self.__size)
+        self.__max_depth = max(self.__max_depth, self.__size)
+        self.__condition.notify_all()
+
+    def __drop(self, key):
+        items = self.__keys.get(key)
+        if not items:
+            return False
+        item = items.popleft()
+        if not items:
+            del self.__keys[key]
+        # Skipped by the worker
+        item[0] = None
+        self.__size -= 1
+        self.__dropped += 1
+        return True
+
+    def __forget(self, item):
+        if item[3] is None:
+            return
+        items = self.__keys[item[3]]
+        items.popleft()
+        if not items:
+            del self.__keys[item[3]]
+
+    def __get(self):
+        with self.__condition:
+            while True:
+                while self.__running and not self.__size:
+                    self.__condition.wait()
+                if not self.__running:
+                    return None
+                item = self.__queue.popleft()
+                if item[0] is not None:
+                    break
+            self.__forget(item)
+            self.__size -= 1
+            self.__wait.add(time.monotonic() - item[2])
+            self.__condition.notify_all()
+            return item
+
+    def __run(self):
+        while True:
+            item = self.__get()
+            if item is None:
+                return
+            func, args, _, _ = item
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Unable to process the received message")
+
+    def summary(self):
+        with self.__condition:
+            return {
+                "size": self.__size,
+                "max_depth": self.__max_depth,
+                "depth": self.__depth.summary(),
+                "wait": self.__wait.summary(),
+                "dropped": self.__dropped,
+                "blocked": self.__blocked,
+            }
@@ -25,6 +25,7 @@ logger = logging.getLogger(__name__)
 
 
 class Lcd(PoupoolActor):
+    BLOCKING_IO = True
     UPDATE_DELAY = 2
 
     def __init__(self, lcdbackpack):
@@ -64,7 +65,7 @@ class Lcd(PoupoolActor):
     def do_update(self):
         self.__lcdbackpack.set_cursor_home()
         self.__lcdbackpack.write(self.get_string())
-        self.do_delay(self.UPDATE_DELAY, self.do_update.__name__)
+        self.do_periodic(self.UPDATE_DELAY, self.do_update.__name__)
 
     def get_string(self):
         state = self.__cache.get("filtration_state", "--")
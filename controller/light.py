@@ -18,7 +18,6 @@
 import logging
 from typing import Final
 
-# from transitions.extensions import GraphMachine as Machine
 from .actor import PoupoolActor, PoupoolModel
 
 logger = logging.getLogger(__name__)
@@ -0,0 +1,279 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import bisect
+import threading
+import time
+
+from pykka import messages
+
+# Timer handlers of PoupoolActor, the method they call is their second argument
+TIMERS = frozenset({"do_timer", "do_tick"})
+
+
+def message_name(message):
+    if isinstance(message, messages.ProxyCall | messages.ProxyGetAttr | messages.ProxySetAttr):
+        name = message.attr_path[-1]
+        if name in TIMERS and isinstance(message, messages.ProxyCall):
+            return message.args[1]
+        return name
+    return type(message).__name__
+
+
+class Histogram:
+    # Upper bounds of the buckets. The last bucket catches everything above.
+    BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self, bounds=BOUNDS):
+        self.__bounds = bounds
+        self.__buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.__buckets[bisect.bisect_left(self.__bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        # Upper bound of the bucket holding the percentile, the maximum for the last bucket
+        rank = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.__bounds, self.__buckets, strict=False):
+            seen += count
+            if seen >= rank and seen > 0:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class MethodMetrics:
+    __slots__ = ("cancelled", "coalesced", "depth", "duration", "jitter", "max_depth", "skipped", "wait")
+
+    def __init__(self):
+        self.depth = 0
+        self.max_depth = 0
+        self.wait = Histogram()
+        self.duration = Histogram()
+        self.coalesced = 0
+        self.cancelled = 0
+        # Only for the periodic handlers
+        self.jitter = None
+        self.skipped = 0
+
+    def summary(self):
+        summary = {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "wait": self.wait.summary(),
+            "duration": self.duration.summary(),
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+        }
+        if self.jitter is not None:
+            summary["jitter"] = self.jitter.summary()
+            summary["skipped"] = self.skipped
+        return summary
+
+
+class ActorMetrics:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__methods = {}
+        self.__depth = Histogram(bounds=(0, 1, 2, 5, 10, 20, 50, 100))
+        self.__running = None
+        # Wait of the urgent messages and how many routine messages they went past
+        self.__urgent = Histogram()
+        self.__overtaken = 0
+
+    def __method(self, name):
+        method = self.__methods.get(name)
+        if method is None:
+            method = self.__methods[name] = MethodMetrics()
+        return method
+
+    def enqueued(self, name, depth):
+        with self.__lock:
+            method = self.__method(name)
+            method.depth += 1
+            method.max_depth = max(method.max_depth, method.depth)
+            self.__depth.add(depth)
+
+    def dequeued(self, name, wait):
+        with self.__lock:
+            method = self.__method(name)
+            method.depth -= 1
+            method.wait.add(wait)
+
+    def coalesced(self, name):
+        # A pending message replaced by a newer one
+        with self.__lock:
+            method = self.__method(name)
+            method.depth -= 1
+            method.coalesced += 1
+
+    def cancelled(self, name):
+        # A pending trigger dropped by an urgent message
+        with self.__lock:
+            method = self.__method(name)
+            method.depth -= 1
+            method.cancelled += 1
+
+    def preempted(self, wait, overtaken):
+        with self.__lock:
+            self.__urgent.add(wait)
+            self.__overtaken += overtaken
+
+    def ticked(self, name, lateness):
+        # How late a periodic handler runs compared to its deadline
+        with self.__lock:
+            method = self.__method(name)
+            if method.jitter is None:
+                method.jitter = Histogram()
+            method.jitter.add(lateness)
+
+    def skipped(self, name, count):
+        with self.__lock:
+            self.__method(name).skipped += count
+
+    def started(self, name):
+        handler = (name, time.monotonic(), threading.get_ident())
+        self.__running = handler
+        return handler
+
+    def finished(self, handler):
+        name, since, _ = handler
+        duration = time.monotonic() - since
+        with self.__lock:
+            self.__method(name).duration.add(duration)
+        self.__running = None
+        return duration
+
+    def handler(self):
+        # Name, start time and thread of the handler being run, None if idle
+        return self.__running
+
+    def running(self):
+        # Name of the handler being run and for how long, used to spot a blocked actor
+        handler = self.__running
+        if handler is None:
+            return None, 0
+        return handler[0], time.monotonic() - handler[1]
+
+    def summary(self):
+        running, busy = self.running()
+        with self.__lock:
+            return {
+                "depth": self.__depth.summary(),
+                "running": running,
+                "busy": busy,
+                "urgent": dict(self.__urgent.summary(), overtaken=self.__overtaken),
+                "methods": {name: method.summary() for name, method in self.__methods.items()},
+            }
+
+
+class RouteMetrics:
+    __slots__ = ("coalesced", "consumed", "current", "duration", "max_rate", "outcomes", "second")
+
+    def __init__(self):
+        # Indexed by DispatchMetrics.ACCEPTED, REJECTED and ERRORS
+        self.outcomes = [0, 0, 0]
+        self.coalesced = 0
+        self.consumed = 0
+        self.duration = Histogram(DispatchMetrics.BOUNDS)
+        # Highest number of messages received within a second, a flooded topic stands out
+        self.second = None
+        self.current = 0
+        self.max_rate = 0
+
+    def summary(self):
+        accepted, rejected, errors = self.outcomes
+        return {
+            "accepted": accepted,
+            "rejected": rejected,
+            "errors": errors,
+            "coalesced": self.coalesced,
+            "consumed": self.consumed,
+            "max_rate": self.max_rate,
+            "duration": self.duration.summary(),
+        }
+
+
+class DispatchMetrics:
+    # A dispatch takes a few microseconds
+    BOUNDS = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.01, 0.1)
+
+    # Outcomes of a message
+    ACCEPTED = 0
+    REJECTED = 1
+    ERRORS = 2
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__routes = {}
+        self.__unknown = 0
+
+    def __route(self, topic):
+        route = self.__routes.get(topic)
+        if route is None:
+            route = self.__routes[topic] = RouteMetrics()
+        return route
+
+    def dispatched(self, topic, outcome, start, end, coalesced=False):
+        # Start and end of the dispatch in seconds. Topic is None for a message without route.
+        with self.__lock:
+            if topic is None:
+                self.__unknown += 1
+                return
+            route = self.__route(topic)
+            route.outcomes[outcome] += 1
+            route.coalesced += coalesced
+            route.duration.add(end - start)
+            second = int(start)
+            if second != route.second:
+                route.second = second
+                route.current = 0
+            route.current += 1
+            if route.current > route.max_rate:
+                route.max_rate = route.current
+
+    def consumed(self, topic):
+        with self.__lock:
+            self.__route(topic).consumed += 1
+
+    def route(self, topic):
+        with self.__lock:
+            route = self.__routes.get(topic)
+            return route.summary() if route else None
+
+    def summary(self):
+        with self.__lock:
+            return {
+                "unknown": self.__unknown,
+                "routes": {topic: route.summary() for topic, route in self.__routes.items()},
+            }
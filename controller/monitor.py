@@ -0,0 +1,57 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import logging
+from collections import Counter
+
+import pykka
+
+from .actor import PoupoolActor
+from .config import config
+
+logger = logging.getLogger(__name__)
+
+
+def actor_metrics():
+    # Keyed by class name, the URN is added when several actors share a class like the PWMs
+    refs = [ref for ref in pykka.ActorRegistry.get_all() if getattr(ref.actor_inbox, "metrics", None)]
+    classes = Counter(ref.actor_class.__name__ for ref in refs)
+    metrics = {}
+    for ref in refs:
+        name = ref.actor_class.__name__
+        if classes[name] > 1:
+            name = f"{name}/{ref.actor_urn}"
+        metrics[name] = ref.actor_inbox.metrics.summary()
+    return metrics
+
+
+class Monitor(PoupoolActor):
+    INTERVAL = int(config["metrics", "interval"])
+
+    def __init__(self, mqtt, dispatcher=None):
+        super().__init__()
+        self.__mqtt = mqtt
+        self.__dispatcher = dispatcher
+
+    def do_publish(self):
+        for name, summary in actor_metrics().items():
+            self.__mqtt.publish.defer(f"/status/metrics/actors/{name}", json.dumps(summary))
+        if self.__dispatcher:
+            summary = dict(self.__dispatcher.metrics.summary(), ingress=self.__dispatcher.ingress.summary())
+            self.__mqtt.publish.defer("/status/metrics/dispatcher", json.dumps(summary))
+        self.do_periodic(self.INTERVAL, self.do_publish.__name__)
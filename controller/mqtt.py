@@ -15,64 +15,244 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import contextlib
+import json
 import logging
+import selectors
+import socket
+import threading
 
 import paho.mqtt.client as mqtt
 
 from .actor import PoupoolActor
+from .config import config
+from .dispatcher import EXPORT_TOPIC, IMPORT_STATUS_TOPIC, IMPORT_TOPIC, to_bool
+from .scheduler import scheduler
+from .spool import Spool
 
 logger = logging.getLogger(__name__)
 
 
 class Mqtt(PoupoolActor):
-    def __init__(self, dispatcher):
+    BLOCKING_IO = True
+    FLUSH_DELAY = int(config["spool", "flush_delay"])
+    RESTORE_TIMEOUT = float(config["restore", "timeout"])
+
+    def __init__(self, dispatcher, host=None, port=None, client_id=None, spool=True, requests=True):
         super().__init__()
         self.__run = True
         self.__dispatcher = dispatcher
-        self.__client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+        self.__host = host or config["mqtt", "host"]
+        self.__port = port or int(config["mqtt", "port"])
+        self.__persistent = to_bool(config["mqtt", "persistent"])
+        self.__subscribed = False
+        # Only poupool answers the export and import requests, not the tools
+        self.__requests = requests
+        # MQTT has no end of the retained messages. The broker handles our packets in order so the
+        # marker we publish after subscribing comes back after all the retained messages.
+        client_id = client_id or config["mqtt", "client_id"]
+        self.__marker = f"/restore/{client_id}"
+        self.__restore = None
+        self.__client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION1,
+            client_id=client_id,
+            clean_session=not self.__persistent,
+        )
         self.__client.on_connect = self.__on_connect
         self.__client.on_message = self.__on_message
         self.__client.on_disconnect = self.__on_disconnect
+        # The network loop sleeps until the socket is ready, a packet is queued or a keepalive is
+        # due. Paho tells us about the socket changes and the packets to send with these callbacks.
+        self.__client.on_socket_open = self.__wakeup
+        self.__client.on_socket_close = self.__wakeup
+        self.__client.on_socket_register_write = self.__wakeup
+        self.__client.on_socket_unregister_write = self.__wakeup
+        self.__wake_r, self.__wake_w = socket.socketpair()
+        self.__wake_r.setblocking(False)
+        self.__wake_w.setblocking(False)
+        self.__thread = None
+        # Messages which could not be published, replayed once connected. The file belongs to the
+        # daemon, the other clients like backup_settings.py do without.
+        self.__spool = None
+        if spool:
+            self.__spool = Spool(
+                config["spool", "path"], int(config["spool", "max_entries"]), int(config["spool", "batch"])
+            )
+        self.__flush = None
 
     def on_stop(self):
         self.do_stop()
+        if self.__thread:
+            self.__thread.join()
+        self.__dispatcher.stop()
+        # The network loop is gone, send the disconnect ourselves
         self.__client.disconnect()
+        self.__client.loop_write()
+        self.__wake_r.close()
+        self.__wake_w.close()
+        if self.__flush:
+            scheduler.cancel(self.__flush)
+        if self.__restore:
+            scheduler.cancel(self.__restore)
+        if self.__spool is not None:
+            self.__spool.flush()
 
     def __on_connect(self, client, userdata, flags, rc):
         logger.info("MQTT client connected to broker")
-        for topic in self.__dispatcher.topics():
-            self.__client.subscribe(topic)
+        # The broker kept our subscriptions. We still subscribe once after starting to get the
+        # retained settings.
+        if self.__subscribed and flags.get("session present"):
+            logger.info("MQTT session restored, no need to subscribe")
+        else:
+            # Only QoS 1 messages are queued by the broker for a persistent session
+            qos = 1 if self.__persistent else 0
+            topics = self.__dispatcher.subscriptions()
+            if not self.__subscribed:
+                topics = [*topics, self.__marker]
+            self.__client.subscribe([(topic, qos) for topic in topics])
+            if not self.__subscribed:
+                self.__client.publish(self.__marker)
+                # In case the marker gets lost
+                self.__restore = scheduler.schedule(self.RESTORE_TIMEOUT, self.__end_restore, False)
+            self.__subscribed = True
+        # Called from the network thread, the actor replays the spool
+        self._proxy.do_replay.defer()
 
     def __on_message(self, client, userdata, message):
-        self.__dispatcher.dispatch(message.topic, message.payload)
+        if message.topic == self.__marker:
+            self.__end_restore()
+        elif self.__requests and message.topic in (EXPORT_TOPIC, IMPORT_TOPIC):
+            # A retained request would be run again on every start
+            if message.retain:
+                logger.warning(f"Ignoring retained {message.topic}")
+            elif message.topic == EXPORT_TOPIC:
+                self.__dispatcher.submit_call(self.__export)
+            else:
+                self.__dispatcher.submit_call(self.__import, message.payload)
+        else:
+            self.__dispatcher.submit(message.topic, message.payload)
+
+    def __export(self):
+        self._proxy.publish.defer("/status/settings/export", json.dumps(self.__dispatcher.export()))
+
+    def __import(self, payload):
+        try:
+            applied = self.__dispatcher.import_settings(json.loads(payload))
+        except ValueError as e:
+            logger.error(f"Unable to import the settings: {e}")
+            self._proxy.publish.defer(IMPORT_STATUS_TOPIC, json.dumps({"imported": 0, "error": str(e)}))
+            return
+        # Retained like the settings from the UI so that they are restored on the next start
+        for topic, data in applied:
+            self._proxy.publish.defer(topic, data, qos=1, retain=True)
+        self._proxy.publish.defer(IMPORT_STATUS_TOPIC, json.dumps({"imported": len(applied)}))
+
+    def __end_restore(self, complete=True):
+        if self.__restore:
+            scheduler.cancel(self.__restore)
+            self.__restore = None
+        self.__dispatcher.submit_call(self.__dispatcher.end_restore, complete)
 
     def __on_disconnect(self, client, userdata, rc):
         logger.warning(f"MQTT client disconnected: {rc}")
         if rc != 0 and self.__run:
-            self.do_connect()
+            # Called from the network thread, the actor reconnects
+            self._proxy.do_connect.defer()
+
+    def __wakeup(self, *args):
+        # Full when a wakeup is already pending, closed when stopping
+        with contextlib.suppress(OSError):
+            self.__wake_w.send(b"\0")
 
     def do_connect(self):
         try:
-            self.__client.connect("localhost")
+            self.__client.connect(self.__host, self.__port)
         except Exception as e:
             logger.error(f"Unable to connect to MQTT broker: {e}")
             self.do_delay(5, self.do_connect.__name__)
 
     def do_start(self):
+        # The settings received until the restore ends are applied as one batch
+        self.__dispatcher.begin_restore()
+        self.__dispatcher.start()
         self.do_connect()
-        self._proxy.do_loop()
+        self.__thread = threading.Thread(target=self.__network, name="MqttNetwork", daemon=True)
+        self.__thread.start()
+
+    def __network(self):
+        client = self.__client
+        selector = selectors.DefaultSelector()
+        selector.register(self.__wake_r, selectors.EVENT_READ)
+        sock = None
+        while self.__run:
+            current = client.socket()
+            if current is not sock:
+                if sock is not None:
+                    selector.unregister(sock)
+                sock = current
+                if sock is not None:
+                    selector.register(sock, selectors.EVENT_READ)
+            if sock is not None:
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.want_write() else 0)
+                selector.modify(sock, events)
+            # Without a connection, only wait for a wakeup
+            timeout = client.keepalive / 4 if sock is not None else None
+            for key, events in selector.select(timeout):
+                if key.fileobj is self.__wake_r:
+                    self.__drain()
+                    continue
+                if events & selectors.EVENT_READ:
+                    client.loop_read()
+                if events & selectors.EVENT_WRITE and client.socket() is sock:
+                    client.loop_write()
+            client.loop_misc()
+        selector.close()
 
-    def do_loop(self):
-        self.__client.loop(timeout=0.05)
-        if self.__run:
-            self.do_delay(0, self.do_loop.__name__)
+    def __drain(self):
+        with contextlib.suppress(BlockingIOError):
+            while self.__wake_r.recv(64):
+                pass
 
     def do_stop(self):
         self.__run = False
+        self.__wakeup()
+
+    def do_replay(self):
+        if self.__spool is None:
+            return
+        entries = self.__spool.replay()
+        if entries:
+            logger.info(f"Replaying {len(entries)} messages from the spool")
+        for i, (topic, payload, qos, retain) in enumerate(entries):
+            result, _ = self.__client.publish(topic, payload, qos, retain)
+            if result != mqtt.MQTT_ERR_SUCCESS:
+                # Disconnected again, keep the others for the next connection
+                for entry in entries[i:]:
+                    self.__spool.append(*entry)
+                self.__schedule_flush()
+                break
+
+    def do_flush(self):
+        self.__flush = None
+        self.__spool.flush()
+
+    def __schedule_flush(self):
+        if self.__flush is None:
+            self.__flush = scheduler.schedule(self.FLUSH_DELAY, self._proxy.do_flush.defer)
 
     def publish(self, topic, payload, qos=0, retain=False):
-        result, _ = self.__client.publish(topic, payload, qos, retain)
-        if result != 0:
-            logger.error(f"Unable to publish topic '{topic}':'{payload!s}'")
-            return False
-        return True
+        # Once something is spooled, the newer messages go to the spool too to keep the order
+        if self.__spool is None or not len(self.__spool):
+            result, _ = self.__client.publish(topic, payload, qos, retain)
+            if result == mqtt.MQTT_ERR_SUCCESS:
+                return True
+            if result != mqtt.MQTT_ERR_NO_CONN:
+                logger.error(f"Unable to publish topic '{topic}':'{payload!s}'")
+                return False
+            if self.__spool is None:
+                logger.error(f"Unable to publish topic '{topic}':'{payload!s}', not connected")
+                return False
+            logger.error(f"Unable to publish topic '{topic}':'{payload!s}', spooling until connected")
+        self.__spool.append(topic, payload, qos, retain)
+        self.__schedule_flush()
+        return False
@@ -0,0 +1,161 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import heapq
+import itertools
+import logging
+import threading
+
+from .clock import get_clock
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduledCall:
+    __slots__ = ("args", "cancelled", "deadline", "func", "kwargs", "sequence")
+
+    def __init__(self, deadline, sequence, func, args, kwargs):
+        self.deadline = deadline
+        self.sequence = sequence
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.deadline, self.sequence) < (other.deadline, other.sequence)
+
+
+class Scheduler:
+    # Rebuild the heap once the cancelled entries outnumber the live ones
+    COMPACT_THRESHOLD = 64
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__heap = []
+        self.__sequence = itertools.count()
+        self.__thread = None
+        self.__running = False
+        self.__clock = get_clock()
+        # Counters
+        self.__armed = 0
+        self.__fired = 0
+        self.__cancelled = 0
+        self.__lateness_total = 0.0
+        self.__lateness_max = 0.0
+
+    def start(self):
+        with self.__condition:
+            if self.__running:
+                return
+            self.__running = True
+            self.__thread = threading.Thread(target=self.__run, name="Scheduler", daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        if self.__thread and self.__thread is not threading.current_thread():
+            self.__thread.join()
+        self.__thread = None
+
+    def schedule(self, delay, func, *args, **kwargs):
+        assert delay >= 0
+        self.start()
+        with self.__condition:
+            call = ScheduledCall(self.__get_clock().monotonic() + delay, next(self.__sequence), func, args, kwargs)
+            heapq.heappush(self.__heap, call)
+            self.__armed += 1
+            # Only wake up the thread if the new call is the next one to fire
+            if self.__heap[0] is call:
+                self.__condition.notify()
+        return call
+
+    def cancel(self, call):
+        # Lazy deletion. The entry stays in the heap and is discarded when it reaches the top.
+        with self.__condition:
+            if call.cancelled or call.func is None:
+                return False
+            call.cancelled = True
+            self.__armed -= 1
+            self.__cancelled += 1
+            if len(self.__heap) > self.COMPACT_THRESHOLD and self.__armed < len(self.__heap) // 2:
+                self.__heap = [c for c in self.__heap if not c.cancelled]
+                heapq.heapify(self.__heap)
+            return True
+
+    def stats(self):
+        with self.__condition:
+            return {
+                "armed": self.__armed,
+                "fired": self.__fired,
+                "cancelled": self.__cancelled,
+                "lateness_mean": self.__lateness_total / self.__fired if self.__fired else 0.0,
+                "lateness_max": self.__lateness_max,
+            }
+
+    def __get_clock(self):
+        clock = get_clock()
+        if clock is not self.__clock:
+            # The pending deadlines were computed with another time base, they are meaningless now
+            logger.debug(f"Clock changed, dropping {self.__armed} pending call(s)")
+            for call in self.__heap:
+                call.cancelled = True
+            self.__heap.clear()
+            self.__armed = 0
+            self.__clock = clock
+        return clock
+
+    def __pop_due(self, clock):
+        while self.__heap:
+            call = self.__heap[0]
+            if call.cancelled:
+                heapq.heappop(self.__heap)
+                continue
+            remaining = call.deadline - clock.monotonic()
+            if remaining > 0:
+                return None, remaining
+            heapq.heappop(self.__heap)
+            return call, 0
+        return None, None
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                if not self.__running:
+                    return
+                clock = self.__get_clock()
+                call, remaining = self.__pop_due(clock)
+                if call is None:
+                    clock.wait(self.__condition, remaining)
+                    continue
+                lateness = clock.monotonic() - call.deadline
+                self.__armed -= 1
+                self.__fired += 1
+                self.__lateness_total += lateness
+                self.__lateness_max = max(self.__lateness_max, lateness)
+                func, args, kwargs = call.func, call.args, call.kwargs
+                # Drop the references so that a late cancel() becomes a no-op
+                call.func = call.args = call.kwargs = None
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception("Scheduled call failed")
+
+
+scheduler = Scheduler()
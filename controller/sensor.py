@@ -43,6 +43,8 @@ class MovingAverage:
 
 
 class BaseReader(PoupoolActor):
+    BLOCKING_IO = True
+
     def __init__(self, sensors, maxlen=10):
         super().__init__()
         self.__sensors = sensors
@@ -77,7 +79,7 @@ class DisinfectionReader(BaseReader):
 
     def do_read(self):
         super().do_read()
-        self.do_delay(self.DELAY_SECONDS, self.do_read.__name__)
+        self.do_periodic(self.DELAY_SECONDS, self.do_read.__name__)
 
 
 class DisinfectionWriter(PoupoolActor):
@@ -95,7 +97,7 @@ class DisinfectionWriter(PoupoolActor):
         ph = self.__reader.get_ph().get()
         if ph:
             self.__encoder.disinfection_ph_value(f"{ph:.2f}")
-        self.do_delay(self.DELAY_SECONDS, self.do_write.__name__)
+        self.do_periodic(self.DELAY_SECONDS, self.do_write.__name__)
 
 
 class TemperatureReader(BaseReader):
@@ -125,7 +127,7 @@ class TemperatureReader(BaseReader):
 
     def do_read(self):
         super().do_read()
-        self.do_delay(self.DELAY_SECONDS, self.do_read.__name__)
+        self.do_periodic(self.DELAY_SECONDS, self.do_read.__name__)
 
 
 class TemperatureWriter(PoupoolActor):
@@ -149,4 +151,4 @@ class TemperatureWriter(PoupoolActor):
         rounded = round(self.__reader.get_temperature_slope("temperature_pool").get(), 2)
         logger.debug(f"Temperature slope for pool is {rounded:.2f}°C/hour")
         self.__encoder.temperature_pool__slope(rounded)
-        self.do_delay(self.DELAY_SECONDS, self.do_write.__name__)
+        self.do_periodic(self.DELAY_SECONDS, self.do_write.__name__)
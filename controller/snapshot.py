@@ -0,0 +1,64 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import json
+import logging
+
+from .actor import PoupoolActor
+from .config import config
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot(PoupoolActor):
+    """Aggregate the status of each subsystem into a single retained JSON document.
+
+    Clients can load the whole state of a subsystem from /status/snapshot/<subsystem> instead of
+    subscribing to all the individual topics, which are still published.
+    """
+
+    SUBSYSTEMS = ("filtration", "tank", "heating", "disinfection", "temperature", "swim")
+    INTERVAL = int(config["snapshot", "interval"])
+
+    def __init__(self, mqtt):
+        super().__init__()
+        self.__mqtt = mqtt
+        self.__snapshots = {name: {} for name in self.SUBSYSTEMS}
+        self.__dirty = set()
+
+    def update(self, topic, value):
+        # /status/<subsystem>/<key...>
+        parts = topic.split("/")[2:]
+        snapshot = self.__snapshots.get(parts[0])
+        if snapshot is None or len(parts) < 2:
+            return
+        key = "_".join(parts[1:])
+        if snapshot.get(key) != value:
+            snapshot[key] = value
+            self.__dirty.add(parts[0])
+            if self.INTERVAL == 0:
+                self.__publish()
+
+    def do_publish(self):
+        # Changes are published at most once per interval
+        self.__publish()
+        if self.INTERVAL > 0:
+            self.do_periodic(self.INTERVAL, self.do_publish.__name__)
+
+    def __publish(self):
+        for name in sorted(self.__dirty):
+            self.__mqtt.publish.defer(f"/status/snapshot/{name}", json.dumps(self.__snapshots[name]), retain=True)
+        self.__dirty.clear()
@@ -0,0 +1,99 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import contextlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def compact(entries):
+    # Only keep the latest value of the retained topics, the order is preserved
+    latest = {entry[0]: i for i, entry in enumerate(entries) if entry[3]}
+    return [entry for i, entry in enumerate(entries) if not entry[3] or latest[entry[0]] == i]
+
+
+class Spool:
+    """Bounded append only file of the messages which could not be published.
+
+    One JSON line per message. The messages are buffered and written in batches to spare the SD
+    card. Once the file holds more than max_entries messages, it is compacted and the oldest
+    messages are dropped.
+    """
+
+    def __init__(self, path, max_entries=1000, batch=20):
+        self.__path = path
+        self.__max_entries = max_entries
+        self.__batch = batch
+        self.__buffer = []
+        self.__count = len(self.__read())
+        self.dropped = 0
+
+    def __len__(self):
+        return self.__count + len(self.__buffer)
+
+    def __read(self):
+        entries = []
+        with contextlib.suppress(FileNotFoundError), open(self.__path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Partial line written during a power loss
+                    logger.warning(f"Ignoring corrupted line in spool {self.__path}")
+        return entries
+
+    def append(self, topic, payload, qos=0, retain=False):
+        if isinstance(payload, bytes):
+            payload = payload.decode()
+        self.__buffer.append([topic, payload, qos, retain])
+        if len(self.__buffer) >= self.__batch:
+            self.flush()
+
+    def flush(self):
+        if not self.__buffer:
+            return
+        if len(self) > self.__max_entries:
+            self.__rewrite(self.__read() + self.__buffer)
+        else:
+            with open(self.__path, "a") as f:
+                f.writelines(json.dumps(entry) + "\n" for entry in self.__buffer)
+            self.__count += len(self.__buffer)
+        self.__buffer = []
+
+    def __rewrite(self, entries):
+        entries = compact(entries)
+        if len(entries) > self.__max_entries:
+            dropped = len(entries) - self.__max_entries
+            self.dropped += dropped
+            logger.warning(f"Spool full, dropping the {dropped} oldest messages")
+            entries = entries[dropped:]
+        temporary = self.__path + ".tmp"
+        with open(temporary, "w") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in entries)
+        os.replace(temporary, self.__path)
+        self.__count = len(entries)
+
+    def replay(self):
+        # Remove and return all the messages, oldest first
+        entries = compact(self.__read() + self.__buffer)
+        self.__buffer = []
+        self.__count = 0
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.__path)
+        return entries
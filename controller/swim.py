@@ -16,11 +16,10 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import logging
-from datetime import datetime, timedelta
+from datetime import timedelta
 from typing import Final
 
-# from transitions.extensions import GraphMachine as Machine
-from .actor import PoupoolActor, PoupoolModel, do_repeat
+from .actor import PoupoolActor, PoupoolModel, do_repeat, is_state
 from .config import config
 from .util import Timer
 
@@ -68,14 +67,12 @@ class Swim(PoupoolActor):
         logger.info(f"Speed for swim pump set to: {self.__speed}")
 
     def filtration_allow_swim(self):
-        actor = self.get_actor("Filtration")
-        is_opened = actor.is_overflow_normal().get() or actor.is_standby_normal().get()
-        is_opened = is_opened or actor.is_comfort().get()
+        is_opened = is_state("Filtration", "overflow_normal") or is_state("Filtration", "standby_normal")
+        is_opened = is_opened or is_state("Filtration", "comfort")
         return is_opened or self.filtration_is_wintering()
 
     def filtration_is_wintering(self):
-        actor = self.get_actor("Filtration")
-        return actor.is_wintering_waiting().get() or actor.is_wintering_stir().get()
+        return is_state("Filtration", "wintering_waiting") or is_state("Filtration", "wintering_stir")
 
     def on_enter_halt(self):
         logger.info("Entering halt state")
@@ -90,11 +87,11 @@ class Swim(PoupoolActor):
 
     def do_repeat_timed(self):
         self.__devices.get_pump("swim").speed(self.__speed)
-        self.__timer.update(datetime.now())
+        self.__timer.update(self._clock.now())
         if self.__timer.elapsed():
             self._proxy.halt.defer()
         else:
-            self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_timed.__name__)
+            self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_timed.__name__)
 
     @do_repeat()
     def on_enter_continuous(self):
@@ -103,7 +100,7 @@ class Swim(PoupoolActor):
 
     def do_repeat_continuous(self):
         self.__devices.get_pump("swim").speed(self.__speed)
-        self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_continuous.__name__)
+        self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_continuous.__name__)
 
     @do_repeat()
     def on_enter_wintering_waiting(self):
@@ -117,7 +114,7 @@ class Swim(PoupoolActor):
             if temperature is None or temperature <= Swim.WINTERING_ONLY_BELOW:
                 self._proxy.wintering_stir.defer()
                 return
-        self.do_delay(2 * 60, self.do_repeat_wintering_waiting.__name__)
+        self.do_periodic(2 * 60, self.do_repeat_wintering_waiting.__name__)
 
     def on_enter_wintering_stir(self):
         logger.info("Entering wintering stir state")
@@ -19,7 +19,6 @@ import datetime
 import logging
 from typing import Final
 
-# from transitions.extensions import GraphMachine as Machine
 from .actor import PoupoolActor, PoupoolModel, StopRepeatException, do_repeat
 from .config import config
 
@@ -27,6 +26,7 @@ logger = logging.getLogger(__name__)
 
 
 class Tank(PoupoolActor):
+    BLOCKING_IO = True
     STATE_REFRESH_DELAY = 10
 
     states: Final = ["halt", "fill", "low", "normal", "high"]
@@ -109,7 +109,7 @@ class Tank(PoupoolActor):
         if height > self.levels_too_low:
             self._proxy.low.defer()
             return
-        self.do_delay(self.STATE_REFRESH_DELAY / 2, self.do_repeat_fill.__name__)
+        self.do_periodic(self.STATE_REFRESH_DELAY / 2, self.do_repeat_fill.__name__)
 
     @do_repeat()
     def on_enter_low(self):
@@ -131,7 +131,7 @@ class Tank(PoupoolActor):
             logger.warning(f"Tank TOO LOW, stopping: {height}")
             self.get_actor("Filtration").halt.defer()
             return
-        self.do_delay(self.STATE_REFRESH_DELAY / 2, self.do_repeat_low.__name__)
+        self.do_periodic(self.STATE_REFRESH_DELAY / 2, self.do_repeat_low.__name__)
 
     @do_repeat()
     def on_enter_normal(self):
@@ -147,7 +147,7 @@ class Tank(PoupoolActor):
         if height >= self.levels["high"] + self.hysteresis:
             self._proxy.high.defer()
             return
-        self.do_delay(self.STATE_REFRESH_DELAY, self.do_repeat_normal.__name__)
+        self.do_periodic(self.STATE_REFRESH_DELAY, self.do_repeat_normal.__name__)
 
     @do_repeat()
     def on_enter_high(self):
@@ -160,4 +160,4 @@ class Tank(PoupoolActor):
         if height < self.levels["high"] - self.hysteresis:
             self._proxy.normal.defer()
         else:
-            self.do_delay(self.STATE_REFRESH_DELAY * 2, self.do_repeat_high.__name__)
+            self.do_periodic(self.STATE_REFRESH_DELAY * 2, self.do_repeat_high.__name__)
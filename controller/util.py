@@ -18,14 +18,17 @@
 import logging
 from datetime import datetime, timedelta
 
+from .clock import get_clock
+
 logger = logging.getLogger(__name__)
 
 
 class Duration:
-    def __init__(self, name):
+    def __init__(self, name, clock=None):
         self.__name = name
+        self.__clock = clock or get_clock()
         self.__total_duration = timedelta()
-        self.__start = datetime.now()
+        self.__start = self.__clock.now()
         self.__callback = None
 
     def set_callback(self, callback):
@@ -40,12 +43,12 @@ class Duration:
         return self.__total_duration
 
     def start(self, value=None):
-        value = value or datetime.now()
+        value = value or self.__clock.now()
         assert isinstance(value, datetime)
         self.__start = value
 
     def stop(self, value=None):
-        value = value or datetime.now()
+        value = value or self.__clock.now()
         assert isinstance(value, datetime)
         diff = value - self.__start
         assert diff > timedelta()
@@ -0,0 +1,114 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import itertools
+import logging
+import sys
+import threading
+import time
+import traceback
+
+import pykka
+
+from .config import config
+
+logger = logging.getLogger(__name__)
+
+
+class Watchdog:
+    """Detect actor handlers and future waits running for too long.
+
+    Each stall is reported once with the stack of the involved thread. A stall lasting more than
+    the persistent budget is considered fatal, see stalled().
+    """
+
+    def __init__(self, budget, persistent):
+        self.__budget = budget
+        self.__persistent = persistent
+        self.__waits = {}
+        self.__counter = itertools.count()
+        self.__reported = set()
+        self.__stalls = []
+        self.__alert = None
+        self.__thread = None
+        self.__stop = threading.Event()
+
+    def start(self, alert=None):
+        self.__alert = alert
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name="Watchdog", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def wait_started(self):
+        # Only track the waits when running. The dict operations are atomic, no lock needed.
+        if self.__thread is None:
+            return None
+        token = next(self.__counter)
+        self.__waits[token] = (threading.get_ident(), time.monotonic())
+        return token
+
+    def wait_finished(self, token):
+        if token is not None:
+            self.__waits.pop(token, None)
+
+    def __run(self):
+        while not self.__stop.wait(self.__budget / 2):
+            self.check()
+
+    def check(self):
+        now = time.monotonic()
+        stalls = []
+        for ref in pykka.ActorRegistry.get_all():
+            metrics = getattr(ref.actor_inbox, "metrics", None)
+            handler = metrics.handler() if metrics else None
+            if handler is None:
+                continue
+            name, since, ident = handler
+            if now - since > self.__budget:
+                stalls.append((handler, ident, f"{ref.actor_class.__name__}.{name}", now - since))
+        for token, (ident, since) in list(self.__waits.items()):
+            if now - since > self.__budget:
+                stalls.append((token, ident, "get()", now - since))
+        self.__stalls = stalls
+        keys = set()
+        for key, ident, what, duration in stalls:
+            keys.add(key)
+            if key not in self.__reported:
+                self.__report(ident, what, duration)
+        self.__reported = keys
+        return stalls
+
+    def __report(self, ident, what, duration):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        thread = names.get(ident, str(ident))
+        frame = sys._current_frames().get(ident)  # noqa: SLF001
+        stack = "".join(traceback.format_stack(frame)) if frame else "unavailable"
+        logger.critical(f"Stall detected in {what} on thread {thread} for {duration:.1f}s:\n{stack}")
+        if self.__alert:
+            self.__alert({"what": what, "thread": thread, "duration": round(duration, 1)})
+
+    def stalled(self):
+        return any(duration > self.__persistent for _, _, _, duration in self.__stalls)
+
+
+watchdog = Watchdog(float(config["watchdog", "budget"]), float(config["watchdog", "persistent"]))
@@ -20,20 +20,26 @@ import datetime
 from controller.dispatcher import Dispatcher
 from controller.mqtt import Mqtt
 
-
-class FakeDispatcher:
-    def topics(self):
-        return []
+# Our own session and no spool, like backup_settings.py, so that a running poupool is left alone
+CLIENT_ID = "poupool-defaults"
 
 
 def main():
     dispatcher = Dispatcher()
-    dispatcher.register(None, None, None, None, None, None)
+    dispatcher.register()
     remaining = list(dispatcher.topics())
     missing = []
 
-    mqtt = Mqtt.start(FakeDispatcher()).proxy()
-    mqtt.do_start()
+    # Nothing to dispatch, we only publish
+    connection = Dispatcher(routes=())
+    mqtt = Mqtt.start(connection, client_id=CLIENT_ID, spool=False, requests=False).proxy()
+    mqtt.do_start().get()
+    # Connected once the retained messages, none here, are received
+    if not connection.wait_restored(10):
+        print("Timeout while connecting to the broker")
+        mqtt.do_stop()
+        mqtt.stop()
+        return
 
     def publish(topic, value):
         settings = {"qos": 1, "retain": True}
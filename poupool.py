@@ -17,6 +17,7 @@
 
 import argparse
 import itertools
+import json
 import logging.config
 import os
 import signal
@@ -26,6 +27,7 @@ import time
 import pykka
 
 from controller.arduino import Arduino
+from controller.backend import EventLoopBackend, get_backend, set_backend
 from controller.config import as_list, config
 from controller.device import DeviceRegistry
 from controller.disinfection import Disinfection
@@ -35,10 +37,13 @@ from controller.filtration import Filtration
 from controller.heating import Heater, Heating
 from controller.lcd import Lcd
 from controller.light import Light
+from controller.monitor import Monitor
 from controller.mqtt import Mqtt
 from controller.sensor import DisinfectionReader, DisinfectionWriter, TemperatureReader, TemperatureWriter
+from controller.snapshot import Snapshot
 from controller.swim import Swim
 from controller.tank import Tank
+from controller.watchdog import watchdog
 
 
 def setup_gpio(registry, gpio):
@@ -321,9 +326,10 @@ running = True
 def main(args, devices):
     dispatcher = Dispatcher()
 
-    mqtt = Mqtt.start(dispatcher).proxy()
+    mqtt = Mqtt.start(dispatcher, args.mqtt_host, args.mqtt_port).proxy()
     lcd = Lcd.start(devices.get_device("lcd")).proxy()
-    encoder = Encoder(mqtt, lcd)
+    snapshot = Snapshot.start(mqtt).proxy()
+    encoder = Encoder(mqtt, lcd, snapshot=snapshot)
 
     # Temperature
     sensors = [
@@ -372,6 +378,11 @@ def main(args, devices):
     disinfection_reader.do_read.defer()
     # disinfection_writer is started/stopped by the disinfection actor
     lcd.do_start.defer()
+    snapshot.do_publish.defer()
+
+    # Publish the mailbox and handler metrics of all the actors and the ones of the settings
+    monitor = Monitor.start(mqtt, dispatcher).proxy()
+    monitor.do_publish.defer()
 
     # Monitor the main actors. If one dies, we will exit the main thread.
     main_actors = [filtration.actor_ref, tank.actor_ref, disinfection.actor_ref, heating.actor_ref]
@@ -382,8 +393,14 @@ def main(args, devices):
         running = False
         time.sleep(2)
 
+    # Report stalled actors. A persistent stall is handled like a dead actor.
+    watchdog.start(lambda alert: mqtt.publish.defer("/status/watchdog/alert", json.dumps(alert)))
+
     # Wait forever or until SIGTERM is caught
     while running and all(actor.is_alive() for actor in main_actors):
+        if watchdog.stalled():
+            logging.critical("Persistent stall detected, exiting")
+            break
         time.sleep(0.5)
 
     # If possible try to stop the filtration actor which in turn will stop others.
@@ -393,6 +410,19 @@ def main(args, devices):
     return 1 if running else 0
 
 
+def stop_actors(timeout):
+    # A stalled actor never handles its stop message, we must not wait for it forever. Return
+    # whether all the actors stopped.
+    stopped = True
+    for ref in reversed(pykka.ActorRegistry.get_all()):
+        try:
+            ref.stop(timeout=timeout)
+        except pykka.Timeout:
+            logging.critical(f"Unable to stop {ref.actor_class.__name__}")
+            stopped = False
+    return stopped
+
+
 def sigterm_handler(signo, stack_frame):
     global running
     running = False
@@ -405,6 +435,13 @@ if __name__ == "__main__":
     parser.add_argument("--test-mode", action="store_true", help="test mode for the hardware")
     parser.add_argument("--fake-devices", action="store_true", help="fake the underlying hardware")
     parser.add_argument("--test-start", action="store_true", help="test application start")
+    parser.add_argument("--mqtt-host", action="store", help="MQTT broker host, overrides the configuration")
+    parser.add_argument("--mqtt-port", action="store", type=int, help="MQTT broker port, overrides the configuration")
+    parser.add_argument(
+        "--event-loop",
+        action="store_true",
+        help="run the actors on a shared event loop thread and the blocking ones on a thread pool",
+    )
     args = parser.parse_args()
 
     # Setup logging
@@ -418,6 +455,9 @@ if __name__ == "__main__":
     # Handle SIGINT. It is ctrl+c
     signal.signal(signal.SIGINT, sigterm_handler)
 
+    if args.event_loop:
+        set_backend(EventLoopBackend())
+
     devices = DeviceRegistry()
     try:
         if args.fake_devices:
@@ -429,7 +469,9 @@ if __name__ == "__main__":
         else:
             sys.exit(main(args, devices))
     finally:
-        pykka.ActorRegistry.stop_all()
+        watchdog.stop()
+        stopped = stop_actors(float(config["watchdog", "stop_timeout"]))
+        get_backend().shutdown()
         # Turn off all the devices on exit
         for device in itertools.chain(devices.get_pumps(), devices.get_valves()):
             device.off()
@@ -441,3 +483,7 @@ if __name__ == "__main__":
             import RPi.GPIO as GPIO
 
             GPIO.cleanup()
+        if not stopped:
+            # The thread of the stalled actor would keep us running
+            logging.shutdown()
+            os._exit(1)
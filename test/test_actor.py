@@ -15,12 +15,14 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import threading
 import time
+from typing import Final
 
 import pykka
 import pytest
 
-from controller.actor import PoupoolActor
+from controller.actor import PoupoolActor, PoupoolModel, do_repeat, get_state, is_state
 
 
 class MyPoupoolActor(PoupoolActor):
@@ -47,6 +49,11 @@ class MyPoupoolActor(PoupoolActor):
         self.run += 1
         self.do_delay(1, self.do_run.__name__)
 
+    def do_sleep_and_cancel(self):
+        # The timer fires while we are busy, its message is already in the inbox when cancelling
+        time.sleep(0.5)
+        self.do_cancel()
+
 
 @pytest.fixture
 def poupool_actor():
@@ -96,3 +103,131 @@ class TestPoupoolActor:
         time.sleep(2)
         assert poupool_actor.long.get() == 1
         assert poupool_actor.cancelled.get() == 1
+
+    def test_cancel_fired_timer(self, poupool_actor):
+        poupool_actor.do_delay(0.1, "do_single")
+        poupool_actor.do_sleep_and_cancel()
+        time.sleep(0.5)
+        assert poupool_actor.single.get() == 0
+
+    def test_timer_metrics(self, poupool_actor):
+        poupool_actor.do_delay(0.1, "do_single")
+        time.sleep(0.3)
+        methods = poupool_actor.actor_ref.actor_inbox.metrics.summary()["methods"]
+        assert methods["do_single"]["duration"]["count"] == 1
+        assert "do_timer" not in methods
+
+
+class OtherPoupoolActor(PoupoolActor):
+    pass
+
+
+class TestGetActor:
+    def test_get_actor(self, poupool_actor):
+        other = OtherPoupoolActor.start().proxy()
+        actor = poupool_actor.get_actor("OtherPoupoolActor").get()
+        assert actor.actor_ref.actor_urn == other.actor_ref.actor_urn
+        # Cached per actor
+        assert poupool_actor.get_actor("OtherPoupoolActor").get() is actor
+
+    def test_get_actor_stopped(self, poupool_actor):
+        other = OtherPoupoolActor.start()
+        assert poupool_actor.get_actor("OtherPoupoolActor").get() is not None
+        other.stop()
+        assert poupool_actor.get_actor("OtherPoupoolActor").get() is None
+        # A new instance is found again
+        other = OtherPoupoolActor.start()
+        actor = poupool_actor.get_actor("OtherPoupoolActor").get()
+        assert actor.actor_ref.actor_urn == other.actor_urn
+
+    def test_get_actor_not_found(self, poupool_actor, caplog):
+        assert poupool_actor.get_actor("Unknown").get() is None
+        assert "Actor Unknown not found!!!" in caplog.text
+
+
+class StateActor(PoupoolActor):
+    states: Final = ["halt", {"name": "run", "initial": "slow", "children": ["slow", "fast"]}]
+
+    def __init__(self):
+        super().__init__()
+        self.__machine = PoupoolModel(model=self, states=StateActor.states, initial="halt")
+        self.__machine.add_transition("run", "halt", "run")
+        self.__machine.add_transition("fast", "run_slow", "run_fast")
+
+    def do_crash(self):
+        raise RuntimeError("crash")
+
+
+class RepeatActor(PoupoolActor):
+    states: Final = ["halt", "run"]
+
+    def __init__(self):
+        super().__init__()
+        self.__machine = PoupoolModel(model=self, states=RepeatActor.states, initial="halt")
+        self.__machine.add_transition("run", "halt", "run")
+        self.__machine.add_transition("halt", "run", "halt")
+        self.repeated = 0
+
+    def run_and_wait(self, event):
+        self.run()
+        # The halt is sent while the first repeat is waiting in the inbox
+        event.wait()
+
+    @do_repeat()
+    def on_enter_run(self):
+        pass
+
+    def do_repeat_run(self):
+        self.repeated += 1
+        self.do_delay(0.05, "do_repeat_run")
+
+
+@pytest.fixture
+def repeat_actor():
+    yield RepeatActor.start().proxy()
+    pykka.ActorRegistry.stop_all()
+
+
+class TestRepeat:
+    def test_repeat(self, repeat_actor):
+        repeat_actor.run().get()
+        time.sleep(0.2)
+        assert repeat_actor.repeated.get() >= 2
+
+    def test_halt_before_first_repeat(self, repeat_actor):
+        event = threading.Event()
+        repeat_actor.run_and_wait.defer(event)
+        time.sleep(0.1)
+        # Urgent, handled before the first repeat
+        repeat_actor.halt.defer()
+        event.set()
+        time.sleep(0.2)
+        assert repeat_actor.state.get() == "halt"
+        assert repeat_actor.repeated.get() == 0
+
+
+class TestStateMirror:
+    def test_published_on_transition(self):
+        actor = StateActor.start().proxy()
+        assert get_state("StateActor") == "halt"
+        assert is_state("StateActor", "halt")
+        # Dropped from the inbox by a halt
+        assert actor.actor_ref.actor_inbox.triggers == {"run", "fast"}
+        actor.run().get()
+        assert get_state("StateActor") == "run_slow"
+        assert not is_state("StateActor", "run")
+        assert is_state("StateActor", "run", allow_substates=True)
+        actor.fast().get()
+        assert is_state("StateActor", "run_fast")
+        actor.actor_ref.stop()
+        assert get_state("StateActor") is None
+        assert not is_state("StateActor", "halt")
+
+    def test_cleared_on_failure(self, poupool_actor, caplog):
+        actor = StateActor.start().proxy()
+        assert get_state("StateActor") == "halt"
+        actor.do_crash.defer()
+        assert actor.actor_ref.actor_stopped.wait(2)
+        assert get_state("StateActor") is None
+        assert poupool_actor.get_actor("StateActor").get() is None
+        assert "Actor StateActor not found!!!" in caplog.text
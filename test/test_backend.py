@@ -0,0 +1,253 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import contextlib
+import threading
+import time
+
+import pykka
+import pytest
+
+from controller.actor import PoupoolActor, defer_coalesced
+from controller.backend import EventLoopBackend, ThreadingBackend, get_backend, set_backend
+
+
+@pytest.fixture
+def backend():
+    backend = EventLoopBackend()
+    set_backend(backend)
+    yield backend
+    pykka.ActorRegistry.stop_all()
+    backend.shutdown()
+    set_backend(ThreadingBackend())
+
+
+class Counter(PoupoolActor):
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.started = False
+
+    def on_start(self):
+        self.started = True
+
+    def increment(self):
+        self.count += 1
+        return self.count
+
+    def thread(self):
+        return threading.current_thread().name
+
+    def fail(self):
+        raise ValueError("failed")
+
+
+class BlockingCounter(Counter):
+    BLOCKING_IO = True
+
+    def slow(self):
+        time.sleep(0.5)
+        return self.increment()
+
+
+class Forwarder(PoupoolActor):
+    def __init__(self, target):
+        super().__init__()
+        self.__target = target
+
+    def forward(self):
+        # Asking an actor running on the same event loop
+        return self.__target.increment().get()
+
+    def forward_slow(self):
+        return self.__target.slow().get()
+
+
+class Caller(PoupoolActor):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.callee = None
+
+    def outer(self):
+        self.calls.append("outer")
+        with contextlib.suppress(pykka.Timeout):
+            self.callee.call_back().get()
+        self.calls.append("outer done")
+
+    def inner(self):
+        self.calls.append("inner")
+
+
+class Callee(PoupoolActor):
+    def __init__(self, caller):
+        super().__init__()
+        self.__caller = caller
+
+    def call_back(self):
+        # The caller is busy waiting for us
+        self.__caller.inner().get(timeout=0.2)
+
+
+class Busy(PoupoolActor):
+    def __init__(self, event):
+        super().__init__()
+        self.__event = event
+        self.calls = []
+
+    def block(self):
+        self.__event.wait()
+
+    def poll(self, value=None):
+        self.calls.append("poll" if value is None else value)
+
+    def halt(self):
+        self.calls.append("halt")
+
+
+class TestEventLoopBackend:
+    def test_ask_and_tell(self, backend):
+        counter = Counter.start().proxy()
+        for _ in range(100):
+            counter.increment.defer()
+        assert counter.increment().get() == 101
+        assert counter.started.get()
+        assert counter.thread().get() == "EventLoop"
+
+    def test_blocking_actor_in_executor(self, backend):
+        counter = BlockingCounter.start().proxy()
+        assert counter.increment().get() == 1
+        assert counter.thread().get().startswith("BlockingActor")
+
+    def test_ask_from_loop(self, backend):
+        counter = Counter.start().proxy()
+        forwarder = Forwarder.start(counter).proxy()
+        assert forwarder.forward().get(timeout=2) == 1
+        blocking = BlockingCounter.start().proxy()
+        forwarder = Forwarder.start(blocking).proxy()
+        assert forwarder.forward().get(timeout=2) == 1
+
+    def test_ask_blocking_from_loop(self, backend):
+        # The loop keeps running the other actors while one waits on a slow blocking actor
+        counter = Counter.start().proxy()
+        forwarder = Forwarder.start(BlockingCounter.start().proxy()).proxy()
+        slow = forwarder.forward_slow()
+        time.sleep(0.1)
+        start = time.monotonic()
+        assert counter.increment().get(timeout=2) == 1
+        assert time.monotonic() - start < 0.2
+        assert slow.get(timeout=2) == 1
+
+    def test_not_reentrant(self, backend):
+        caller = Caller.start().proxy()
+        caller.callee = Callee.start(caller).proxy()
+        caller.outer().get(timeout=2)
+        # Like with a thread per actor, inner waits for outer to finish
+        assert caller.calls.get() == ["outer", "outer done", "inner"]
+
+    def test_exception(self, backend):
+        counter = Counter.start().proxy()
+        with pytest.raises(ValueError, match="failed"):
+            counter.fail().get()
+        assert counter.increment().get() == 1
+
+    def test_stop(self, backend):
+        counter = Counter.start()
+        counter.stop()
+        assert not counter.is_alive()
+        with pytest.raises(pykka.ActorDeadError):
+            counter.proxy().increment().get()
+
+    def test_no_thread_per_actor(self, backend):
+        before = threading.active_count()
+        actors = [Counter.start().proxy() for _ in range(20)]
+        assert [a.increment().get() for a in actors] == [1] * 20
+        assert threading.active_count() == before
+
+    def test_default_backend(self):
+        assert isinstance(get_backend(), ThreadingBackend)
+
+
+class TestUrgent:
+    @pytest.fixture(params=[ThreadingBackend, EventLoopBackend])
+    def busy(self, request):
+        backend = request.param()
+        set_backend(backend)
+        event = threading.Event()
+        yield Busy.start(event).proxy(), event
+        event.set()
+        pykka.ActorRegistry.stop_all()
+        backend.shutdown()
+        set_backend(ThreadingBackend())
+
+    def test_halt_first(self, busy):
+        actor, event = busy
+        actor.block.defer()
+        for _ in range(50):
+            actor.poll.defer()
+        actor.halt.defer()
+        event.set()
+        calls = actor.calls.get()
+        assert calls[0] == "halt"
+        assert calls.count("poll") == 50
+        urgent = actor.actor_ref.actor_inbox.metrics.summary()["urgent"]
+        assert urgent["count"] == 1
+        assert urgent["overtaken"] >= 50
+
+    def test_coalesced(self, busy):
+        actor, event = busy
+        actor.block.defer()
+        defer_coalesced(actor, "a", "poll", 0)
+        actor.poll.defer()
+        for value in range(1, 10):
+            defer_coalesced(actor, "a", "poll", value)
+            defer_coalesced(actor, "b", "poll", -value)
+        event.set()
+        # The newest call goes to the tail
+        assert actor.calls.get() == ["poll", 9, -9]
+        inbox = actor.actor_ref.actor_inbox
+        assert inbox.metrics.summary()["methods"]["poll"]["coalesced"] == 17
+        assert inbox.metrics.summary()["methods"]["poll"]["depth"] == 0
+        assert inbox.unfinished_tasks == 0
+
+    def test_urgent_in_order(self, busy):
+        actor, event = busy
+        actor.block.defer()
+        actor.halt.defer()
+        actor.poll.defer()
+        actor.halt.defer()
+        event.set()
+        assert actor.calls.get() == ["halt", "halt", "poll"]
+
+    def test_halt_cancels_triggers(self, busy):
+        actor, event = busy
+        inbox = actor.actor_ref.actor_inbox
+        # Like a trigger of the state machine
+        inbox.triggers.add("poll")
+        actor.block.defer()
+        actor.poll.defer()
+        waiting = actor.poll()
+        defer_coalesced(actor, "a", "poll", 1)
+        actor.halt.defer()
+        # Sent after the halt, kept
+        actor.poll.defer(2)
+        event.set()
+        assert waiting.get(timeout=2) is False
+        assert actor.calls.get() == ["halt", 2]
+        poll = inbox.metrics.summary()["methods"]["poll"]
+        assert (poll["cancelled"], poll["depth"]) == (3, 0)
+        assert inbox.unfinished_tasks == 0
@@ -0,0 +1,147 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import itertools
+import time
+from datetime import datetime, timedelta
+
+import pykka
+import pytest
+
+from controller.actor import PoupoolActor, is_quiescent
+from controller.clock import RealClock, VirtualClock, set_clock
+
+START = datetime(1981, 5, 30)
+
+
+@pytest.fixture
+def virtual_clock():
+    clock = VirtualClock(START, idle=is_quiescent)
+    set_clock(clock)
+    yield clock
+    pykka.ActorRegistry.stop_all()
+    set_clock(RealClock())
+
+
+class HourlyActor(PoupoolActor):
+    def __init__(self):
+        super().__init__()
+        self.runs = []
+
+    def do_run(self):
+        self.runs.append(self._clock.now())
+        if len(self.runs) < 24:
+            self.do_delay(3600, self.do_run.__name__)
+
+
+class PeriodicActor(PoupoolActor):
+    def __init__(self, duration, policy=PoupoolActor.SKIP):
+        super().__init__()
+        self.duration = duration
+        self.policy = policy
+        self.runs = []
+
+    def do_run(self):
+        self.runs.append(self._clock.monotonic())
+        # Work taking some time, the period must not drift because of it
+        self._clock.sleep(self.duration)
+        if len(self.runs) < 5:
+            self.do_periodic(60, self.do_run.__name__, self.policy)
+
+
+class CancelledActor(PeriodicActor):
+    def do_run(self):
+        super().do_run()
+        # Like a transition happening after the timer was re-armed
+        if len(self.runs) == 2:
+            self._proxy.do_cancel.defer()
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class TestVirtualClock:
+    def test_advance(self):
+        clock = VirtualClock(START)
+        assert clock.now() == START
+        assert clock.monotonic() == 0
+        clock.advance(90)
+        assert clock.now() == START + timedelta(seconds=90)
+        assert clock.time() == START.timestamp() + 90
+        clock.sleep(10)
+        assert clock.monotonic() == 100
+
+    def test_duration(self):
+        from controller.util import Duration
+
+        clock = VirtualClock(START)
+        duration = Duration("test", clock)
+        duration.start()
+        clock.advance(3600)
+        duration.stop()
+        assert duration.duration == timedelta(hours=1)
+
+    def test_actor_day_in_virtual_time(self, virtual_clock):
+        actor = HourlyActor.start().proxy()
+        actor.do_run.defer()
+        wait_until(lambda: len(actor.runs.get()) == 24)
+        runs = actor.runs.get()
+        assert runs[0] == START
+        assert runs[-1] == START + timedelta(hours=23)
+        assert all(b - a == timedelta(hours=1) for a, b in itertools.pairwise(runs))
+
+
+class TestPeriodic:
+    def run(self, duration, policy=PoupoolActor.SKIP):
+        actor = PeriodicActor.start(duration, policy).proxy()
+        actor.do_periodic(60, "do_run", policy)
+        wait_until(lambda: len(actor.runs.get()) == 5)
+        metrics = actor.actor_ref.actor_inbox.metrics.summary()
+        return actor.runs.get(), metrics["methods"]["do_run"]
+
+    def test_fixed_rate(self, virtual_clock):
+        runs, metrics = self.run(20)
+        assert runs == [60, 120, 180, 240, 300]
+        assert metrics["jitter"]["count"] == 5
+        assert metrics["jitter"]["max"] == 0
+        assert metrics["skipped"] == 0
+        # Recorded under the handler, not do_tick
+        assert metrics["duration"]["count"] == 5
+
+    def test_skip(self, virtual_clock):
+        runs, metrics = self.run(90)
+        # The tick falling during the handler is dropped and we stay on the same grid
+        assert runs == [60, 180, 300, 420, 540]
+        assert metrics["skipped"] == 4
+
+    def test_catch_up(self, virtual_clock):
+        runs, metrics = self.run(90, PoupoolActor.CATCH_UP)
+        # The missed ticks are run as soon as possible
+        assert runs == [60, 150, 240, 330, 420]
+        assert metrics["skipped"] == 0
+        assert metrics["jitter"]["max"] == 120
+
+    def test_cancel(self, virtual_clock):
+        actor = CancelledActor.start(0).proxy()
+        actor.do_periodic(60, "do_run")
+        wait_until(lambda: len(actor.runs.get()) == 2)
+        time.sleep(0.1)
+        assert actor.runs.get() == [60, 120]
@@ -0,0 +1,329 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import copy
+import time
+from unittest import mock
+
+import pytest
+
+from controller.dispatcher import LEADING, ROUTES, TRAILING, Dispatcher, Route
+
+
+def immediate(route):
+    route = copy.copy(route)
+    route.window = 0
+    return route
+
+
+@pytest.fixture
+def actors():
+    return [mock.Mock() for _ in range(8)]
+
+
+@pytest.fixture
+def dispatcher(actors):
+    dispatcher = Dispatcher([immediate(route) for route in ROUTES])
+    dispatcher.register(*actors)
+    return dispatcher
+
+
+class TestRoute:
+    def test_expand(self):
+        route = Route("/a/{x}/{y}", "actor", "{x}_{y}", "int", params={"x": ("b", "c"), "y": ("d",)})
+        assert list(route.expand()) == [("/a/b/d", "b_d"), ("/a/c/d", "c_d")]
+
+    def test_edges(self):
+        windows = {route.topic: (route.edge, route.window) for route in ROUTES}
+        assert windows["/settings/mode"][0] == LEADING
+        assert windows["/settings/heating/enable"][0] == LEADING
+        assert windows["/settings/filtration/speed/eco"][0] == TRAILING
+        assert windows["/status/filtration/duration"][1] == 0
+
+    def test_methods_bound_once(self):
+        lookups = []
+
+        class Actor:
+            def __getattr__(self, name):
+                lookups.append(name)
+                return mock.Mock()
+
+        dispatcher = Dispatcher()
+        dispatcher.register(None, None, Actor(), None, None, None, None, None)
+        assert sorted(lookups) == ["continuous", "halt", "speed", "timed", "timer"]
+        dispatcher.dispatch("/settings/swim/mode", b"timed")
+        dispatcher.dispatch("/settings/swim/speed", b"50")
+        assert len(lookups) == 5
+
+
+class TestDispatcher:
+    @pytest.mark.parametrize(
+        ("topic", "payload", "index", "method", "value"),
+        [
+            ("/settings/filtration/duration", b"3600.0", 0, "duration", 3600),
+            ("/settings/filtration/tank_percentage", b"0.25", 0, "tank_percentage", 0.25),
+            ("/settings/filtration/backwash/rinse_duration", b"60", 0, "backwash_rinse_duration", 60),
+            ("/settings/tank/force_empty", b"ON", 1, "force_empty", True),
+            ("/settings/heating/enable", b"0", 5, "enable", False),
+            ("/settings/disinfection/orp/enable", b"1", 6, "orp_enable", True),
+            ("/settings/disinfection/ph/pterm", b"1.5", 6, "ph_pterm", 1.5),
+            ("/status/filtration/backwash/last", b"yesterday", 0, "backwash_last", "yesterday"),
+            ("/status/water/counter", b"1234", 7, "restore_water_counter", 1234),
+        ],
+    )
+    def test_value(self, dispatcher, actors, topic, payload, index, method, value):
+        dispatcher.dispatch(topic, payload)
+        getattr(actors[index], method).defer.assert_called_once_with(value)
+
+    def test_mode(self, dispatcher, actors):
+        dispatcher.dispatch("/settings/mode", b"eco")
+        dispatcher.dispatch("/settings/light/mode", b"on")
+        actors[0].eco.defer.assert_called_once_with()
+        actors[3].on.defer.assert_called_once_with()
+
+    @pytest.mark.parametrize(
+        ("topic", "payload"),
+        [
+            ("/settings/mode", b"party"),
+            ("/settings/filtration/period", b"11"),
+            ("/settings/filtration/period", b"abc"),
+            ("/settings/heating/enable", b"yes"),
+            ("/status/water/counter", b"-1"),
+            ("/settings/heating/setpoint", b"\xff"),
+            ("/settings/heating/setpoint", b"nan"),
+            ("/settings/disinfection/ph/pterm", b"inf"),
+            ("/status/water/counter", b"inf"),
+        ],
+    )
+    def test_invalid(self, dispatcher, actors, topic, payload):
+        dispatcher.dispatch(topic, payload)
+        for actor in actors:
+            assert not [call for call in actor.mock_calls if call[0].endswith("defer")]
+
+    def test_unknown(self, dispatcher):
+        dispatcher.dispatch("/settings/unknown", b"1")
+
+    def test_once(self, dispatcher, actors):
+        dispatcher.dispatch("/status/filtration/duration", b"100")
+        dispatcher.dispatch("/status/filtration/duration", b"200")
+        actors[0].restore_duration.defer.assert_called_once_with(100)
+        assert "/status/filtration/duration" not in dispatcher.topics()
+
+
+class TestDebounce:
+    WINDOW = 0.1
+
+    @pytest.fixture
+    def filtration(self):
+        filtration = mock.Mock()
+        dispatcher = Dispatcher(
+            [
+                Route("/mode", "filtration", None, "enum", ("halt", "eco", "standby"), window=self.WINDOW),
+                Route("/speed", "filtration", "speed_eco", "int", (1, 3), window=self.WINDOW),
+            ]
+        )
+        dispatcher.register(filtration, *[None] * 7)
+        return dispatcher, filtration
+
+    def test_trailing(self, filtration):
+        dispatcher, filtration = filtration
+        for value in (b"1", b"2", b"3", b"2"):
+            dispatcher.dispatch("/speed", value)
+        assert not filtration.speed_eco.defer.called
+        time.sleep(self.WINDOW * 3)
+        # Only the settled value reaches the actor
+        filtration.speed_eco.defer.assert_called_once_with(2)
+
+    def test_trailing_invalid(self, filtration):
+        dispatcher, filtration = filtration
+        dispatcher.dispatch("/speed", b"2")
+        dispatcher.dispatch("/speed", b"9")
+        time.sleep(self.WINDOW * 3)
+        filtration.speed_eco.defer.assert_called_once_with(2)
+
+    def test_leading(self, filtration):
+        dispatcher, filtration = filtration
+        dispatcher.dispatch("/mode", b"eco")
+        filtration.eco.defer.assert_called_once_with()
+        dispatcher.dispatch("/mode", b"standby")
+        dispatcher.dispatch("/mode", b"eco")
+        dispatcher.dispatch("/mode", b"standby")
+        assert not filtration.standby.defer.called
+        time.sleep(self.WINDOW * 3)
+        # The last mode is applied at the end of the window
+        filtration.standby.defer.assert_called_once_with()
+        filtration.eco.defer.assert_called_once_with()
+
+    def test_leading_back(self, filtration):
+        dispatcher, filtration = filtration
+        dispatcher.dispatch("/mode", b"eco")
+        dispatcher.dispatch("/mode", b"standby")
+        dispatcher.dispatch("/mode", b"eco")
+        time.sleep(self.WINDOW * 3)
+        # Back to the mode already applied, nothing to do
+        filtration.eco.defer.assert_called_once_with()
+        assert not filtration.standby.defer.called
+        # Quiet again, the next change is applied right away
+        dispatcher.dispatch("/mode", b"standby")
+        filtration.standby.defer.assert_called_once_with()
+
+    def test_halt_right_away(self, filtration):
+        dispatcher, filtration = filtration
+        dispatcher.dispatch("/mode", b"eco")
+        dispatcher.dispatch("/mode", b"standby")
+        dispatcher.dispatch("/mode", b"halt")
+        # Not delayed by the window and the pending standby is dropped
+        filtration.halt.defer.assert_called_once_with()
+        time.sleep(self.WINDOW * 3)
+        assert not filtration.standby.defer.called
+        assert [call[0] for call in filtration.mock_calls] == ["eco.defer", "halt.defer"]
+
+
+class TestRestore:
+    def test_batch(self, dispatcher, actors):
+        filtration = actors[0]
+        dispatcher.begin_restore()
+        dispatcher.dispatch("/settings/mode", b"standby")
+        dispatcher.dispatch("/settings/filtration/speed/eco", b"2")
+        dispatcher.dispatch("/settings/mode", b"eco")
+        dispatcher.dispatch("/settings/swim/speed", b"50")
+        dispatcher.dispatch("/status/filtration/duration", b"100")
+        assert filtration.mock_calls == []
+        assert dispatcher.end_restore()
+        # The latest value of each topic, the mode last
+        assert [call[0] for call in filtration.mock_calls] == ["speed_eco.defer", "restore_duration.defer", "eco.defer"]
+        actors[2].speed.defer.assert_called_once_with(50)
+        assert "/status/filtration/duration" not in dispatcher.topics()
+        assert dispatcher.wait_restored(0)
+        assert dispatcher.restore_duration >= 0
+        assert not dispatcher.end_restore()
+        # Back to normal
+        dispatcher.dispatch("/settings/mode", b"halt")
+        filtration.halt.defer.assert_called_once_with()
+
+    def test_complete(self, actors):
+        routes = (
+            Route("/mode", "filtration", None, "enum", ("halt", "eco")),
+            Route("/speed", "filtration", "speed_eco", "int", (1, 3)),
+        )
+        dispatcher = Dispatcher(routes)
+        dispatcher.register(*actors)
+        dispatcher.begin_restore()
+        dispatcher.dispatch("/speed", b"2")
+        assert dispatcher.missing() == ["/mode"]
+        assert not dispatcher.wait_restored(0)
+        # Ended by the last expected topic without waiting for the marker
+        dispatcher.dispatch("/mode", b"eco")
+        assert dispatcher.wait_restored(0)
+        assert dispatcher.restore_complete
+        assert dispatcher.missing() == []
+        assert [call[0] for call in actors[0].mock_calls] == ["speed_eco.defer", "eco.defer"]
+        assert not dispatcher.end_restore()
+
+    def test_timeout(self, dispatcher, actors):
+        dispatcher.begin_restore()
+        dispatcher.dispatch("/settings/mode", b"eco")
+        assert dispatcher.end_restore(complete=False)
+        assert not dispatcher.restore_complete
+        assert "/settings/mode" not in dispatcher.missing()
+        assert "/settings/swim/speed" in dispatcher.missing()
+        actors[0].eco.defer.assert_called_once_with()
+
+
+class TestMetrics:
+    def test_outcomes(self, dispatcher):
+        dispatcher.dispatch("/settings/filtration/period", b"3")
+        dispatcher.dispatch("/settings/filtration/period", b"11")
+        dispatcher.dispatch("/settings/filtration/period", b"abc")
+        dispatcher.dispatch("/settings/mode", b"party")
+        dispatcher.dispatch("/settings/unknown", b"1")
+        dispatcher.dispatch("/status/filtration/duration", b"100")
+        period = dispatcher.metrics.route("/settings/filtration/period")
+        assert (period["accepted"], period["rejected"], period["errors"]) == (1, 1, 1)
+        assert period["max_rate"] == 3
+        assert period["duration"]["count"] == 3
+        assert dispatcher.metrics.route("/settings/mode")["rejected"] == 1
+        assert dispatcher.metrics.route("/status/filtration/duration")["consumed"] == 1
+        assert dispatcher.metrics.route("/settings/unknown") is None
+        assert dispatcher.metrics.summary()["unknown"] == 1
+
+    def test_coalesced(self, actors):
+        dispatcher = Dispatcher([Route("/speed", "filtration", "speed_eco", "int", (1, 3), window=60)])
+        dispatcher.register(*actors)
+        for value in (b"1", b"2", b"3"):
+            dispatcher.dispatch("/speed", value)
+        assert dispatcher.metrics.route("/speed")["coalesced"] == 2
+
+
+class TestBulk:
+    def test_export(self, dispatcher):
+        dispatcher.dispatch("/settings/mode", b"eco")
+        dispatcher.dispatch("/settings/filtration/period", b"3")
+        dispatcher.dispatch("/settings/filtration/period", b"42")
+        dispatcher.dispatch("/status/filtration/duration", b"100")
+        dispatcher.dispatch("/status/water/counter", b"1234")
+        # Only the valid values of the exported routes
+        assert dispatcher.export() == {
+            "version": 1,
+            "settings": {"/settings/mode": "eco", "/settings/filtration/period": "3", "/status/water/counter": "1234"},
+        }
+
+    def test_import(self, dispatcher, actors):
+        filtration = actors[0]
+        dispatcher.dispatch("/settings/filtration/duration", b"3600")
+        filtration.reset_mock()
+        document = {
+            "version": 1,
+            "settings": {
+                "/settings/mode": "standby",
+                "/settings/filtration/speed/eco": 2,
+                "/settings/filtration/duration": "3600",
+                "/settings/heating/enable": True,
+            },
+        }
+        applied = dispatcher.import_settings(document)
+        assert applied == [
+            ("/settings/mode", "standby"),
+            ("/settings/filtration/speed/eco", "2"),
+            ("/settings/filtration/duration", "3600"),
+            ("/settings/heating/enable", "1"),
+        ]
+        # The unchanged duration is skipped and the mode comes last
+        assert [call[0] for call in filtration.mock_calls] == ["speed_eco.defer", "standby.defer"]
+        actors[5].enable.defer.assert_called_once_with(True)
+        assert dispatcher.export()["settings"]["/settings/filtration/speed/eco"] == "2"
+        # Published back by the broker
+        dispatcher.dispatch("/settings/mode", b"standby")
+        filtration.standby.defer.assert_called_once_with()
+        dispatcher.dispatch("/settings/mode", b"eco")
+        filtration.eco.defer.assert_called_once_with()
+
+    @pytest.mark.parametrize(
+        ("document", "match"),
+        [
+            ({"version": 2, "settings": {}}, "version 1 expected"),
+            ({"version": 1}, "No settings"),
+            ({"version": 1, "settings": {"/settings/mode": "eco", "/settings/unknown": "1"}}, "/settings/unknown"),
+            ({"version": 1, "settings": {"/settings/mode": "eco", "/settings/filtration/period": "42"}}, "42"),
+            ({"version": 1, "settings": {"/status/filtration/duration": "100"}}, "/status/filtration/duration"),
+        ],
+    )
+    def test_import_invalid(self, dispatcher, actors, document, match):
+        with pytest.raises(ValueError, match=match):
+            dispatcher.import_settings(document)
+        # All or nothing
+        assert actors[0].mock_calls == []
+        assert dispatcher.export()["settings"] == {}
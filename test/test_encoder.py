@@ -17,6 +17,10 @@
 
 import pytest
 
+from controller.clock import RealClock, VirtualClock, set_clock
+from controller.dispatcher import ROUTES
+from controller.encoder import STATUS_TOPICS, Encoder, PublishPolicy
+
 
 @pytest.fixture
 def mqtt(mocker):
@@ -30,34 +34,119 @@ def lcd(mocker):
 
 @pytest.fixture
 def encoder(mqtt, lcd):
-    from controller.encoder import Encoder
-
     return Encoder(mqtt, lcd)
 
 
+@pytest.fixture
+def clock():
+    clock = VirtualClock()
+    set_clock(clock)
+    yield clock
+    set_clock(RealClock())
+
+
+@pytest.fixture
+def policy(clock):
+    return PublishPolicy(600, {"temperature_pool": 0.1, "disinfection_orp_value": 5})
+
+
+def told(actor):
+    # Key and call of the coalesced message sent to the actor
+    actor.actor_ref.tell.assert_called_once()
+    coalesced = actor.actor_ref.tell.call_args.args[0]
+    message = coalesced.message
+    return coalesced.key, message.attr_path[-1], message.args, message.kwargs
+
+
 class TestEncoder:
     def test_publish_int(self, mqtt, lcd, encoder):
         value = 10
         encoder.foo(value)
-        mqtt.publish.defer.assert_called_once_with("/status/foo", value)
-        lcd.update.defer.assert_called_once_with("foo", value)
+        assert told(mqtt) == (("publish", "/status/foo"), "publish", ("/status/foo", value), {})
+        assert told(lcd) == (("update", "foo"), "update", ("foo", value), {})
 
     def test_publish_with_underscore(self, mqtt, lcd, encoder):
         value = "foobar"
         encoder.foo_bar(value)
-        mqtt.publish.defer.assert_called_once_with("/status/foo/bar", value)
-        lcd.update.defer.assert_called_once_with("foo_bar", value)
+        assert told(mqtt) == (("publish", "/status/foo/bar"), "publish", ("/status/foo/bar", value), {})
+        assert told(lcd) == (("update", "foo_bar"), "update", ("foo_bar", value), {})
 
     def test_publish_with_double_underscore(self, mqtt, lcd, encoder):
         value = "foobar"
         encoder.foo_bar__cat(value)
-        mqtt.publish.defer.assert_called_once_with("/status/foo/bar_cat", value)
-        lcd.update.defer.assert_called_once_with("foo_bar__cat", value)
+        assert told(mqtt) == (("publish", "/status/foo/bar_cat"), "publish", ("/status/foo/bar_cat", value), {})
+        assert told(lcd) == (("update", "foo_bar__cat"), "update", ("foo_bar__cat", value), {})
 
     def test_publish_with_kwargs(self, mqtt, lcd, encoder):
         value = "foobar"
         kwargs = (1, 2)
         encoder.foo_bar(value, kw=kwargs)
-        mqtt.publish.defer.assert_called_once_with("/status/foo/bar", value, kw=kwargs)
+        assert told(mqtt) == (("publish", "/status/foo/bar"), "publish", ("/status/foo/bar", value), {"kw": kwargs})
         # No need/support for kwargs for LCD
-        lcd.update.defer.assert_called_once_with("foo_bar", value)
+        assert told(lcd) == (("update", "foo_bar"), "update", ("foo_bar", value), {})
+
+    def test_policy(self, mqtt, lcd, policy):
+        encoder = Encoder(mqtt, lcd, policy)
+        encoder.foo(10)
+        encoder.foo(10)
+        assert mqtt.actor_ref.tell.call_count == 1
+        assert lcd.actor_ref.tell.call_count == 1
+
+    def test_snapshot(self, mocker, mqtt, lcd):
+        snapshot = mocker.Mock()
+        encoder = Encoder(mqtt, lcd, snapshot=snapshot)
+        encoder.filtration_state("eco")
+        assert told(snapshot) == (
+            ("update", "/status/filtration/state"),
+            "update",
+            ("/status/filtration/state", "eco"),
+            {},
+        )
+
+    def test_cached(self, mqtt, lcd, encoder):
+        assert encoder.foo_bar is encoder.foo_bar
+        assert encoder.filtration_state is encoder.filtration_state
+        encoder.temperature_pool__slope(0.5)
+        assert told(mqtt)[0] == ("publish", "/status/temperature/pool_slope")
+
+    def test_status_topics(self):
+        assert STATUS_TOPICS["heating_total__seconds"] == "/status/heating/total_seconds"
+        # The retained status values restored at startup are all published by the encoder
+        restored = {route.topic for route in ROUTES if route.topic.startswith("/status/")}
+        assert restored <= set(STATUS_TOPICS.values())
+
+
+class TestPublishPolicy:
+    def test_exact(self, policy):
+        assert policy.accept("filtration_state", "eco")
+        assert not policy.accept("filtration_state", "eco")
+        assert policy.accept("filtration_state", "standby")
+        assert policy.accept("filtration_state", "eco")
+        assert (policy.published, policy.suppressed) == (3, 1)
+
+    def test_deadband(self, policy):
+        assert policy.accept("temperature_pool", 24.5)
+        assert not policy.accept("temperature_pool", 24.55)
+        assert policy.accept("temperature_pool", 24.4)
+        # Compared with the last published value so that a slow drift is eventually published
+        assert not policy.accept("temperature_pool", 24.45)
+        assert policy.accept("temperature_pool", 24.3)
+
+    def test_deadband_string(self, policy):
+        assert policy.accept("disinfection_orp_value", "650")
+        assert not policy.accept("disinfection_orp_value", "653")
+        assert policy.accept("disinfection_orp_value", "645")
+        assert policy.accept("disinfection_orp_value", "n/a")
+
+    def test_names_are_independent(self, policy):
+        assert policy.accept("temperature_pool", 24.5)
+        assert policy.accept("temperature_air", 24.5)
+        assert not policy.accept("temperature_air", 24.5)
+
+    def test_max_age(self, clock, policy):
+        assert policy.accept("temperature_pool", 24.5)
+        clock.advance(599)
+        assert not policy.accept("temperature_pool", 24.5)
+        clock.advance(1)
+        assert policy.accept("temperature_pool", 24.5)
+        assert not policy.accept("temperature_pool", 24.5)
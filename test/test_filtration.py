@@ -15,11 +15,16 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import threading
 from datetime import datetime, timedelta
+from typing import Final
 
+import pykka
 import pytest
 from freezegun import freeze_time
 
+from controller.actor import PoupoolActor, PoupoolModel
+
 
 @pytest.fixture
 def encoder(mocker):
@@ -80,3 +85,62 @@ class TestEcoMode:
         assert eco_mode.filtration.duration == timedelta(hours=5)
         assert eco_mode.filtration.remaining == timedelta(hours=5)
         assert not eco_mode.filtration.elapsed()
+
+
+class Disinfection(PoupoolActor):
+    states: Final = ["halt", "waiting"]
+
+    def __init__(self):
+        super().__init__()
+        self.__machine = PoupoolModel(model=self, states=Disinfection.states, initial="halt")
+        self.__machine.add_transition("run", "halt", "waiting")
+        self.__machine.add_transition("halt", "waiting", "halt")
+
+    def block(self, started, event):
+        started.set()
+        event.wait()
+
+
+@pytest.fixture
+def target():
+    yield Disinfection.start().proxy()
+    pykka.ActorRegistry.stop_all()
+
+
+@pytest.fixture
+def filtration(mocker, encoder, target):
+    from controller.filtration import Filtration
+
+    filtration = Filtration(mocker.Mock(), encoder, mocker.Mock())
+    # Only the disinfection is checked, the other actors are mocks
+    others = {}
+    filtration.get_actor = lambda name: target if name == "Disinfection" else others.setdefault(name, mocker.Mock())
+    return filtration
+
+
+class TestActorRunHalt:
+    def test_halt_pending_run(self, filtration, target):
+        started, event = threading.Event(), threading.Event()
+        target.block.defer(started, event)
+        assert started.wait(2)
+        # Still halted when the halt is sent
+        target.run.defer()
+        filtration.on_enter_halt()
+        event.set()
+        assert target.state.get() == "halt"
+        assert target.actor_ref.actor_inbox.metrics.summary()["methods"]["run"]["cancelled"] == 1
+
+    def test_run_pending_halt(self, filtration, target):
+        target.run().get()
+        started, event = threading.Event(), threading.Event()
+        target.block.defer(started, event)
+        assert started.wait(2)
+        # Still waiting when the run is sent
+        target.halt.defer()
+        thread = threading.Thread(target=filtration._Filtration__disinfection_start)  # noqa: SLF001
+        thread.start()
+        # Waits for the halt to be handled
+        thread.join(0.1)
+        event.set()
+        thread.join(2)
+        assert target.state.get() == "waiting"
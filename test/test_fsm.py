@@ -0,0 +1,199 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import copy
+import random
+from typing import Final
+
+import pykka
+import pytest
+from transitions.extensions import HierarchicalMachine
+
+from controller.fsm import Machine
+
+
+class Recorder:
+    # Stand-in for PoupoolModel capturing how a controller builds its state machine
+    def __init__(self, model, states, initial, before_state_change=None):
+        self.states = states
+        self.initial = initial
+        self.before_state_change = [*(before_state_change or []), "do_cancel"]
+        self.transitions = []
+
+    def add_transition(self, trigger, source, dest, **kwargs):
+        self.transitions.append((trigger, source, dest, kwargs))
+
+
+def capture(mocker, module, cls, *args):
+    recorders = []
+
+    def recorder(**kwargs):
+        recorders.append(Recorder(**kwargs))
+        return recorders[-1]
+
+    mocker.patch(f"controller.{module}.PoupoolModel", recorder)
+    getattr(__import__(f"controller.{module}", fromlist=[cls]), cls)(*args)
+    return recorders[0]
+
+
+def state_names(states, prefix=""):
+    for state in states:
+        if isinstance(state, str):
+            yield prefix + state
+        else:
+            yield prefix + state["name"]
+            yield from state_names(state.get("children", []), prefix + state["name"] + "_")
+
+
+def name(callback):
+    return callback if isinstance(callback, str) else callback.__name__
+
+
+def listify(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def recording(log, name):
+    return lambda self: log.append(name)
+
+
+def replay(engine, recorder, seed, steps=300):
+    # Run the same random sequence of triggers with random guards and record what happened
+    rng = random.Random(seed)
+    log = []
+    attributes = {}
+    states = list(state_names(recorder.states))
+    for state in states:
+        for kind in ("on_enter", "on_exit"):
+            attributes[f"{kind}_{state}"] = recording(log, f"{kind}_{state}")
+    for _, _, _, kwargs in recorder.transitions:
+        for callback in listify(kwargs.get("conditions")) + listify(kwargs.get("unless")):
+            attributes[name(callback)] = lambda self: rng.random() < 0.5
+        for callback in listify(kwargs.get("before")) + listify(kwargs.get("after")):
+            attributes[name(callback)] = recording(log, name(callback))
+    for callback in recorder.before_state_change:
+        attributes[name(callback)] = recording(log, name(callback))
+    model = type("Model", (), attributes)()
+    before = [name(c) for c in recorder.before_state_change]
+    extra = {"auto_transitions": False, "ignore_invalid_triggers": True} if engine is HierarchicalMachine else {}
+    states_copy = copy.deepcopy(recorder.states)
+    machine = engine(model=model, states=states_copy, initial=recorder.initial, before_state_change=before, **extra)
+    for trigger, source, dest, kwargs in recorder.transitions:
+        kwargs = {key: [name(c) for c in listify(value)] for key, value in kwargs.items()}
+        machine.add_transition(trigger, source, dest, **kwargs)
+    triggers = sorted({t[0] for t in recorder.transitions})
+    for _ in range(steps):
+        trigger = rng.choice(triggers)
+        result = getattr(model, trigger)()
+        checks = [(getattr(model, f"is_{s}")(), getattr(model, f"is_{s}")(allow_substates=True)) for s in states]
+        log.append((trigger, result, model.state, checks))
+    return log
+
+
+@pytest.fixture
+def controllers(mocker):
+    temperature, encoder, devices = mocker.Mock(), mocker.Mock(), mocker.MagicMock()
+    recorders = {
+        "Filtration": capture(mocker, "filtration", "Filtration", temperature, encoder, devices),
+        "Tank": capture(mocker, "tank", "Tank", encoder, devices),
+        "Swim": capture(mocker, "swim", "Swim", temperature, encoder, devices),
+        "Heater": capture(mocker, "heating", "Heater", temperature, mocker.Mock()),
+        "Heating": capture(mocker, "heating", "Heating", temperature, encoder, devices),
+        "Light": capture(mocker, "light", "Light", encoder, devices),
+        "Arduino": capture(mocker, "arduino", "Arduino", encoder, devices),
+        "Disinfection": capture(mocker, "disinfection", "Disinfection", encoder, devices, None, None),
+    }
+    yield recorders
+    pykka.ActorRegistry.stop_all()
+
+
+class Model:
+    def __init__(self):
+        self.calls = []
+
+    def on_enter_run(self):
+        self.calls.append("enter_run")
+
+    def on_exit_run(self):
+        self.calls.append("exit_run")
+
+    def on_enter_run_slow(self):
+        self.calls.append("enter_run_slow")
+
+    def allowed(self):
+        return True
+
+    def before(self):
+        self.calls.append("before")
+
+
+class TestMachine:
+    states: Final = ["halt", {"name": "run", "initial": "slow", "children": ["slow", "fast"]}]
+
+    def test_same_behaviour_as_transitions(self, controllers):
+        for recorder in controllers.values():
+            for seed in range(5):
+                assert replay(Machine, recorder, seed) == replay(HierarchicalMachine, recorder, seed)
+
+    def test_same_behaviour_as_transitions_corner_cases(self):
+        states = ["halt", {"name": "run", "initial": "slow", "children": ["slow", {"name": "fast", "children": ["a"]}]}]
+        recorder = Recorder(model=None, states=states, initial="halt")
+        recorder.add_transition("run", "halt", "run", conditions="guard")
+        recorder.add_transition("halt", "run", "halt")
+        # Reflexive, to a parent, internal and from a parent to a child
+        recorder.add_transition("restart", "run", "run")
+        recorder.add_transition("again", "halt", "halt")
+        recorder.add_transition("reset", "run_fast_a", "run")
+        recorder.add_transition("noop", "run", None, after="after")
+        recorder.add_transition("fast", "run", "run_fast_a", unless="guard")
+        recorder.add_transition("fast", "run_slow", "run_fast")
+        for seed in range(20):
+            assert replay(Machine, recorder, seed) == replay(HierarchicalMachine, recorder, seed)
+
+    def test_nested(self):
+        model = Model()
+        machine = Machine(model=model, states=self.states, initial="halt")
+        machine.add_transition("run", "halt", "run", conditions="allowed", before=model.before)
+        machine.add_transition("halt", "run", "halt")
+        machine.add_transition("fast", "run_slow", "run_fast", unless="allowed")
+        assert model.is_halt()
+        assert model.run()
+        assert model.state == "run_slow"
+        assert model.calls == ["before", "enter_run", "enter_run_slow"]
+        assert model.is_run(allow_substates=True)
+        assert not model.is_run()
+        assert not model.fast()
+        assert not model.run()
+        # Triggered from the parent state
+        assert model.halt()
+        assert model.calls[-1] == "exit_run"
+
+    def test_unknown_state(self):
+        machine = Machine(model=Model(), states=self.states, initial="halt")
+        with pytest.raises(ValueError, match="not a registered state"):
+            machine.add_transition("run", "halt", "unknown")
+
+    def test_table_shared(self):
+        tables = []
+        for _ in range(3):
+            model = Model()
+            machine = Machine(model=model, states=self.states, initial="halt")
+            machine.add_transition("run", "halt", "run", before=model.before)
+            tables.append(machine.table)
+        assert tables[0] is tables[1] is tables[2]
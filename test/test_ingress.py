@@ -0,0 +1,126 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import threading
+import time
+
+import pytest
+
+from controller.ingress import Ingress
+
+
+def wait_until(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class Worker:
+    # Records the calls, the first one blocks until released
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def block(self):
+        self.started.set()
+        self.release.wait(2)
+
+    def call(self, *args):
+        self.calls.append(args)
+
+
+@pytest.fixture
+def worker():
+    return Worker()
+
+
+def start(worker, maxsize, policy):
+    ingress = Ingress(maxsize, policy)
+    ingress.start()
+    ingress.put("block", worker.block)
+    assert worker.started.wait(2)
+    return ingress
+
+
+class TestIngress:
+    def test_order(self, worker):
+        ingress = Ingress(10)
+        ingress.start()
+        for i in range(5):
+            ingress.put("/a" if i % 2 else "/b", worker.call, i)
+        wait_until(lambda: len(worker.calls) == 5)
+        assert worker.calls == [(i,) for i in range(5)]
+        summary = ingress.summary()
+        assert summary["wait"]["count"] == 5
+        assert summary["dropped"] == 0
+        ingress.stop()
+
+    def test_drop_oldest(self, worker):
+        ingress = start(worker, 3, Ingress.DROP_OLDEST)
+        ingress.put("/a", worker.call, "a1")
+        ingress.put("/b", worker.call, "b1")
+        ingress.put("/a", worker.call, "a2")
+        # Full, the oldest of the same topic goes
+        ingress.put("/a", worker.call, "a3")
+        # Full and nothing pending for this topic, the received message goes
+        ingress.put("/c", worker.call, "c1")
+        assert ingress.summary()["size"] == 3
+        worker.release.set()
+        wait_until(lambda: len(worker.calls) == 3)
+        assert worker.calls == [("b1",), ("a2",), ("a3",)]
+        summary = ingress.summary()
+        assert summary["dropped"] == 2
+        assert summary["max_depth"] == 3
+        ingress.stop()
+
+    def test_control(self, worker):
+        ingress = start(worker, 2, Ingress.DROP_OLDEST)
+        ingress.put("/a", worker.call, "a1")
+        ingress.put_control(worker.call, "control")
+        # Full, the control calls are never dropped
+        ingress.put("/b", worker.call, "b1")
+        ingress.put_control(worker.call, "end")
+        assert ingress.summary()["size"] == 3
+        ingress.put("/a", worker.call, "a2")
+        worker.release.set()
+        wait_until(lambda: len(worker.calls) == 3)
+        assert worker.calls == [("control",), ("end",), ("a2",)]
+        assert ingress.summary()["dropped"] == 2
+        ingress.stop()
+
+    def test_block(self, worker):
+        ingress = start(worker, 1, Ingress.BLOCK)
+        ingress.put("/a", worker.call, "a1")
+        thread = threading.Thread(target=ingress.put, args=("/a", worker.call, "a2"))
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+        worker.release.set()
+        thread.join(2)
+        wait_until(lambda: len(worker.calls) == 2)
+        assert worker.calls == [("a1",), ("a2",)]
+        assert ingress.summary()["blocked"] == 1
+        ingress.stop()
+
+    def test_exception(self, worker):
+        ingress = Ingress(10)
+        ingress.start()
+        ingress.put("/a", lambda: 1 / 0)
+        ingress.put("/a", worker.call, "a")
+        wait_until(lambda: worker.calls == [("a",)])
+        ingress.stop()
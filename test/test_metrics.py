@@ -0,0 +1,114 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import time
+
+import pykka
+import pytest
+
+from controller.actor import PoupoolActor
+from controller.dispatcher import Dispatcher
+from controller.metrics import Histogram
+from controller.monitor import Monitor
+
+
+class SlowActor(PoupoolActor):
+    def do_slow(self):
+        time.sleep(0.05)
+
+    def do_fast(self):
+        pass
+
+
+@pytest.fixture
+def slow_actor():
+    yield SlowActor.start().proxy()
+    pykka.ActorRegistry.stop_all()
+
+
+class TestHistogram:
+    def test_empty(self):
+        summary = Histogram().summary()
+        assert summary["count"] == 0
+        assert summary["mean"] == 0
+        assert summary["p99"] == 0
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for _ in range(99):
+            histogram.add(0.0002)
+        histogram.add(2)
+        summary = histogram.summary()
+        assert summary["count"] == 100
+        assert summary["p50"] == 0.0005
+        assert summary["p99"] == 0.0005
+        assert summary["max"] == 2
+        assert histogram.percentile(100) == 2
+
+
+class TestActorMetrics:
+    def test_wait_and_duration(self, slow_actor):
+        for _ in range(4):
+            slow_actor.do_slow.defer()
+        slow_actor.do_fast().get()
+        summary = slow_actor.actor_ref.actor_inbox.metrics.summary()
+        slow = summary["methods"]["do_slow"]
+        assert slow["duration"]["count"] == 4
+        assert slow["duration"]["max"] >= 0.05
+        assert slow["depth"] == 0
+        assert slow["max_depth"] >= 1
+        # The last message waited for the 4 slow ones
+        fast = summary["methods"]["do_fast"]
+        assert fast["wait"]["max"] >= 0.15
+        assert summary["depth"]["max"] >= 2
+
+    def test_running(self, slow_actor):
+        slow_actor.do_slow.defer()
+        time.sleep(0.02)
+        running, busy = slow_actor.actor_ref.actor_inbox.metrics.running()
+        assert running == "do_slow"
+        assert busy > 0
+
+    def test_monitor_publish(self, mocker, slow_actor):
+        mqtt = mocker.Mock()
+        slow_actor.do_fast().get()
+        monitor = Monitor.start(mqtt).proxy()
+        monitor.do_publish().get()
+        topics = {c.args[0]: json.loads(c.args[1]) for c in mqtt.publish.defer.call_args_list}
+        assert "/status/metrics/actors/SlowActor" in topics
+        assert "/status/metrics/actors/Monitor" in topics
+        assert topics["/status/metrics/actors/SlowActor"]["methods"]["do_fast"]["duration"]["count"] == 1
+
+    def test_monitor_same_class(self, mocker, slow_actor):
+        mqtt = mocker.Mock()
+        other = SlowActor.start().proxy()
+        Monitor.start(mqtt).proxy().do_publish().get()
+        topics = {c.args[0] for c in mqtt.publish.defer.call_args_list}
+        for actor in (slow_actor, other):
+            assert f"/status/metrics/actors/SlowActor/{actor.actor_ref.actor_urn}" in topics
+        assert "/status/metrics/actors/SlowActor" not in topics
+
+    def test_monitor_dispatcher(self, mocker):
+        mqtt = mocker.Mock()
+        dispatcher = Dispatcher()
+        dispatcher.register(*[mocker.Mock() for _ in range(8)])
+        dispatcher.dispatch("/settings/filtration/period", b"42")
+        Monitor.start(mqtt, dispatcher).proxy().do_publish().get()
+        topics = {c.args[0]: json.loads(c.args[1]) for c in mqtt.publish.defer.call_args_list}
+        assert topics["/status/metrics/dispatcher"]["routes"]["/settings/filtration/period"]["rejected"] == 1
+        pykka.ActorRegistry.stop_all()
@@ -0,0 +1,314 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import json
+import queue
+import threading
+import time
+from unittest import mock
+
+import paho.mqtt.client as paho
+import pykka
+import pytest
+
+from controller.broker import Broker, matches
+from controller.dispatcher import Dispatcher, Route
+from controller.mqtt import Mqtt
+from controller.spool import Spool
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = Dispatcher()
+    dispatcher.register(*[mock.Mock() for _ in range(8)])
+    return dispatcher
+
+
+@pytest.fixture
+def broker():
+    broker = Broker().start()
+    yield broker
+    broker.stop()
+
+
+class Subscriber:
+    # Paho client running its own network thread, collecting the received messages
+    def __init__(self, broker, client_id="", clean_session=True):
+        self.messages = queue.Queue()
+        self.flags = queue.Queue()
+        self.client = paho.Client(paho.CallbackAPIVersion.VERSION2, client_id=client_id, clean_session=clean_session)
+        self.client.on_connect = lambda client, userdata, flags, reason, properties: self.flags.put(flags)
+        self.client.on_message = lambda client, userdata, message: self.messages.put(
+            (message.topic, message.payload.decode(), message.retain)
+        )
+        self.client.connect(broker.host, broker.port)
+        self.client.loop_start()
+        self.connected = self.flags.get(timeout=2)
+
+    def subscribe(self, topic):
+        result, _ = self.client.subscribe(topic)
+        assert result == paho.MQTT_ERR_SUCCESS
+        # Wait for the SUBACK with a round trip
+        self.client.publish("/sync", "sync", qos=1).wait_for_publish(2)
+
+    def get(self):
+        return self.messages.get(timeout=2)
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+@pytest.fixture
+def subscriber(broker):
+    subscriber = Subscriber(broker)
+    yield subscriber
+    subscriber.stop()
+
+
+@pytest.fixture
+def client(mocker):
+    yield mocker.patch("controller.mqtt.mqtt.Client").return_value
+    pykka.ActorRegistry.stop_all()
+
+
+class TestSubscribe:
+    def test_subscriptions(self, dispatcher):
+        subscriptions = dispatcher.subscriptions()
+        assert "/settings/#" in subscriptions
+        assert "/status/water/counter" in subscriptions
+        assert not [topic for topic in subscriptions if topic.startswith("/settings/") and topic != "/settings/#"]
+        # All the routes are covered
+        for topic in dispatcher.topics():
+            assert topic in subscriptions or topic.startswith("/settings/")
+
+    def test_single_subscribe(self, dispatcher, client):
+        from controller.mqtt import Mqtt
+
+        Mqtt.start(dispatcher).proxy().do_connect().get()
+        client.connect.assert_called_once_with("localhost", 1883)
+        client.on_connect(client, None, {"session present": 0}, 0)
+        topics = [*dispatcher.subscriptions(), "/restore/poupool"]
+        client.subscribe.assert_called_once_with([(topic, 0) for topic in topics])
+        # The marker comes back after the retained messages
+        client.publish.assert_called_once_with("/restore/poupool")
+
+    def test_session_present(self, mocker, dispatcher, client):
+        from controller import mqtt
+
+        mocker.patch.object(mqtt, "to_bool", return_value=True)
+        mqtt.Mqtt.start(dispatcher)
+        _, kwargs = mqtt.mqtt.Client.call_args
+        assert kwargs == {"client_id": "poupool", "clean_session": False}
+        # Subscribe after starting even if the session is present to get the retained settings
+        client.on_connect(client, None, {"session present": 1}, 0)
+        topics = [*dispatcher.subscriptions(), "/restore/poupool"]
+        client.subscribe.assert_called_once_with([(topic, 1) for topic in topics])
+        client.subscribe.reset_mock()
+        client.on_connect(client, None, {"session present": 1}, 0)
+        client.subscribe.assert_not_called()
+        # Only restored once
+        client.on_connect(client, None, {"session present": 0}, 0)
+        client.subscribe.assert_called_once_with([(topic, 1) for topic in dispatcher.subscriptions()])
+
+
+class TestBroker:
+    def test_matches(self):
+        assert matches("/settings/#", "/settings/filtration/duration")
+        assert matches("/settings/#", "/settings")
+        assert matches("/status/+/state", "/status/tank/state")
+        assert not matches("/status/+/state", "/status/tank/height")
+        assert not matches("/status/tank", "/status/tank/state")
+        assert matches("/status/tank/state", "/status/tank/state")
+
+    def test_publish_subscribe(self, broker, subscriber):
+        subscriber.subscribe("/status/#")
+        publisher = Subscriber(broker)
+        publisher.client.publish("/status/tank/state", "normal").wait_for_publish(2)
+        publisher.client.publish("/settings/mode", "eco", qos=1).wait_for_publish(2)
+        publisher.stop()
+        assert subscriber.get() == ("/status/tank/state", "normal", False)
+        assert subscriber.messages.empty()
+
+    def test_retained(self, broker, subscriber):
+        subscriber.client.publish("/settings/mode", "eco", retain=True).wait_for_publish(2)
+        subscriber.client.publish("/settings/filtration/period", "3", qos=2, retain=True).wait_for_publish(2)
+        subscriber.client.publish("/status/tank/state", "normal", retain=True).wait_for_publish(2)
+        subscriber.subscribe("/settings/#")
+        assert {subscriber.get(), subscriber.get()} == {
+            ("/settings/mode", "eco", True),
+            ("/settings/filtration/period", "3", True),
+        }
+        # An empty retained message clears it
+        subscriber.client.publish("/settings/mode", "", retain=True).wait_for_publish(2)
+        assert subscriber.get() == ("/settings/mode", "", False)
+        other = Subscriber(broker)
+        other.subscribe("/settings/#")
+        assert other.get() == ("/settings/filtration/period", "3", True)
+        other.stop()
+
+    def test_persistent_session(self, broker):
+        subscriber = Subscriber(broker, "poupool", clean_session=False)
+        assert not subscriber.connected.session_present
+        subscriber.subscribe("/settings/#")
+        subscriber.stop()
+        subscriber = Subscriber(broker, "poupool", clean_session=False)
+        assert subscriber.connected.session_present
+        # The subscription was kept
+        publisher = Subscriber(broker)
+        publisher.client.publish("/settings/mode", "eco").wait_for_publish(2)
+        publisher.stop()
+        assert subscriber.get() == ("/settings/mode", "eco", False)
+        subscriber.stop()
+
+
+def wait_until(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class TestMqtt:
+    @pytest.fixture
+    def actors(self, mocker, tmp_path):
+        mocker.patch("controller.mqtt.Spool", lambda _, max_entries, batch: Spool(str(tmp_path / "spool"), max_entries))
+        actors = [mock.Mock() for _ in range(8)]
+        yield actors
+        pykka.ActorRegistry.stop_all()
+
+    def test_settings_to_actor(self, broker, actors):
+        dispatcher = Dispatcher()
+        dispatcher.register(*actors)
+        filtration = actors[0]
+        publisher = Subscriber(broker)
+        publisher.client.publish("/settings/filtration/period", "3", retain=True).wait_for_publish(2)
+        mqtt = Mqtt.start(dispatcher, broker.host, broker.port).proxy()
+        mqtt.do_start().get()
+        # Retained setting restored at start up
+        wait_until(lambda: filtration.period.defer.called)
+        filtration.period.defer.assert_called_once_with(3)
+        publisher.client.publish("/settings/mode", "eco").wait_for_publish(2)
+        wait_until(lambda: filtration.eco.defer.called)
+        publisher.stop()
+
+    def test_restore(self, broker, actors):
+        dispatcher = Dispatcher()
+        dispatcher.register(*actors)
+        filtration = actors[0]
+        publisher = Subscriber(broker)
+        publisher.client.publish("/settings/mode", "eco", retain=True).wait_for_publish(2)
+        publisher.client.publish("/settings/filtration/speed/eco", "2", retain=True).wait_for_publish(2)
+        publisher.stop()
+        mqtt = Mqtt.start(dispatcher, broker.host, broker.port).proxy()
+        mqtt.do_start().get()
+        # Ended by the marker, not by the timeout
+        assert dispatcher.wait_restored(2)
+        assert [call[0] for call in filtration.mock_calls] == ["speed_eco.defer", "eco.defer"]
+
+    def test_restore_missing(self, broker):
+        # Like backup_settings.py, without actors and with its own client id
+        publisher = Subscriber(broker)
+        publisher.client.publish("/settings/mode", "eco", retain=True).wait_for_publish(2)
+        publisher.stop()
+        dispatcher = Dispatcher()
+        dispatcher.register()
+        mqtt = Mqtt.start(dispatcher, broker.host, broker.port, client_id="backup", spool=False).proxy()
+        mqtt.do_start().get()
+        assert dispatcher.wait_restored(2)
+        assert dispatcher.restore_complete
+        assert dispatcher.export()["settings"] == {"/settings/mode": "eco"}
+        assert "/settings/swim/speed" in dispatcher.missing()
+        pykka.ActorRegistry.stop_all()
+
+    def test_no_spool(self, mocker):
+        spool = mocker.patch("controller.mqtt.Spool")
+        mqtt = Mqtt.start(Dispatcher(), "localhost", 1, spool=False).proxy()
+        # Not connected
+        assert not mqtt.publish("/status/tank/state", "normal").get()
+        mqtt.do_replay().get()
+        spool.assert_not_called()
+        pykka.ActorRegistry.stop_all()
+
+    def test_publish(self, broker, subscriber, actors):
+        subscriber.subscribe("/status/#")
+        mqtt = Mqtt.start(Dispatcher(), broker.host, broker.port).proxy()
+        mqtt.do_start().get()
+        wait_until(lambda: mqtt.publish("/status/tank/state", "normal").get())
+        assert subscriber.get() == ("/status/tank/state", "normal", False)
+
+    def test_import_export(self, broker, subscriber, actors):
+        dispatcher = Dispatcher()
+        dispatcher.register(*actors)
+        mqtt = Mqtt.start(dispatcher, broker.host, broker.port).proxy()
+        mqtt.do_start().get()
+        assert dispatcher.wait_restored(2)
+        subscriber.subscribe("/settings/filtration/#")
+        subscriber.subscribe("/status/settings/#")
+        document = {"version": 1, "settings": {"/settings/filtration/period": 3}}
+        subscriber.client.publish("/settings/import", json.dumps(document))
+        assert subscriber.get() == ("/settings/filtration/period", "3", False)
+        assert subscriber.get() == ("/status/settings/import", json.dumps({"imported": 1}), False)
+        actors[0].period.defer.assert_called_once_with(3)
+        subscriber.client.publish("/settings/export", "")
+        topic, payload, _ = subscriber.get()
+        assert topic == "/status/settings/export"
+        assert json.loads(payload) == {"version": 1, "settings": {"/settings/filtration/period": "3"}}
+        # Retained for the next start
+        other = Subscriber(broker)
+        other.subscribe("/settings/filtration/period")
+        assert other.get() == ("/settings/filtration/period", "3", True)
+        other.stop()
+
+    def test_no_requests(self, broker, subscriber):
+        # A tool like backup_settings.py only collects the answer of poupool
+        dispatcher = Dispatcher(routes=(Route("/status/settings/import", None, None, "string"),))
+        dispatcher.register()
+        mqtt = Mqtt.start(dispatcher, broker.host, broker.port, client_id="tool", spool=False, requests=False).proxy()
+        mqtt.do_start().get()
+        assert dispatcher.wait_restored(2)
+        subscriber.subscribe("/status/settings/#")
+        subscriber.client.publish("/settings/import", json.dumps({"version": 1, "settings": {}}))
+        subscriber.client.publish("/status/settings/import", json.dumps({"imported": 0}))
+        assert subscriber.get() == ("/status/settings/import", json.dumps({"imported": 0}), False)
+        wait_until(lambda: dispatcher.value("/status/settings/import") is not None)
+        assert subscriber.messages.empty()
+        pykka.ActorRegistry.stop_all()
+
+    def test_slow_dispatch(self, broker, subscriber, actors):
+        # A burst of settings handled slowly does not hold the status publications back
+        dispatcher = Dispatcher()
+        dispatcher.register(*actors)
+        mqtt = Mqtt.start(dispatcher, broker.host, broker.port).proxy()
+        mqtt.do_start().get()
+        assert dispatcher.wait_restored(2)
+        dispatching = threading.Event()
+
+        def dispatch(topic, payload):
+            dispatching.set()
+            time.sleep(1)
+
+        dispatcher.dispatch = dispatch
+        subscriber.subscribe("/status/tank/#")
+        publisher = Subscriber(broker)
+        for _ in range(3):
+            publisher.client.publish("/settings/mode", "eco")
+        assert dispatching.wait(2)
+        start = time.monotonic()
+        wait_until(lambda: mqtt.publish("/status/tank/state", "normal").get())
+        assert subscriber.get() == ("/status/tank/state", "normal", False)
+        assert time.monotonic() - start < 0.5
+        publisher.stop()
@@ -0,0 +1,82 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def scheduler():
+    from controller.scheduler import Scheduler
+
+    scheduler = Scheduler()
+    yield scheduler
+    scheduler.stop()
+
+
+class TestScheduler:
+    def test_fire_in_order(self, scheduler):
+        fired = []
+        done = threading.Event()
+        scheduler.schedule(0.3, done.set)
+        scheduler.schedule(0.2, fired.append, "second")
+        scheduler.schedule(0.1, fired.append, "first")
+        assert done.wait(2)
+        assert fired == ["first", "second"]
+        stats = scheduler.stats()
+        assert stats["fired"] == 3
+        assert stats["armed"] == 0
+        assert stats["lateness_max"] >= 0
+
+    def test_cancel(self, scheduler):
+        fired = []
+        call = scheduler.schedule(0.1, fired.append, "cancelled")
+        assert scheduler.stats()["armed"] == 1
+        assert scheduler.cancel(call)
+        # Cancelling twice is a no-op
+        assert not scheduler.cancel(call)
+        assert scheduler.stats()["armed"] == 0
+        time.sleep(0.3)
+        assert fired == []
+        assert scheduler.stats()["cancelled"] == 1
+
+    def test_cancel_after_fire(self, scheduler):
+        done = threading.Event()
+        call = scheduler.schedule(0, done.set)
+        assert done.wait(2)
+        assert not scheduler.cancel(call)
+        assert scheduler.stats()["cancelled"] == 0
+
+    def test_kwargs(self, scheduler):
+        result = {}
+        done = threading.Event()
+
+        def func(a, b=None):
+            result.update(a=a, b=b)
+            done.set()
+
+        scheduler.schedule(0.05, func, 1, b=2)
+        assert done.wait(2)
+        assert result == {"a": 1, "b": 2}
+
+    def test_many_cancels_compact(self, scheduler):
+        calls = [scheduler.schedule(60, print) for _ in range(200)]
+        for call in calls[:-1]:
+            scheduler.cancel(call)
+        assert scheduler.stats()["armed"] == 1
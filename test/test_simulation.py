@@ -0,0 +1,143 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import time
+from datetime import datetime, timedelta
+from unittest.mock import call
+
+import pykka
+import pytest
+
+from controller.actor import is_quiescent
+from controller.backend import EventLoopBackend, ThreadingBackend, set_backend
+from controller.clock import RealClock, VirtualClock, set_clock
+from controller.device import DeviceRegistry, PumpDevice, SensorDevice, StoppableDevice, SwitchDevice
+
+START = datetime(1981, 5, 30, 6, 0, 0)
+
+
+class FakeSensor(SensorDevice):
+    def __init__(self, name, value):
+        super().__init__(name)
+        self.__value = value
+
+    @property
+    def value(self):
+        return self.__value() if callable(self.__value) else self.__value
+
+
+class FakeArduino(StoppableDevice):
+    cover_position = 0
+    water_counter = 0
+
+    def cover_open(self):
+        pass
+
+    def cover_close(self):
+        pass
+
+    def cover_stop(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+@pytest.fixture(params=[ThreadingBackend, EventLoopBackend])
+def clock(request):
+    backend = request.param()
+    set_backend(backend)
+    clock = VirtualClock(START, idle=is_quiescent)
+    set_clock(clock)
+    yield clock
+    pykka.ActorRegistry.stop_all()
+    backend.shutdown()
+    set_backend(ThreadingBackend())
+    set_clock(RealClock())
+
+
+def mock_device(mocker, device_type, name):
+    device = mocker.Mock(device_type)
+    device.name = name
+    return device
+
+
+@pytest.fixture
+def devices(mocker, clock):
+    registry = DeviceRegistry()
+    registry.add_pump(mock_device(mocker, PumpDevice, "variable"))
+    for name in ("boost", "ph", "cl", "swim"):
+        registry.add_pump(mock_device(mocker, SwitchDevice, name))
+    for name in ("gravity", "backwash", "tank", "drain", "main", "heating", "light"):
+        registry.add_valve(mock_device(mocker, SwitchDevice, name))
+    # The tank is full so that a backwash can be done. The pool warms up slowly while heating.
+    registry.add_sensor(FakeSensor("tank", 97))
+    registry.add_sensor(FakeSensor("ph", 7.4))
+    registry.add_sensor(FakeSensor("orp", 550))
+    hours = lambda: (clock.now() - START).total_seconds() / 3600  # noqa: E731
+    registry.add_sensor(FakeSensor("temperature_pool", lambda: 25.0 + hours() / 4))
+    registry.add_sensor(FakeSensor("temperature_air", 22.0))
+    registry.add_device(FakeArduino("arduino"))
+    return registry
+
+
+def start_all(encoder, devices):
+    from controller.arduino import Arduino
+    from controller.disinfection import Disinfection
+    from controller.filtration import Filtration
+    from controller.heating import Heating
+    from controller.light import Light
+    from controller.sensor import DisinfectionReader, DisinfectionWriter, TemperatureReader
+    from controller.swim import Swim
+    from controller.tank import Tank
+
+    temperature = [devices.get_sensor("temperature_pool"), devices.get_sensor("temperature_air")]
+    temperature_reader = TemperatureReader.start(temperature).proxy()
+    sensors = [devices.get_sensor("ph"), devices.get_sensor("orp")]
+    disinfection_reader = DisinfectionReader.start(sensors).proxy()
+    disinfection_writer = DisinfectionWriter.start(encoder, disinfection_reader).proxy()
+    filtration = Filtration.start(temperature_reader, encoder, devices).proxy()
+    Tank.start(encoder, devices)
+    Swim.start(temperature_reader, encoder, devices)
+    Heating.start(temperature_reader, encoder, devices)
+    Light.start(encoder, devices)
+    Arduino.start(encoder, devices)
+    Disinfection.start(encoder, devices, disinfection_reader, disinfection_writer)
+    temperature_reader.do_read().get()
+    disinfection_reader.do_read().get()
+    return filtration
+
+
+class TestSimulation:
+    def test_eco_day(self, mocker, clock, devices):
+        encoder = mocker.Mock()
+        filtration = start_all(encoder, devices)
+        filtration.duration(8 * 3600).get()
+        filtration.eco().get()
+        started = time.monotonic()
+        while clock.now() < START + timedelta(hours=24):
+            assert time.monotonic() - started < 60, "Simulation is too slow"
+            time.sleep(0.05)
+        filtration.halt().get()
+        states = {c.args[0] for c in encoder.filtration_state.call_args_list}
+        assert {"eco_compute", "eco_normal", "eco_tank", "eco_waiting", "backwash", "rinse"} <= states
+        assert "heating_running" in states
+        assert call("heating") in encoder.heating_state.call_args_list
+        assert call("treating") in encoder.disinfection_state.call_args_list
+        devices.get_valve("backwash").on.assert_called_once_with()
+        devices.get_valve("heating").on.assert_called_once_with()
+        devices.get_pump("cl").on.assert_called()
@@ -0,0 +1,71 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import json
+
+import pykka
+import pytest
+
+from controller.snapshot import Snapshot
+
+
+@pytest.fixture
+def mqtt(mocker):
+    return mocker.Mock()
+
+
+@pytest.fixture
+def snapshot(mqtt):
+    yield Snapshot.start(mqtt).proxy()
+    pykka.ActorRegistry.stop_all()
+
+
+def published(mqtt):
+    return {c.args[0]: json.loads(c.args[1]) for c in mqtt.publish.defer.call_args_list}
+
+
+class TestSnapshot:
+    def test_aggregate(self, mqtt, snapshot):
+        snapshot.update("/status/temperature/pool", 24.5)
+        snapshot.update("/status/temperature/pool_slope", 0.1)
+        snapshot.update("/status/filtration/state", "eco")
+        snapshot.update("/status/filtration/backwash/last", "never")
+        snapshot.do_publish().get()
+        assert published(mqtt) == {
+            "/status/snapshot/temperature": {"pool": 24.5, "pool_slope": 0.1},
+            "/status/snapshot/filtration": {"state": "eco", "backwash_last": "never"},
+        }
+        assert all(c.kwargs == {"retain": True} for c in mqtt.publish.defer.call_args_list)
+
+    def test_only_changed(self, mqtt, snapshot):
+        snapshot.update("/status/tank/state", "normal")
+        snapshot.update("/status/swim/state", "halt")
+        snapshot.do_publish().get()
+        mqtt.publish.defer.reset_mock()
+        snapshot.update("/status/tank/state", "normal")
+        snapshot.update("/status/swim/state", "timed")
+        snapshot.do_publish().get()
+        assert published(mqtt) == {"/status/snapshot/swim": {"state": "timed"}}
+
+    def test_unknown_subsystem(self, mqtt, snapshot):
+        snapshot.update("/status/water/counter", 12)
+        snapshot.do_publish().get()
+        mqtt.publish.defer.assert_not_called()
+
+    def test_on_change(self, mocker, mqtt, snapshot):
+        mocker.patch.object(Snapshot, "INTERVAL", 0)
+        snapshot.update("/status/heating/state", "waiting").get()
+        assert published(mqtt) == {"/status/snapshot/heating": {"state": "waiting"}}
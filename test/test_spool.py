@@ -0,0 +1,111 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import paho.mqtt.client as paho
+import pykka
+import pytest
+
+from controller.spool import Spool, compact
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "poupool.spool")
+
+
+def lines(path):
+    with open(path) as f:
+        return f.readlines()
+
+
+class TestSpool:
+    def test_batch(self, path):
+        spool = Spool(path, batch=3)
+        spool.append("/status/a", "1")
+        spool.append("/status/b", 2)
+        assert len(spool) == 2
+        with pytest.raises(FileNotFoundError):
+            lines(path)
+        spool.append("/status/c", 3.5, retain=True)
+        assert len(lines(path)) == 3
+        assert len(spool) == 3
+
+    def test_replay(self, path):
+        spool = Spool(path, batch=2)
+        spool.append("/status/a", "1")
+        spool.append("/status/b", 2, 1, True)
+        spool.append("/status/c", b"3")
+        assert spool.replay() == [["/status/a", "1", 0, False], ["/status/b", 2, 1, True], ["/status/c", "3", 0, False]]
+        assert len(spool) == 0
+        assert spool.replay() == []
+
+    def test_persistent(self, path):
+        spool = Spool(path)
+        spool.append("/status/water/counter", 10, retain=True)
+        spool.flush()
+        spool = Spool(path)
+        assert len(spool) == 1
+        assert spool.replay() == [["/status/water/counter", 10, 0, True]]
+
+    def test_compact(self):
+        entries = [["a", 1, 0, True], ["b", 1, 0, False], ["a", 2, 0, True], ["b", 2, 0, False]]
+        assert compact(entries) == [["b", 1, 0, False], ["a", 2, 0, True], ["b", 2, 0, False]]
+
+    def test_bounded(self, path):
+        spool = Spool(path, max_entries=10, batch=5)
+        for i in range(20):
+            spool.append("/status/water/counter", i, retain=True)
+            spool.append("/status/temperature/pool", i)
+        # Compacted and then the oldest are dropped
+        assert len(spool) == 10
+        assert len(lines(path)) == 10
+        entries = spool.replay()
+        assert entries[-1] == ["/status/temperature/pool", 19, 0, False]
+        assert ["/status/water/counter", 19, 0, True] in entries
+        assert spool.dropped > 0
+
+    def test_corrupted(self, path):
+        with open(path, "w") as f:
+            f.write('["/status/a", 1, 0, true]\n["/status/b", 2, 0')
+        assert Spool(path).replay() == [["/status/a", 1, 0, True]]
+
+
+class TestMqttSpool:
+    @pytest.fixture
+    def client(self, mocker, path):
+        mocker.patch("controller.mqtt.Spool", lambda _, max_entries, batch: Spool(path, max_entries, 1))
+        client = mocker.patch("controller.mqtt.mqtt.Client").return_value
+        yield client
+        pykka.ActorRegistry.stop_all()
+
+    def test_spool_when_disconnected(self, mocker, client):
+        from controller.mqtt import Mqtt
+
+        mqtt = Mqtt.start(mocker.Mock()).proxy()
+        client.publish.return_value = (paho.MQTT_ERR_NO_CONN, None)
+        assert not mqtt.publish("/status/water/counter", 1, retain=True).get()
+        client.publish.return_value = (paho.MQTT_ERR_SUCCESS, None)
+        # Still spooled to keep the order until the spool is replayed
+        assert not mqtt.publish("/status/water/counter", 2, retain=True).get()
+        assert not mqtt.publish("/status/temperature/pool", 24.5).get()
+        assert client.publish.call_count == 1
+        client.publish.reset_mock()
+        mqtt.do_replay().get()
+        assert [c.args for c in client.publish.call_args_list] == [
+            ("/status/water/counter", 2, 0, True),
+            ("/status/temperature/pool", 24.5, 0, False),
+        ]
+        assert mqtt.publish("/status/temperature/pool", 24.6).get()
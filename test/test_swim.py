@@ -18,7 +18,6 @@
 from unittest.mock import PropertyMock
 
 import pytest
-from pykka._threading import ThreadingFuture
 
 
 @pytest.fixture
@@ -64,9 +63,7 @@ class TestSwim:
 
     def test_continuous_state(self, mocker, swim, devices, filtration):
         # Filtration
-        future = mocker.Mock(ThreadingFuture)
-        filtration.is_overflow_normal = mocker.Mock(return_value=future)
-        future.get = mocker.Mock(return_value=True)
+        mocker.patch.dict("controller.actor._states", {"Filtration": "overflow_normal"})
         # Devices
         pump = devices.get_pump("swim")
         pump.speed = mocker.Mock()
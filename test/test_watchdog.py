@@ -0,0 +1,78 @@
+# Poupool - swimming pool control software
+# Copyright (C) 2019 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import threading
+import time
+
+import pykka
+import pytest
+
+from controller.actor import PoupoolActor
+from controller.watchdog import Watchdog
+
+
+class StuckActor(PoupoolActor):
+    def __init__(self, event):
+        super().__init__()
+        self.__event = event
+
+    def do_stuck(self):
+        self.__event.wait(5)
+
+
+@pytest.fixture
+def watchdog(mocker):
+    watchdog = Watchdog(budget=0.2, persistent=0.5)
+    mocker.patch("controller.backend.watchdog", watchdog)
+    yield watchdog
+    watchdog.stop()
+    pykka.ActorRegistry.stop_all()
+
+
+class TestWatchdog:
+    def test_stalled_handler(self, watchdog, caplog):
+        alerts = []
+        watchdog.start(alerts.append)
+        event = threading.Event()
+        actor = StuckActor.start(event).proxy()
+        actor.do_stuck.defer()
+        time.sleep(0.4)
+        assert not watchdog.stalled()
+        # Reported only once
+        assert [a["what"] for a in alerts] == ["StuckActor.do_stuck"]
+        assert "in do_stuck" in caplog.text
+        time.sleep(0.4)
+        assert watchdog.stalled()
+        event.set()
+        time.sleep(0.3)
+        assert not watchdog.stalled()
+
+    def test_stalled_wait(self, watchdog):
+        alerts = []
+        watchdog.start(alerts.append)
+        event = threading.Event()
+        actor = StuckActor.start(event).proxy()
+        future = actor.do_stuck()
+        threading.Timer(0.5, event.set).start()
+        future.get()
+        whats = [a["what"] for a in alerts]
+        assert "get()" in whats
+        assert "StuckActor.do_stuck" in whats
+
+    def test_not_running(self, watchdog):
+        assert watchdog.wait_started() is None
+        assert watchdog.check() == []